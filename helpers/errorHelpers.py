@@ -28,3 +28,23 @@ class ESError(Exception):
 class DataError(Exception):
     def __init__(self, message):
         self.message = message
+
+
+class CheckpointError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class TransformError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class BackfillError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+
+class ReconcileError(Exception):
+    def __init__(self, message):
+        self.message = message
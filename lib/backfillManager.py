@@ -0,0 +1,399 @@
+import json
+import os
+import time
+import traceback
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+
+from sfrCore import SessionManager
+
+from lib.dbManager import (
+    retrieveIDBounds,
+    retrieveLatestMark,
+    exportSnapshot,
+    importSnapshot
+)
+from lib.deadLetterManager import DeadLetterSpool, createDeadLetterSpool
+from lib.checkpointManager import CheckpointStore
+from lib.reindexManager import IndexRebuild
+
+from helpers.logHelpers import createLog
+from helpers.errorHelpers import BackfillError
+
+logger = createLog('backfill_manager')
+
+
+def partitionRange(lowID, highID, count):
+    """Split the work IDs from lowID to highID into count contiguous ranges
+    of equal width, each given as the (afterID, lastID) bounds of the range
+    """
+    span = highID - lowID + 1
+    count = max(1, min(count, span))
+    bounds = [lowID - 1 + (span * part) // count for part in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class BackfillState():
+    """The progress of a backfill, kept in a local JSON file so that an
+    interrupted backfill can be resumed. Each partition records the last
+    work ID it has indexed up to and the number of documents it has written.
+
+    The state of a rebuild also records the name of the index being built,
+    the checkpoint mark of the database state it was started from and
+    whether the index has been made live.
+    """
+    def __init__(self, path, partitions=None, rebuild=None):
+        self.path = path
+        self.partitions = partitions or []
+        self.rebuild = rebuild
+
+    @classmethod
+    def load(cls, path):
+        try:
+            with open(path) as stateFile:
+                stateData = json.load(stateFile)
+                return cls(
+                    path, stateData['partitions'], stateData.get('rebuild')
+                )
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError):
+            raise BackfillError('Unable to parse backfill state {}'.format(
+                path
+            ))
+
+    @classmethod
+    def create(cls, path, lowID, highID, count):
+        return cls(path, [
+            {
+                'number': number, 'after': afterID, 'last': lastID,
+                'done': afterID, 'documents': 0
+            }
+            for number, (afterID, lastID) in enumerate(
+                partitionRange(lowID, highID, count)
+            )
+        ])
+
+    @property
+    def pending(self):
+        return [
+            part for part in self.partitions if part['done'] < part['last']
+        ]
+
+    @property
+    def span(self):
+        return sum(part['last'] - part['after'] for part in self.partitions)
+
+    @property
+    def remaining(self):
+        return sum(part['last'] - part['done'] for part in self.partitions)
+
+    def advance(self, number, doneID, documents):
+        partition = self.partitions[number]
+        partition['done'] = doneID
+        partition['documents'] += documents
+
+    def save(self):
+        # Write to a temporary file and swap it in so that an interrupted
+        # write never leaves truncated progress behind
+        tmpPath = '{}.tmp'.format(self.path)
+        with open(tmpPath, 'w') as stateFile:
+            json.dump({
+                'partitions': self.partitions, 'rebuild': self.rebuild
+            }, stateFile, indent=2)
+        os.replace(tmpPath, self.path)
+
+
+class RelayedDeadLetterSpool(DeadLetterSpool):
+    """Dead letter spool of a backfill worker, which sends its letters to the
+    backfill process to be spooled rather than writing them itself, so that
+    concurrent workers do not write to the same spool
+    """
+    def __init__(self, conn):
+        super(RelayedDeadLetterSpool, self).__init__(None)
+        self.conn = conn
+
+    def flush(self):
+        if len(self.letters) < 1:
+            return
+
+        self.conn.send(('letters', self.letters))
+        self.letters = []
+
+
+def runPartition(conn, partition, chunkSize, snapshotID=None,
+                 rebuildIndex=None):
+    """Main loop of a backfill worker. Each worker opens its own database
+    session and ElasticSearch connection and indexes its partition of work
+    IDs in chunks, reporting the documents written in each chunk once it is
+    complete so that progress is only recorded for completed chunks.
+
+    If a snapshotID is provided the session reads from that snapshot for the
+    whole partition. It is also set as DB_SNAPSHOT, so that the transform
+    workers started for each chunk import it too. If a rebuildIndex is
+    provided the works are written to that index instead of the live one.
+    """
+    # Imported here so that the parent process does not open a connection
+    from lib.esManager import ESConnection
+
+    manager = SessionManager()
+    manager.generateEngine()
+    session = manager.createSession()
+
+    try:
+        if snapshotID is not None:
+            importSnapshot(session, snapshotID)
+            os.environ['DB_SNAPSHOT'] = snapshotID
+
+        es = ESConnection()
+        es.deadLetters = RelayedDeadLetterSpool(conn)
+
+        doneID = partition['done']
+        while doneID < partition['last']:
+            chunkEnd = min(doneID + chunkSize, partition['last'])
+            es.generateRecords(
+                session, rebuildIndex=rebuildIndex,
+                workRange=(doneID, chunkEnd)
+            )
+            doneID = chunkEnd
+            conn.send(('progress', (
+                doneID, es.success + es.failure + es.unchanged + es.stale
+            )))
+    except Exception:
+        conn.send(('error', traceback.format_exc()))
+    finally:
+        manager.closeConnection()
+        conn.close()
+
+
+class BackfillWorker():
+    """A process indexing one partition. These are not daemon processes, as
+    each may start its own pool of transform workers with INDEX_WORKERS, so
+    they are terminated explicitly if the backfill is stopped.
+    """
+    def __init__(self, partition, chunkSize, snapshotID=None,
+                 rebuildIndex=None):
+        self.number = partition['number']
+        self.conn, workerConn = Pipe()
+        self.process = Process(
+            target=runPartition,
+            args=(workerConn, partition, chunkSize, snapshotID, rebuildIndex)
+        )
+        self.process.start()
+        workerConn.close()
+
+    def receive(self):
+        try:
+            return self.conn.recv()
+        except EOFError:
+            return 'exit', None
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+class Backfill():
+    """Indexes every work in the database from a set of worker processes,
+    each indexing a contiguous partition of the work IDs. This process
+    records the progress of each partition in a BackfillState, spools the
+    dead letters of every worker and reports the throughput and estimated
+    time remaining. A backfill resumes from its state file if it exists.
+
+    With snapshot set this process exports a snapshot of the database that
+    every worker reads from, so that together they index a single consistent
+    state of it even while it is being written to. A snapshot can only be
+    imported while the transaction that exported it is open, and transform
+    workers import it afresh for every chunk, so it is held until every
+    partition has finished.
+
+    With rebuild set the works are written to a new versioned index instead,
+    an IndexRebuild, which replaces the live index behind the ES_INDEX alias
+    once every partition is complete. The checkpoint is then moved back to
+    the latest work read when the rebuild started, if it has passed it, so
+    that the next scheduled run indexes the changes made during the rebuild
+    into the new index.
+    """
+    def __init__(self, statePath, workerCount, chunkSize, snapshot=False,
+                 rebuild=False):
+        self.statePath = statePath
+        self.workerCount = workerCount
+        self.chunkSize = chunkSize
+        self.snapshot = snapshot
+        self.rebuild = rebuild
+        self.deadLetters = createDeadLetterSpool(os.environ['ES_INDEX'])
+        self.es = None
+        self.failed = []
+
+    def loadState(self, session):
+        state = BackfillState.load(self.statePath)
+        if state is not None:
+            if (state.rebuild is not None) != self.rebuild:
+                raise BackfillError(
+                    'State {} is of a different kind of backfill, pass '
+                    '--restart to discard it'.format(self.statePath)
+                )
+            logger.info('Resuming backfill from {}'.format(self.statePath))
+            return state
+
+        lowID, highID = retrieveIDBounds(session)
+        if lowID is None:
+            return BackfillState(self.statePath)
+
+        logger.info('Backfilling works {} to {} in {} partitions'.format(
+            lowID, highID, self.workerCount
+        ))
+        state = BackfillState.create(
+            self.statePath, lowID, highID, self.workerCount
+        )
+        if self.rebuild:
+            state.rebuild = self.createRebuild(session)
+        state.save()
+        return state
+
+    def reset(self):
+        """Discard the progress of an earlier backfill, deleting the index of
+        a rebuild that was not completed
+        """
+        state = BackfillState.load(self.statePath)
+        if state is None:
+            return
+
+        if state.rebuild is not None and not state.rebuild['live']:
+            IndexRebuild(
+                self.connection().client, os.environ['ES_INDEX'],
+                state.rebuild['index']
+            ).discard()
+        os.remove(self.statePath)
+
+    def run(self, session):
+        snapshotID = exportSnapshot(session) if self.snapshot else None
+        state = self.loadState(session)
+        rebuildIndex = state.rebuild['index'] if state.rebuild else None
+        pending = state.pending
+        if len(pending) < 1:
+            logger.info('Backfill is complete')
+            self.releaseSnapshot(session)
+            self.finishRebuild(state)
+            return
+
+        self.start = time.perf_counter()
+        self.startRemaining = state.remaining
+        self.documents = 0
+        workers = {}
+        try:
+            for partition in pending:
+                worker = BackfillWorker(
+                    partition, self.chunkSize, snapshotID, rebuildIndex
+                )
+                workers[worker.conn] = worker
+            logger.info('Started {} backfill workers'.format(len(workers)))
+
+            while len(workers) > 0:
+                for conn in wait(list(workers.keys())):
+                    worker = workers[conn]
+                    if self.handleMessage(state, worker, *worker.receive()):
+                        worker.process.join()
+                        del workers[conn]
+        finally:
+            for worker in workers.values():
+                worker.terminate()
+            self.releaseSnapshot(session)
+            self.deadLetters.flush()
+            state.save()
+
+        if len(self.failed) > 0:
+            raise BackfillError(
+                'Backfill partitions {} failed, rerun to resume them'.format(
+                    ', '.join(str(number) for number in self.failed)
+                )
+            )
+        logger.info('Backfill complete, {} documents written'.format(
+            sum(part['documents'] for part in state.partitions)
+        ))
+        self.finishRebuild(state)
+
+    def connection(self):
+        # Imported here, as in runPartition, so that a backfill of the live
+        # index does not open a connection in this process
+        from lib.esManager import ESConnection
+
+        if self.es is None:
+            self.es = ESConnection()
+        return self.es
+
+    def createRebuild(self, session):
+        """Create the index of a new rebuild, returning its state. The mark
+        is read in the same transaction as the partitions, from the exported
+        snapshot if there is one, so every later change is after it.
+        """
+        es = self.connection()
+        rebuild = IndexRebuild(es.client, es.index)
+        rebuild.create()
+
+        mark = retrieveLatestMark(session)
+        return {
+            'index': rebuild.name,
+            'mark': CheckpointStore.encodeMark(mark) if mark else None,
+            'live': False
+        }
+
+    def finishRebuild(self, state):
+        """Make the index of a completed rebuild live and move the
+        checkpoint back to the start of the rebuild if it has passed it.
+        This is retried by rerunning a rebuild whose partitions are complete.
+        """
+        if state.rebuild is None or state.rebuild['live']:
+            return
+
+        es = self.connection()
+        IndexRebuild(es.client, es.index, state.rebuild['index']).finish()
+
+        if es.checkpoint is not None and state.rebuild['mark'] is not None:
+            mark = CheckpointStore.decodeMark(state.rebuild['mark'])
+            current = es.checkpoint.load()
+            if current is None or tuple(current) > mark:
+                logger.info('Moving checkpoint back to {}'.format(mark))
+                es.checkpoint.save(mark)
+
+        state.rebuild['live'] = True
+        state.save()
+
+    def handleMessage(self, state, worker, msgType, payload):
+        """Handle a message from a worker, returning True once it has exited"""
+        if msgType == 'letters':
+            self.deadLetters.extend(payload)
+            return False
+        elif msgType == 'progress':
+            doneID, documents = payload
+            state.advance(worker.number, doneID, documents)
+            state.save()
+            self.documents += documents
+            self.logProgress(state)
+            return False
+        elif msgType == 'error':
+            logger.error('Backfill partition {} failed\n{}'.format(
+                worker.number, payload
+            ))
+            self.failed.append(worker.number)
+
+        return True
+
+    def releaseSnapshot(self, session):
+        if self.snapshot:
+            logger.info('Releasing exported database snapshot')
+            session.rollback()
+
+    def logProgress(self, state):
+        elapsed = time.perf_counter() - self.start
+        covered = self.startRemaining - state.remaining
+        rate = self.documents / elapsed if elapsed > 0 else 0
+        # Work IDs are roughly evenly spread, so the time remaining is
+        # estimated from the share of the ID range still to be indexed
+        eta = elapsed * state.remaining / covered if covered > 0 else None
+
+        logger.info('Backfill {:.1f}% | {:.1f} docs/s | ETA {}'.format(
+            100 * (state.span - state.remaining) / state.span, rate,
+            '{:.0f}s'.format(eta) if eta is not None else 'unknown'
+        ))
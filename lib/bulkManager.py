@@ -0,0 +1,400 @@
+import asyncio
+import heapq
+import os
+import random
+import time
+from collections import deque
+from itertools import count
+from concurrent.futures import ThreadPoolExecutor
+
+from elasticsearch.exceptions import (
+    ConnectionError,
+    ConnectionTimeout,
+    TransportError
+)
+from elasticsearch.helpers import BulkIndexError, expand_action
+
+from helpers.logHelpers import createLog
+
+logger = createLog('bulk_manager')
+
+# Smallest chunk size the controller will back off to
+MIN_CHUNK_SIZE = 10
+
+# Bulk item statuses that indicate the cluster is overloaded rather than
+# that the document is invalid, and so are worth retrying. A request that
+# times out is reported as a 408 for each of its documents
+RETRYABLE_STATUSES = (408, 429, 503)
+
+
+def createBulkSink(client):
+    """Create the bulk writer for a run, configured with BULK_CHUNK_BYTES
+    (the maximum size of a request body, default 10MB), BULK_MAX_RETRIES
+    (the number of times a rejected document is resent, default 3) and
+    BULK_RETRY_BACKOFF/BULK_MAX_RETRY_BACKOFF (the base and maximum seconds
+    to wait before resending, default 1 and 60). The number and size of the
+    requests are set by a ChunkController.
+    """
+    return BulkSink(
+        client,
+        createChunkController(),
+        chunkBytes=int(os.environ.get('BULK_CHUNK_BYTES', 10 * 1024 * 1024)),
+        maxRetries=int(os.environ.get('BULK_MAX_RETRIES', 3)),
+        retryBackoff=float(os.environ.get('BULK_RETRY_BACKOFF', 1)),
+        maxRetryBackoff=float(os.environ.get('BULK_MAX_RETRY_BACKOFF', 60))
+    )
+
+
+def createChunkController():
+    """Create the chunk controller for a run. BULK_CHUNK_SIZE (default 500)
+    and BULK_CONCURRENCY (default 4) set the initial number of documents per
+    request and of requests in flight, which grow while requests complete
+    within BULK_TARGET_LATENCY seconds (default 2) up to BULK_MAX_CHUNK_SIZE
+    (default 5000) and BULK_MAX_CONCURRENCY (default 8). A target latency of
+    0 keeps the initial values fixed.
+    """
+    return ChunkController(
+        int(os.environ.get('BULK_CHUNK_SIZE', 500)),
+        int(os.environ.get('BULK_CONCURRENCY', 4)),
+        targetLatency=float(os.environ.get('BULK_TARGET_LATENCY', 2)),
+        maxChunkSize=int(os.environ.get('BULK_MAX_CHUNK_SIZE', 5000)),
+        maxConcurrency=int(os.environ.get('BULK_MAX_CONCURRENCY', 8))
+    )
+
+
+class ChunkController():
+    """Sizes bulk requests with additive increase, multiplicative decrease
+    (AIMD). While requests complete within the target latency the chunk size
+    grows by a fixed step and the concurrency by one request. When the
+    cluster rejects documents (429) or a request times out both are halved.
+    Requests that are slow but succeed leave the sizes unchanged.
+    """
+    def __init__(self, chunkSize, concurrency, targetLatency=2,
+                 maxChunkSize=5000, maxConcurrency=8):
+        self.maxChunkSize = max(maxChunkSize, chunkSize)
+        self.maxConcurrency = max(maxConcurrency, concurrency, 1)
+        self.chunkSize = chunkSize
+        self.concurrency = max(concurrency, 1)
+        self.targetLatency = targetLatency
+        self.step = max(chunkSize // 10, 1)
+
+        self.started = time.perf_counter()
+        self.indexed = 0
+
+    def record(self, latency, count, rejected=0):
+        """Update the sizes from the outcome of a bulk request"""
+        self.indexed += count - rejected
+        if self.targetLatency <= 0:
+            return
+
+        if rejected > 0:
+            self.backOff()
+        elif latency < self.targetLatency:
+            self.grow()
+
+    def grow(self):
+        chunkSize = min(self.chunkSize + self.step, self.maxChunkSize)
+        concurrency = min(self.concurrency + 1, self.maxConcurrency)
+        self._resize(chunkSize, concurrency)
+
+    def backOff(self):
+        if self.targetLatency <= 0:
+            return
+
+        chunkSize = max(self.chunkSize // 2, MIN_CHUNK_SIZE)
+        concurrency = max(self.concurrency // 2, 1)
+        self._resize(chunkSize, concurrency)
+
+    def throughput(self):
+        elapsed = time.perf_counter() - self.started
+        return self.indexed / elapsed if elapsed > 0 else 0
+
+    def _resize(self, chunkSize, concurrency):
+        if chunkSize == self.chunkSize and concurrency == self.concurrency:
+            return
+
+        self.chunkSize, self.concurrency = chunkSize, concurrency
+        logger.info(
+            'Bulk chunk size {} | concurrency {} | {:.1f} docs/s'.format(
+                self.chunkSize, self.concurrency, self.throughput()
+            )
+        )
+
+
+class BulkEntry():
+    """A single action serialized into the lines of a bulk request body. A
+    source already serialized for an earlier entry can be passed as
+    sourceLine, so it is not serialized again.
+    """
+    def __init__(self, action, serializer, sourceLine=None):
+        header, source = expand_action(action)
+        self.opType, self.meta = next(iter(header.items()))
+        self.lines = [serializer.dumps(header)]
+        if sourceLine is not None:
+            self.lines.append(sourceLine)
+        elif source is not None:
+            self.lines.append(serializer.dumps(source))
+        self.size = sum(len(line.encode('utf-8')) + 1 for line in self.lines)
+        self.attempts = 0
+
+    def result(self, status, error):
+        """Build a bulk response item for an entry that was not written"""
+        result = dict(self.meta)
+        result.update({'status': status, 'error': error})
+        return {self.opType: result}
+
+
+class BulkSink():
+    """Writes a stream of bulk actions to ElasticSearch, in chunks capped by
+    both the number of actions and the serialized size of the request body,
+    with several requests in flight at once. This fills the role of the
+    streaming_bulk helper and yields an (ok, item) pair for each action in
+    the same way, though not necessarily in the order provided.
+
+    The number of actions per chunk and of requests in flight are taken from
+    the ChunkController as each chunk is built, so they adapt over the run.
+    Documents rejected by an overloaded cluster (429 or 503) and those in
+    requests that time out are resent up to maxRetries times. Each retry
+    waits out an exponential backoff with full jitter, during which the rest
+    of the stream continues to be sent.
+
+    Requests are made from a ThreadPoolExecutor rather than with the
+    parallel_bulk helper, as the multiprocessing ThreadPool that helper uses
+    depends on shared memory that is not available in the Lambda runtime.
+    """
+    def __init__(self, client, controller, chunkBytes=10485760, maxRetries=3,
+                 retryBackoff=1, maxRetryBackoff=60):
+        self.client = client
+        self.serializer = client.transport.serializer
+        self.controller = controller
+        self.chunkBytes = chunkBytes
+        self.maxRetries = maxRetries
+        self.retryBackoff = retryBackoff
+        self.maxRetryBackoff = maxRetryBackoff
+        # Heap of (time ready, sequence, entry) for entries to be resent
+        self.retries = []
+        self.retrySequence = count()
+        self.carried = None
+        self.lastSource = None
+        self.lastSourceLine = None
+
+    def write(self, actions, raiseOnError=True):
+        """Write the actions, yielding the result of each. If any action
+        fails and raiseOnError is set a BulkIndexError listing the failures
+        is raised once every request has completed, so that no results are
+        lost.
+        """
+        errors = []
+        inFlight = deque()
+        actions = iter(actions)
+        with ThreadPoolExecutor(
+            max_workers=self.controller.maxConcurrency
+        ) as executor:
+            while True:
+                while len(inFlight) < self.controller.concurrency:
+                    chunk = self.nextChunk(actions)
+                    if chunk is None:
+                        break
+                    inFlight.append(executor.submit(self.sendChunk, chunk))
+
+                if len(inFlight) > 0:
+                    for ok, item in self.collect(inFlight.popleft().result()):
+                        if not ok:
+                            errors.append(item)
+                        yield ok, item
+                elif len(self.retries) > 0:
+                    # Only retries that are waiting out their backoff remain
+                    time.sleep(max(self.retries[0][0] - time.monotonic(), 0))
+                else:
+                    break
+
+        if raiseOnError and len(errors) > 0:
+            raise BulkIndexError(
+                '{} document(s) failed to index.'.format(len(errors)), errors
+            )
+
+    async def writeAsync(self, batches, send):
+        """Async equivalent of write, taking lists of actions from the asyncio
+        Queue batches until it receives None and yielding the result of each.
+        Chunks are sent with the coroutine function send, which returns the
+        same values as sendChunk. More actions are only taken from the queue
+        while there are not enough buffered to fill a chunk, so a slow cluster
+        holds back the stages that fill the queue.
+        """
+        buffer = deque()
+        inFlight = []
+        nextBatch = None
+        done = False
+        while True:
+            while len(inFlight) < self.controller.concurrency and (
+                done or len(buffer) >= self.controller.chunkSize
+                or self._retryReady()
+            ):
+                chunk = self.nextChunk(BulkSink._drain(buffer))
+                if chunk is None:
+                    break
+                inFlight.append(asyncio.ensure_future(send(chunk)))
+
+            if not done and nextBatch is None\
+                    and len(buffer) < self.controller.chunkSize:
+                nextBatch = asyncio.ensure_future(batches.get())
+
+            waiting = set(inFlight)
+            if nextBatch is not None:
+                waiting.add(nextBatch)
+            if len(waiting) < 1 and len(self.retries) < 1:
+                break
+
+            retryDelay = None
+            if len(self.retries) > 0:
+                retryDelay = max(self.retries[0][0] - time.monotonic(), 0)
+
+            if len(waiting) < 1:
+                await asyncio.sleep(retryDelay)
+                continue
+
+            finished, _ = await asyncio.wait(
+                waiting, timeout=retryDelay,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+
+            if nextBatch in finished:
+                batch = nextBatch.result()
+                nextBatch = None
+                if batch is None:
+                    done = True
+                else:
+                    buffer.extend(batch)
+
+            for sent in [task for task in inFlight if task in finished]:
+                inFlight.remove(sent)
+                for ok, item in self.collect(sent.result()):
+                    yield ok, item
+
+    def nextChunk(self, actions):
+        """Build the next chunk, taking entries queued for retry before those
+        from the stream of actions. A chunk is closed when adding the next
+        entry would exceed either the current chunk size or chunkBytes, so a
+        single entry larger than chunkBytes is sent in a chunk of its own.
+        Returns None if there is nothing ready to send.
+        """
+        chunk, size = [], 0
+        while len(chunk) < self.controller.chunkSize:
+            entry = self._nextEntry(actions)
+            if entry is None:
+                break
+
+            if len(chunk) > 0 and size + entry.size > self.chunkBytes:
+                self.carried = entry
+                break
+
+            chunk.append(entry)
+            size += entry.size
+
+        return chunk if len(chunk) > 0 else None
+
+    def _nextEntry(self, actions):
+        if self.carried is not None:
+            entry, self.carried = self.carried, None
+            return entry
+        if self._retryReady():
+            return heapq.heappop(self.retries)[2]
+
+        action = next(actions, None)
+        if action is None:
+            return None
+        # The same document written to several indexes shares its source, so
+        # it is only serialized for the first of them
+        source = action.get('_source', None)
+        if source is None or source is not self.lastSource:
+            entry = BulkEntry(action, self.serializer)
+            self.lastSource = source
+            self.lastSourceLine = entry.lines[-1]
+            return entry
+
+        return BulkEntry(action, self.serializer, self.lastSourceLine)
+
+    def _retryReady(self):
+        return len(self.retries) > 0 and self.retries[0][0] <= time.monotonic()
+
+    @staticmethod
+    def _drain(buffer):
+        while len(buffer) > 0:
+            yield buffer.popleft()
+
+    def sendChunk(self, chunk):
+        """Send a chunk, returning it along with the request latency and the
+        response items. If the whole request fails with an error worth
+        retrying an item is returned for each entry with the status of that
+        error, so that they are retried like documents the cluster rejected.
+        """
+        body = '\n'.join(line for entry in chunk for line in entry.lines)
+        start = time.perf_counter()
+        try:
+            response = self.client.bulk(body + '\n')
+        except TransportError as err:
+            items = BulkSink._failedItems(chunk, err)
+            return chunk, time.perf_counter() - start, items
+        return chunk, time.perf_counter() - start, response['items']
+
+    async def sendChunkAsync(self, chunk, asyncClient):
+        """Equivalent of sendChunk for an async ElasticSearch client"""
+        body = '\n'.join(line for entry in chunk for line in entry.lines)
+        start = time.perf_counter()
+        try:
+            response = await asyncClient.bulk(body + '\n')
+        except TransportError as err:
+            items = BulkSink._failedItems(chunk, err)
+            return chunk, time.perf_counter() - start, items
+        return chunk, time.perf_counter() - start, response['items']
+
+    @staticmethod
+    def _failedItems(chunk, err):
+        """Build the items of a request that failed as a whole. Timeouts,
+        connection errors and requests rejected by an overloaded cluster are
+        retried, and any other error is raised.
+        """
+        if isinstance(err, ConnectionTimeout):
+            status, error = 408, 'Bulk request timed out'
+        elif isinstance(err, ConnectionError):
+            status, error = 503, 'Bulk request failed: {}'.format(err)
+        elif err.status_code in RETRYABLE_STATUSES:
+            status = err.status_code
+            error = 'Bulk request rejected: {}'.format(err.error)
+        else:
+            raise err
+
+        logger.warning('{} ({} documents)'.format(error, len(chunk)))
+        return [entry.result(status, error) for entry in chunk]
+
+    def collect(self, sent):
+        """Yield the results of a completed request, queueing any rejected
+        entries to be retried and updating the controller.
+        """
+        chunk, latency, items = sent
+        rejected = 0
+        for entry, item in zip(chunk, items):
+            opType, result = next(iter(item.items()))
+            status = result.get('status', 500)
+            if status in RETRYABLE_STATUSES:
+                rejected += 1
+                if self._retry(entry):
+                    continue
+            yield 200 <= status < 300, {opType: result}
+
+        self.controller.record(latency, len(chunk), rejected)
+
+    def _retry(self, entry):
+        if entry.attempts >= self.maxRetries:
+            return False
+
+        backoff = min(
+            self.retryBackoff * (2 ** entry.attempts), self.maxRetryBackoff
+        )
+        entry.attempts += 1
+        heapq.heappush(self.retries, (
+            time.monotonic() + random.uniform(0, backoff),
+            next(self.retrySequence),
+            entry
+        ))
+        return True
@@ -0,0 +1,62 @@
+import os
+from collections import OrderedDict
+
+from helpers.logHelpers import createLog
+
+logger = createLog('cache_manager')
+
+
+def createDocCache():
+    """Create the sub-document cache for a single indexing run, sized with
+    DOC_CACHE_SIZE (default 10000 entries). A size of 0 disables caching.
+    """
+    maxSize = int(os.environ.get('DOC_CACHE_SIZE', 10000))
+    if maxSize < 1:
+        return None
+    return DocCache(maxSize)
+
+
+class DocCache():
+    """A bounded LRU cache of the sub-documents (agents, languages, rights)
+    built for records that are shared between many works. Entries are keyed
+    on the type of the entity, its row ID and its date_modified, so that a
+    record updated during a run is rebuilt rather than served stale.
+
+    Cached documents are never returned directly. Each fetch returns a copy
+    made with the provided copy method, so that callers are free to modify
+    the top level of the document (e.g. to set the roles of an agent).
+    """
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.docs = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def fetch(self, entityType, record, build, copy):
+        recordID = getattr(record, 'id', None)
+        if recordID is None:
+            return build(record)
+
+        key = (entityType, recordID, getattr(record, 'date_modified', None))
+        doc = self.docs.get(key, None)
+        if doc is not None:
+            self.hits += 1
+            self.docs.move_to_end(key)
+            return copy(doc)
+
+        self.misses += 1
+        doc = build(record)
+        self.docs[key] = doc
+        if len(self.docs) > self.maxSize:
+            self.docs.popitem(last=False)
+            self.evictions += 1
+
+        return copy(doc)
+
+    def logStats(self):
+        logger.info(
+            'Document cache hits: {} | misses: {} | evictions: {}'.format(
+                self.hits, self.misses, self.evictions
+            )
+        )
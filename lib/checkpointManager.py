@@ -0,0 +1,249 @@
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from elasticsearch.exceptions import NotFoundError
+
+from helpers.logHelpers import createLog
+from helpers.errorHelpers import CheckpointError
+
+logger = createLog('checkpoint_manager')
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def createCheckpointStore(client, index):
+    """Create the checkpoint store configured for this environment. The
+    backend is set with CHECKPOINT_BACKEND and may be "elasticsearch" (the
+    default), "file", "sqlite" or "none" to disable checkpointing and fall
+    back to the INDEX_PERIOD window on every run.
+    """
+    backend = os.environ.get('CHECKPOINT_BACKEND', 'elasticsearch').lower()
+
+    if backend == 'none':
+        return None
+    elif backend == 'elasticsearch':
+        checkpointIndex = os.environ.get(
+            'CHECKPOINT_INDEX', '{}_checkpoints'.format(index)
+        )
+        return ESCheckpointStore(client, checkpointIndex, index)
+    elif backend == 'file':
+        path = os.environ.get('CHECKPOINT_PATH', 'checkpoints.json')
+        return FileCheckpointStore(path, index)
+    elif backend == 'sqlite':
+        path = os.environ.get('CHECKPOINT_PATH', 'checkpoints.db')
+        return SQLiteCheckpointStore(path, index)
+
+    raise CheckpointError('Unknown checkpoint backend {}'.format(backend))
+
+
+class CheckpointStore(ABC):
+    """Base class for checkpoint backends. A checkpoint is the highest
+    (date_modified, id) pair of the works that have been successfully indexed,
+    stored under a name (the ES index being written to) so that several
+    indexes can share a single backend. A backend that does not implement
+    both load and save cannot be instantiated.
+    """
+    def __init__(self, name):
+        self.name = name
+
+    @abstractmethod
+    def load(self):
+        """Return the stored mark, or None if there is no checkpoint yet"""
+
+    @abstractmethod
+    def save(self, mark):
+        """Store the mark, replacing any earlier checkpoint"""
+
+    @staticmethod
+    def encodeMark(mark):
+        dateModified, workID = mark
+        return {
+            'date_modified': dateModified.strftime(DATE_FORMAT),
+            'id': workID
+        }
+
+    @staticmethod
+    def decodeMark(markData):
+        return (
+            datetime.strptime(markData['date_modified'], DATE_FORMAT),
+            markData['id']
+        )
+
+
+class FileCheckpointStore(CheckpointStore):
+    def __init__(self, path, name):
+        super(FileCheckpointStore, self).__init__(name)
+        self.path = path
+
+    def _readMarks(self):
+        try:
+            with open(self.path) as markFile:
+                return json.load(markFile)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            raise CheckpointError('Unable to parse checkpoint file {}'.format(
+                self.path
+            ))
+
+    def load(self):
+        markData = self._readMarks().get(self.name, None)
+        return self.decodeMark(markData) if markData else None
+
+    def save(self, mark):
+        marks = self._readMarks()
+        marks[self.name] = self.encodeMark(mark)
+
+        # Write to a temporary file and swap it in so that an interrupted
+        # write never leaves a truncated checkpoint behind
+        tmpPath = '{}.tmp'.format(self.path)
+        with open(tmpPath, 'w') as markFile:
+            json.dump(marks, markFile)
+        os.replace(tmpPath, self.path)
+
+
+class SQLiteCheckpointStore(CheckpointStore):
+    def __init__(self, path, name):
+        super(SQLiteCheckpointStore, self).__init__(name)
+        self.path = path
+
+        with self._connect() as conn:
+            conn.execute(
+                'CREATE TABLE IF NOT EXISTS checkpoints ('
+                'name TEXT PRIMARY KEY, date_modified TEXT, work_id INTEGER)'
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def load(self):
+        with self._connect() as conn:
+            row = conn.execute(
+                'SELECT date_modified, work_id FROM checkpoints '
+                'WHERE name = ?',
+                (self.name,)
+            ).fetchone()
+
+        if row is None:
+            return None
+        return self.decodeMark({'date_modified': row[0], 'id': row[1]})
+
+    def save(self, mark):
+        markData = self.encodeMark(mark)
+        with self._connect() as conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?)',
+                (self.name, markData['date_modified'], markData['id'])
+            )
+
+
+class ESCheckpointStore(CheckpointStore):
+    """Stores the checkpoint as a marker document in a small companion index.
+    This is kept out of the works index itself so that the marker is never
+    returned in search results.
+    """
+    def __init__(self, client, index, name):
+        super(ESCheckpointStore, self).__init__(name)
+        self.client = client
+        self.index = index
+
+    def load(self):
+        try:
+            markDoc = self.client.get(
+                index=self.index, doc_type='doc', id=self.name
+            )
+        except NotFoundError:
+            return None
+        return self.decodeMark(markDoc['_source'])
+
+    def save(self, mark):
+        self.client.index(
+            index=self.index,
+            doc_type='doc',
+            id=self.name,
+            body=self.encodeMark(mark)
+        )
+
+
+class CheckpointTracker():
+    """Tracks the works sent for indexing in a run and maintains the high
+    water mark of the run. Works are added in the order they were retrieved
+    and the mark only advances past a work once it and every work before it
+    has been indexed, so a failed or interrupted run resumes from the first
+    work that was not written.
+
+    A document written to several indexes is bound once for each, and its
+    work is only complete once every copy has a result.
+
+    Works may be added and completed from different threads, e.g. by the
+    stages of an AsyncPipeline, so updates are made under a lock.
+
+    The saved mark is held lag seconds behind the current time. A change
+    can commit after a run with a date_modified stamped before it, e.g. in a
+    long transaction, so works modified in that window are scanned again by
+    the next run rather than skipped for good.
+    """
+    def __init__(self, store, lag=0):
+        self.store = store
+        self.lag = lag
+        self.pending = OrderedDict()
+        self.completed = set()
+        self.docs = {}
+        self.mark = None
+        self.lock = threading.Lock()
+
+    def add(self, workID, mark):
+        with self.lock:
+            self.pending[workID] = mark
+
+    def bind(self, docID, workID):
+        with self.lock:
+            copies = self.docs.get(str(docID), (workID, 0))[1]
+            self.docs[str(docID)] = (workID, copies + 1)
+
+    def complete(self, docID):
+        with self.lock:
+            workID, copies = self.docs.pop(str(docID), (None, 0))
+            if copies > 1:
+                self.docs[str(docID)] = (workID, copies - 1)
+                return
+        if workID is None:
+            return
+
+        self.skip(workID)
+
+    def skip(self, workID):
+        """Mark a work as done without a document being indexed for it"""
+        with self.lock:
+            self.completed.add(workID)
+            self._advance()
+
+    def _advance(self):
+        while len(self.pending) > 0:
+            workID, mark = next(iter(self.pending.items()))
+            if workID not in self.completed:
+                break
+
+            self.pending.popitem(last=False)
+            self.completed.discard(workID)
+            self.mark = mark
+
+    def save(self):
+        if self.store is None or self.mark is None:
+            return
+
+        mark = self.mark
+        if self.lag > 0:
+            cutoff = datetime.utcnow() - timedelta(seconds=self.lag)
+            if mark[0] > cutoff:
+                mark = (cutoff, 0)
+
+        logger.info('Saving checkpoint {} for {}'.format(
+            mark, self.store.name
+        ))
+        self.store.save(mark)
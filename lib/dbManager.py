@@ -1,25 +1,569 @@
 import os
 from datetime import datetime, timedelta
 
-from sfrCore import Work
+from sqlalchemy import (
+    tuple_,
+    inspect,
+    func,
+    text,
+    Table,
+    MetaData,
+    Column,
+    Integer,
+    DateTime,
+    Index
+)
+from sqlalchemy.orm import selectinload
+from sqlalchemy.orm.interfaces import ONETOMANY
+
+from sfrCore import Work, Instance, Item
 
 from helpers.logHelpers import createLog
 from helpers.errorHelpers import DBError
 
 logger = createLog('db_manager')
 
+WORK_LOAD_OPTIONS = None
+WORK_GRAPH_PATHS = None
+
+
+def retrieveRecords(session, pageSize=None, checkpoint=None, fullScan=False,
+                    formerParents=None):
+    """Retrieve all recently updated works in the SFR database, yielding them
+    in batches of (id, date_modified) rows. Rather than loading the full
+    result set this pages through the works table with keyset pagination on
+    (date_modified, id), so memory use is bounded by the page size regardless
+    of the size of the window.
+
+    If a checkpoint (the last (date_modified, id) pair indexed) is provided
+    retrieval starts immediately after it. With fullScan set every work is
+    retrieved, otherwise works modified in the last INDEX_PERIOD seconds are.
+
+    With INDEX_CHANGE_SCOPE set to "graph" changes to the records embedded in
+    a work's document are detected as well, with retrieveGraphChanges, which
+    is passed formerParents.
+    """
+    if pageSize is None:
+        pageSize = int(os.environ.get('INDEX_BATCH_SIZE', 100))
+
+    scope = os.environ.get('INDEX_CHANGE_SCOPE', 'work').lower()
+    if scope == 'graph' and not fullScan:
+        yield from retrieveGraphChanges(
+            session, pageSize, checkpoint, formerParents
+        )
+        return
+
+    windowQuery = session.query(Work.id, Work.date_modified)
+    if checkpoint is not None:
+        logger.debug('Loading Records updated since checkpoint {}'.format(
+            checkpoint
+        ))
+        lastKey = tuple(checkpoint)
+    elif fullScan:
+        logger.debug('Loading all Records')
+        lastKey = None
+    else:
+        logger.debug('Loading Records updated in last {} seconds'.format(
+            os.environ['INDEX_PERIOD'])
+        )
+        fetchPeriod = datetime.utcnow()\
+            - timedelta(seconds=int(os.environ['INDEX_PERIOD']))
+        windowQuery = windowQuery.filter(Work.date_modified >= fetchPeriod)
+        lastKey = None
+
+    while True:
+        pageQuery = windowQuery
+        if lastKey is not None:
+            pageQuery = pageQuery.filter(
+                tuple_(Work.date_modified, Work.id) > tuple_(*lastKey)
+            )
+
+        page = pageQuery.order_by(Work.date_modified, Work.id)\
+            .limit(pageSize)\
+            .all()
+        if len(page) < 1:
+            break
+
+        logger.debug('Retrieved page of {} works after {}'.format(
+            len(page), lastKey
+        ))
+        yield page
+
+        if len(page) < pageSize:
+            break
+        lastKey = (page[-1][1], page[-1][0])
+
+
+def retrieveWorkIDs(session, identifiers):
+    """Resolve a set of work, instance and item identifiers to the distinct
+    (id, date_modified) rows of their parent works. Works are identified by
+    UUID and instances and items by their row ID. All lookups are combined
+    into a single UNION query, which also removes any duplicate works.
+    """
+    lookups = []
+
+    if identifiers.get('work'):
+        lookups.append(
+            session.query(Work.id, Work.date_modified)
+                .filter(Work.uuid.in_(identifiers['work']))
+        )
+
+    if identifiers.get('instance'):
+        lookups.append(
+            session.query(Work.id, Work.date_modified)
+                .join(Work.instances)
+                .filter(Instance.id.in_(identifiers['instance']))
+        )
+
+    if identifiers.get('item'):
+        lookups.append(
+            session.query(Work.id, Work.date_modified)
+                .join(Work.instances)
+                .join(Instance.items)
+                .filter(Item.id.in_(identifiers['item']))
+        )
+
+    if len(lookups) < 1:
+        return []
+
+    logger.debug('Resolving {} identifiers to parent works'.format(
+        sum(len(ids) for ids in identifiers.values())
+    ))
+    return lookups[0].union(*lookups[1:]).order_by(Work.id).all()
+
+
+def retrieveWorkRange(session, afterID, lastID, pageSize=None):
+    """Retrieve the works with IDs after afterID up to and including lastID,
+    yielding them in batches of (id, date_modified) rows. The range is paged
+    through with keyset pagination on the ID, so memory use is bounded by
+    the page size regardless of the size of the range.
+    """
+    if pageSize is None:
+        pageSize = int(os.environ.get('INDEX_BATCH_SIZE', 100))
+
+    while afterID < lastID:
+        page = session.query(Work.id, Work.date_modified)\
+            .filter(Work.id > afterID, Work.id <= lastID)\
+            .order_by(Work.id)\
+            .limit(pageSize)\
+            .all()
+        if len(page) < 1:
+            break
+
+        yield page
+
+        if len(page) < pageSize:
+            break
+        afterID = page[-1][0]
+
+
+def retrieveIDBounds(session):
+    """Return the lowest and highest work IDs, or (None, None) if there are
+    no works
+    """
+    return tuple(session.query(func.min(Work.id), func.max(Work.id)).one())
+
+
+def retrieveLatestMark(session):
+    """Return the (date_modified, id) pair of the most recently modified
+    work, in the order that checkpoints are kept, or None if there are no works
+    """
+    row = session.query(Work.date_modified, Work.id)\
+        .order_by(Work.date_modified.desc(), Work.id.desc())\
+        .first()
+    return tuple(row) if row is not None else None
+
+
+def exportSnapshot(session):
+    """Start a REPEATABLE READ transaction on the session and export its
+    snapshot, returning the snapshot ID. Other sessions can read the same
+    state of the database by importing it with importSnapshot, for as long
+    as this transaction remains open.
+    """
+    session.rollback()
+    session.execute(text('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ'))
+    snapshotID = session.execute(text('SELECT pg_export_snapshot()')).scalar()
+    logger.info('Exported database snapshot {}'.format(snapshotID))
+    return snapshotID
+
+
+def importSnapshot(session, snapshotID):
+    """Start a REPEATABLE READ transaction on the session that reads from a
+    snapshot exported by another session. The session reads from it until
+    the transaction is ended, so it must not be committed during a run.
+    """
+    session.rollback()
+    session.execute(text('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ'))
+    session.execute(
+        text('SET TRANSACTION SNAPSHOT :snapshot'), {'snapshot': snapshotID}
+    )
+    logger.debug('Imported database snapshot {}'.format(snapshotID))
+
+
+def retrieveGraphChanges(session, pageSize, checkpoint=None,
+                         formerParents=None):
+    """Retrieve the works with a change to any record embedded in their
+    documents, yielding them in batches of (id, modified) rows. The modified
+    rows of the works table and of each related table are combined in a
+    single UNION ALL query, joined back to their parent works and grouped so
+    that each work appears once at the time of its latest change. A single
+    agent edit therefore becomes a batch of just the works it appears in.
+
+    The change set of the window is written once to a temporary table, which
+    is paged through with keyset pagination on (modified, id), as in
+    retrieveRecords. The rows are ordered in the same way as those from the
+    works table alone, so checkpoints are interchangeable between the two.
+
+    A work whose instance is moved to another work, e.g. in a merge, is not
+    itself changed. If formerParents is provided it is called with batches
+    of the instances changed in the window, and the works whose documents
+    still hold them are added to the change set, with _addFormerParents.
+    """
+    if checkpoint is not None:
+        logger.debug('Loading Records with changes since checkpoint {}'.format(
+            checkpoint
+        ))
+        lastKey = tuple(checkpoint)
+        since = lastKey[0]
+    else:
+        logger.debug('Loading Records with changes in last {} seconds'.format(
+            os.environ['INDEX_PERIOD']
+        ))
+        lastKey = None
+        since = datetime.utcnow()\
+            - timedelta(seconds=int(os.environ['INDEX_PERIOD']))
+
+    changes = _createGraphChanges(session, since)
+    try:
+        if formerParents is not None:
+            _addFormerParents(session, changes, since, formerParents, pageSize)
+
+        while True:
+            pageQuery = session.query(changes.c.work_id, changes.c.modified)
+            if lastKey is not None:
+                pageQuery = pageQuery.filter(
+                    tuple_(changes.c.modified, changes.c.work_id)
+                    > tuple_(*lastKey)
+                )
+
+            page = pageQuery.order_by(changes.c.modified, changes.c.work_id)\
+                .limit(pageSize)\
+                .all()
+            if len(page) < 1:
+                break
+
+            logger.debug('Retrieved page of {} changed works after {}'.format(
+                len(page), lastKey
+            ))
+            yield page
+
+            if len(page) < pageSize:
+                break
+            lastKey = (page[-1][1], page[-1][0])
+    finally:
+        changes.drop(bind=session.connection(), checkfirst=True)
+
 
-def retrieveRecords(session):
-    """Retrieve all recently updated works in the SFR database and generate
-    elasticsearch-dsl ORM objects.
+def _createGraphChanges(session, since):
+    """Write the (work_id, modified) change set of the window starting at
+    since to a temporary table, returning the table. The table only exists
+    on the connection of the session and is dropped once it is paged through.
     """
-    logger.debug('Loading Records updated in last {} seconds'.format(
-        os.environ['INDEX_PERIOD'])
+    changes = Table(
+        'graph_changes', MetaData(),
+        Column('work_id', Integer, primary_key=True),
+        Column('modified', DateTime),
+        Index('graph_changes_key', 'modified', 'work_id'),
+        prefixes=['TEMPORARY']
     )
-    
-    fetchPeriod = datetime.utcnow() - timedelta(seconds=int(os.environ['INDEX_PERIOD']))
-    for workID in session.query(Work.id)\
-        .yield_per(100)\
-        .filter(Work.date_modified >= fetchPeriod)\
-        .all():
-        yield workID
+    connection = session.connection()
+    changes.drop(bind=connection, checkfirst=True)
+    changes.create(bind=connection)
+    session.execute(changes.insert().from_select(
+        ['work_id', 'modified'], _graphChangesQuery(session, since).statement
+    ))
+    return changes
+
+
+def _addFormerParents(session, changes, since, formerParents, pageSize):
+    """Add the former parent works of the instances changed in the window to
+    the change set. The changed instances are read in pages, with the UUID of
+    their current work, and formerParents returns the UUIDs of any other works
+    whose documents hold them, each with the IDs of the instances it holds.
+    Each former parent is added at the time of the latest of these changes.
+    """
+    lastID = None
+    while True:
+        pageQuery = session.query(
+            Instance.id, Instance.date_modified, Work.uuid
+        ).select_from(Work).join(Work.instances)\
+            .filter(Instance.date_modified >= since)
+        if lastID is not None:
+            pageQuery = pageQuery.filter(Instance.id > lastID)
+
+        page = pageQuery.order_by(Instance.id).limit(pageSize).all()
+        if len(page) < 1:
+            break
+
+        modified = {instanceID: date for instanceID, date, _ in page}
+        parents = formerParents({
+            instanceID: str(uuid).lower() for instanceID, _, uuid in page
+        })
+        if len(parents) > 0:
+            parentIDs = dict(
+                (str(uuid).lower(), workID) for workID, uuid in
+                session.query(Work.id, Work.uuid)
+                    .filter(Work.uuid.in_(list(parents))).all()
+            )
+            _mergeChanges(session, changes, {
+                parentIDs[uuid]: max(modified[i] for i in instanceIDs)
+                for uuid, instanceIDs in parents.items() if uuid in parentIDs
+            })
+
+        if len(page) < pageSize:
+            break
+        lastID = page[-1][0]
+
+
+def _mergeChanges(session, changes, workChanges):
+    """Add a dict of work IDs and the time of their change to the change set,
+    keeping the later time for works that are already in it
+    """
+    if len(workChanges) < 1:
+        return
+
+    logger.debug('Adding {} former parent works to changes'.format(
+        len(workChanges)
+    ))
+    existing = dict(
+        session.query(changes.c.work_id, changes.c.modified)
+            .filter(changes.c.work_id.in_(list(workChanges))).all()
+    )
+    for workID, modified in workChanges.items():
+        if workID not in existing:
+            session.execute(changes.insert().values(
+                work_id=workID, modified=modified
+            ))
+        elif existing[workID] < modified:
+            session.execute(
+                changes.update()
+                    .where(changes.c.work_id == workID)
+                    .values(modified=modified)
+            )
+
+
+def _graphChangesQuery(session, since):
+    """Build the query for the (work_id, modified) pair of each work with a
+    change to its graph of records at or after since
+    """
+    global WORK_GRAPH_PATHS
+    if WORK_GRAPH_PATHS is None:
+        WORK_GRAPH_PATHS = _buildGraphPaths()
+
+    branches = [
+        session.query(
+            Work.id.label('work_id'), Work.date_modified.label('modified')
+        ).filter(Work.date_modified >= since)
+    ]
+    for path in WORK_GRAPH_PATHS:
+        modified = relatedModel(path[-1]).date_modified
+        branch = session.query(Work.id, modified)
+        for relationship in path:
+            branch = branch.join(relationship)
+        branches.append(branch.filter(modified >= since))
+
+    rows = branches[0].union_all(*branches[1:]).subquery()
+    return session.query(
+        rows.c.work_id.label('work_id'),
+        func.max(rows.c.modified).label('modified')
+    ).group_by(rows.c.work_id)
+
+
+def streamWorkUUIDs(session, pageSize=None, after=None):
+    """Yield the UUID of every work in ascending order, or of those after the
+    UUID after, as lowercase strings so that they sort in the same order as
+    ElasticSearch document IDs. The works table is paged through with keyset
+    pagination on the UUID, so memory use is bounded by the page size.
+    """
+    if pageSize is None:
+        pageSize = int(os.environ.get('INDEX_BATCH_SIZE', 100))
+
+    lastUUID = after
+    while True:
+        pageQuery = session.query(Work.uuid)
+        if lastUUID is not None:
+            pageQuery = pageQuery.filter(Work.uuid > lastUUID)
+
+        page = pageQuery.order_by(Work.uuid).limit(pageSize).all()
+        for row in page:
+            yield str(row[0]).lower()
+
+        if len(page) < pageSize:
+            break
+        lastUUID = page[-1][0]
+
+
+def retrieveExistingUUIDs(session, uuids):
+    """Return the subset of a batch of work UUIDs that exist in the database"""
+    return set(
+        str(row[0]).lower() for row in
+        session.query(Work.uuid).filter(Work.uuid.in_(list(uuids))).all()
+    )
+
+
+def retrieveVersions(session, workIDs):
+    """Return the latest date_modified across the graph of records that the
+    document of each work is built from, keyed by work ID. A change to any
+    of these records produces a newer document, so this orders the versions
+    of a work's document. The latest date along each relationship path is
+    found with a grouped query, all combined into a single UNION ALL query.
+    """
+    global WORK_GRAPH_PATHS
+    if WORK_GRAPH_PATHS is None:
+        WORK_GRAPH_PATHS = _buildGraphPaths()
+
+    branches = [
+        session.query(Work.id, Work.date_modified).filter(Work.id.in_(workIDs))
+    ]
+    for path in WORK_GRAPH_PATHS:
+        branch = session.query(
+            Work.id, func.max(relatedModel(path[-1]).date_modified)
+        )
+        for relationship in path:
+            branch = branch.join(relationship)
+        branches.append(
+            branch.filter(Work.id.in_(workIDs)).group_by(Work.id)
+        )
+
+    versions = {}
+    for workID, modified in branches[0].union_all(*branches[1:]).all():
+        if modified is None:
+            continue
+        if workID not in versions or modified > versions[workID]:
+            versions[workID] = modified
+
+    return versions
+
+
+def _buildGraphPaths():
+    """Build the relationship paths from a work to the records that make up
+    its document, whose changes are changes to the document. These follow
+    the relationships loaded by _buildLoadOptions, including the records
+    embedded in agents, rights and identifiers.
+    """
+    AgentWork = relatedModel(Work.agent_works)
+    AgentInstance = relatedModel(Instance.agent_instances)
+    Agent = relatedModel(AgentWork.agent)
+    Identifier = relatedModel(Work.identifiers)
+    Rights = relatedModel(Instance.rights)
+
+    def agentPaths(agentPath):
+        return [
+            agentPath,
+            agentPath + [Agent.aliases],
+            agentPath + [Agent.dates]
+        ]
+
+    def identifierPaths(identifierPath):
+        return [identifierPath] + [
+            identifierPath + [getattr(Identifier, rel.key)]
+            for rel in inspect(Identifier).relationships
+            if rel.direction is ONETOMANY and rel.secondary is None
+        ]
+
+    return [
+        [Work.dates],
+        [Work.alt_titles],
+        [Work.subjects],
+        [Work.measurements],
+        [Work.links],
+        [Work.language],
+        *identifierPaths([Work.identifiers]),
+        *agentPaths([Work.agent_works, AgentWork.agent]),
+        [Work.instances],
+        [Work.instances, Instance.dates],
+        [Work.instances, Instance.language],
+        [Work.instances, Instance.links],
+        [Work.instances, Instance.rights],
+        [Work.instances, Instance.rights, Rights.dates],
+        *agentPaths(
+            [Work.instances, Instance.agent_instances, AgentInstance.agent]
+        ),
+        [Work.instances, Instance.items],
+        [Work.instances, Instance.items, Item.links],
+        *identifierPaths([Work.instances, Instance.items, Item.identifiers])
+    ]
+
+
+def loadWorks(session, workIDs):
+    """Load the full graph of related records for a batch of works. Rather
+    than fetching each work and lazy-loading each relationship as it is
+    accessed this issues a fixed number of SELECT ... IN queries per batch,
+    one for each relationship that is included in the ElasticSearch document.
+    """
+    global WORK_LOAD_OPTIONS
+    if WORK_LOAD_OPTIONS is None:
+        WORK_LOAD_OPTIONS = _buildLoadOptions()
+
+    return session.query(Work)\
+        .options(*WORK_LOAD_OPTIONS)\
+        .filter(Work.id.in_(workIDs))\
+        .all()
+
+
+def _buildLoadOptions():
+    """Build the eager loading options for the work graph. Related models are
+    resolved from the relationships themselves so that only the relationship
+    names used to build ElasticSearch documents are relied upon.
+    """
+    AgentWork = relatedModel(Work.agent_works)
+    AgentInstance = relatedModel(Instance.agent_instances)
+    Agent = relatedModel(AgentWork.agent)
+    Identifier = relatedModel(Work.identifiers)
+    Rights = relatedModel(Instance.rights)
+
+    def agentOptions(agentPath):
+        return [
+            agentPath.selectinload(Agent.aliases),
+            agentPath.selectinload(Agent.dates)
+        ]
+
+    def identifierOptions(identifierPath):
+        # Identifier values are stored in a table per identifier type, each of
+        # which is a one-to-many relationship of the identifier
+        return [
+            identifierPath.selectinload(getattr(Identifier, rel.key))
+            for rel in inspect(Identifier).relationships
+            if rel.direction is ONETOMANY and rel.secondary is None
+        ]
+
+    instancePath = selectinload(Work.instances)
+    itemPath = instancePath.selectinload(Instance.items)
+
+    return [
+        selectinload(Work.dates),
+        selectinload(Work.alt_titles),
+        selectinload(Work.subjects),
+        selectinload(Work.measurements),
+        selectinload(Work.links),
+        selectinload(Work.language),
+        *agentOptions(
+            selectinload(Work.agent_works).joinedload(AgentWork.agent)
+        ),
+        *identifierOptions(selectinload(Work.identifiers)),
+        instancePath.selectinload(Instance.dates),
+        instancePath.selectinload(Instance.language),
+        instancePath.selectinload(Instance.links),
+        instancePath.selectinload(Instance.rights)
+            .selectinload(Rights.dates),
+        *agentOptions(
+            instancePath.selectinload(Instance.agent_instances)
+                .joinedload(AgentInstance.agent)
+        ),
+        itemPath.selectinload(Item.links),
+        *identifierOptions(itemPath.selectinload(Item.identifiers))
+    ]
+
+
+def relatedModel(relationship):
+    return relationship.property.mapper.class_
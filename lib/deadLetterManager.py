@@ -0,0 +1,146 @@
+import gzip
+import json
+import os
+import tempfile
+import uuid
+from datetime import datetime
+
+from botocore.exceptions import ClientError
+
+from helpers.clientHelpers import createAWSClient
+from helpers.logHelpers import createLog
+
+logger = createLog('dead_letter_manager')
+
+
+def createDeadLetterSpool(index):
+    """Create the spool for works that could not be indexed. These are kept
+    in a gzipped NDJSON file at DEAD_LETTER_PATH (by default in the temp
+    directory). If DEAD_LETTER_BUCKET is set they are instead stored in S3,
+    under DEAD_LETTER_PREFIX, so that they persist between Lambda containers.
+    """
+    path = os.environ.get('DEAD_LETTER_PATH', os.path.join(
+        tempfile.gettempdir(), '{}_dead_letters.ndjson.gz'.format(index)
+    ))
+
+    bucket = os.environ.get('DEAD_LETTER_BUCKET', None)
+    if bucket:
+        prefix = os.environ.get(
+            'DEAD_LETTER_PREFIX', '{}/dead_letters/'.format(index)
+        )
+        return S3DeadLetterSpool(path, bucket, prefix)
+
+    return DeadLetterSpool(path)
+
+
+class DeadLetterSpool():
+    """Records the works whose documents permanently failed to index, with
+    the error returned for each, so that they can be replayed in a later run.
+    Letters are buffered in memory and appended to the spool file as a new
+    gzip member on flush, so the file is never rewritten.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.letters = []
+
+    def add(self, docID, error):
+        self.letters.append({
+            'id': docID,
+            'error': error,
+            'failed_at': datetime.utcnow().isoformat()
+        })
+
+    def extend(self, letters):
+        self.letters.extend(letters)
+
+    def flush(self):
+        if len(self.letters) < 1:
+            return
+
+        with gzip.open(self.path, 'at', encoding='utf-8') as spoolFile:
+            for letter in self.letters:
+                spoolFile.write(json.dumps(letter, default=str) + '\n')
+
+        logger.warning('Wrote {} dead letters to {}'.format(
+            len(self.letters), self.path
+        ))
+        self.letters = []
+
+    def read(self):
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as spoolFile:
+                return [json.loads(line) for line in spoolFile if line.strip()]
+        except FileNotFoundError:
+            return []
+
+    def clear(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class S3DeadLetterSpool(DeadLetterSpool):
+    """Keeps the spool in S3 as a gzipped NDJSON object per flush under a
+    prefix, so that concurrent invocations never overwrite each other's
+    letters. The objects are staged at the local path. Reading the spool
+    records the keys that were read, and clearing it deletes only those, so
+    letters flushed by another invocation in between are kept.
+    """
+    def __init__(self, path, bucket, prefix):
+        super(S3DeadLetterSpool, self).__init__(path)
+        self.bucket = bucket
+        self.prefix = prefix
+        self.readKeys = []
+        self.client = createAWSClient('s3', {
+            'region': os.environ.get('AWS_REGION', 'us-east-1')
+        })
+
+    def flush(self):
+        if len(self.letters) < 1:
+            return
+
+        # Keys start with the time of the flush so that they list in order
+        key = '{}{}-{}.ndjson.gz'.format(
+            self.prefix, datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+            uuid.uuid4().hex
+        )
+        super(S3DeadLetterSpool, self).clear()
+        super(S3DeadLetterSpool, self).flush()
+        try:
+            self.client.upload_file(self.path, self.bucket, key)
+        finally:
+            super(S3DeadLetterSpool, self).clear()
+
+    def read(self):
+        letters = []
+        self.readKeys = []
+        for key in self._listKeys():
+            try:
+                self.client.download_file(self.bucket, key, self.path)
+            except ClientError as err:
+                # The object was deleted by another replay since it was listed
+                if err.response['Error']['Code'] not in ('404', 'NoSuchKey'):
+                    raise
+                continue
+            letters.extend(super(S3DeadLetterSpool, self).read())
+            self.readKeys.append(key)
+        super(S3DeadLetterSpool, self).clear()
+        return letters
+
+    def clear(self):
+        # Objects are deleted in the batches of 1000 keys that S3 allows
+        for start in range(0, len(self.readKeys), 1000):
+            self.client.delete_objects(Bucket=self.bucket, Delete={
+                'Objects': [
+                    {'Key': key} for key in self.readKeys[start:start + 1000]
+                ]
+            })
+        self.readKeys = []
+        super(S3DeadLetterSpool, self).clear()
+
+    def _listKeys(self):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix):
+            for obj in page.get('Contents', []):
+                yield obj['Key']
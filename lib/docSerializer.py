@@ -0,0 +1,301 @@
+import hashlib
+import json
+from operator import attrgetter
+
+from elasticsearch_dsl import DateRange
+from sqlalchemy import inspect
+
+from sfrCore import Work as DBWork, Instance as DBInstance, Item as DBItem
+
+from model.elasticDocs import (
+    Language,
+    Work,
+    Subject,
+    Agent,
+    Measurement,
+    Instance,
+    Link,
+    Item,
+    Rights
+)
+
+from lib.dbManager import relatedModel
+
+# Values dropped from documents, matching the skip_empty behavior of the
+# elasticsearch_dsl to_dict() method
+EMPTY_VALUES = ([], {}, None)
+
+# Bookkeeping fields that change without the content of a work changing,
+# which are left out of its content hash
+HASH_EXCLUDED_FIELDS = ('date_modified', 'date_updated', 'content_hash')
+
+
+class ModelSerializer():
+    """Field access for a single ElasticSearch model, compiled from the
+    model's getFields() list and its mapping. Fields are read with a single
+    precompiled attrgetter, restricted to the columns of the database model
+    (names that are not columns always resolve to None in the ESDoc builders).
+    """
+    def __init__(self, esModel, dbModel):
+        columnNames = inspect(dbModel).column_attrs.keys()
+        self.fields = []
+        for field in esModel.getFields():
+            if field in columnNames and field not in self.fields:
+                self.fields.append(field)
+
+        self.getter = attrgetter(*self.fields) if self.fields else None
+        if len(self.fields) == 1:
+            singleGetter = self.getter
+            self.getter = lambda record: (singleGetter(record),)
+
+        mapping = esModel._doc_type.mapping
+        self.dateFields = [
+            name for name in mapping if isinstance(mapping[name], DateRange)
+        ]
+
+    def extract(self, record):
+        if self.getter is None:
+            return {}
+
+        return {
+            field: value
+            for field, value in zip(self.fields, self.getter(record))
+            if value not in EMPTY_VALUES
+        }
+
+    def insertDates(self, record, doc):
+        """Equivalent of ESDoc._loadDates/_insertDate, setting a range and
+        display value for each date of a type mapped as a DateRange.
+        """
+        dates = {}
+        for date in record.dates:
+            if date.date_type in self.dateFields:
+                dates[date.date_type] = date
+
+        for dateType, date in dates.items():
+            if date.date_range is None:
+                continue
+            doc[dateType] = {
+                'gte': date.date_range.lower,
+                'lte': date.date_range.upper
+            }
+            if date.display_date not in EMPTY_VALUES:
+                doc[dateType + '_display'] = date.display_date
+
+
+WORK_FIELDS = ModelSerializer(Work, DBWork)
+INSTANCE_FIELDS = ModelSerializer(Instance, DBInstance)
+ITEM_FIELDS = ModelSerializer(Item, DBItem)
+AGENT_FIELDS = ModelSerializer(
+    Agent, relatedModel(relatedModel(DBWork.agent_works).agent)
+)
+LINK_FIELDS = ModelSerializer(Link, relatedModel(DBWork.links))
+LANGUAGE_FIELDS = ModelSerializer(Language, relatedModel(DBWork.language))
+MEASUREMENT_FIELDS = ModelSerializer(
+    Measurement, relatedModel(DBWork.measurements)
+)
+RIGHTS_FIELDS = ModelSerializer(Rights, relatedModel(DBInstance.rights))
+SUBJECT_FIELDS = ModelSerializer(Subject, relatedModel(DBWork.subjects))
+
+WORK_INDEX = Work._index._name
+WORK_DOC_TYPE = Work._doc_type.name
+
+
+def serializeWork(dbRec, cache=None):
+    """Build the bulk action for a work directly as a plain dict. This
+    produces the same output as ESDoc.indexWork() followed by
+    work.to_dict(True) without constructing and then converting a tree of
+    elasticsearch_dsl objects. Shared sub-documents are served from the
+    DocCache of the run, if one is provided.
+    """
+    source = WORK_FIELDS.extract(dbRec)
+    WORK_FIELDS.insertDates(dbRec, source)
+
+    _setList(source, 'alt_titles', [
+        altTitle.title for altTitle in dbRec.alt_titles
+    ])
+    _setList(source, 'subjects', [
+        SUBJECT_FIELDS.extract(subject) for subject in dbRec.subjects
+    ])
+    _setList(source, 'agents', mergeAgents(dbRec.agent_works, cache=cache))
+    _setList(source, 'identifiers', [
+        _stripEmpty(serializeIdentifier(identifier))
+        for identifier in dbRec.identifiers
+    ])
+    _setList(source, 'measurements', [
+        MEASUREMENT_FIELDS.extract(measure)
+        for measure in dbRec.measurements
+    ])
+    _setList(source, 'links', [serializeLink(link) for link in dbRec.links])
+    _setList(source, 'language', [
+        serializeLanguage(lang, cache=cache) for lang in dbRec.language
+    ])
+    _setList(source, 'instances', [
+        serializeInstance(instance, cache=cache)
+        for instance in dbRec.instances
+    ])
+
+    return {
+        '_id': dbRec.uuid,
+        '_index': WORK_INDEX,
+        '_type': WORK_DOC_TYPE,
+        '_source': source
+    }
+
+
+def serializeIdentifier(identifier):
+    idType = identifier.type
+    if idType is None:
+        idType = 'generic'
+    return {
+        'id_type': idType,
+        'identifier': getattr(identifier, idType)[0].value
+    }
+
+
+def serializeLink(link):
+    linkDoc = LINK_FIELDS.extract(link)
+    linkDoc['unique_id'] = link.id
+
+    linkFlags = getattr(link, 'flags', {})
+    if isinstance(linkFlags, str): linkFlags = json.loads(linkFlags)
+    linkDoc.update(linkFlags)
+
+    return _stripEmpty(linkDoc)
+
+
+def serializeCover(cover):
+    try:
+        coverFlags = json.loads(cover.flags)
+    except TypeError:
+        coverFlags = cover.flags
+    if coverFlags.get('cover', False) is True:
+        return _stripEmpty({'url': cover.url, 'media_type': cover.media_type})
+    return None
+
+
+def serializeLanguage(language, cache=None):
+    if cache is not None:
+        return cache.fetch('language', language, serializeLanguage, dict)
+    return LANGUAGE_FIELDS.extract(language)
+
+
+def serializeRights(rights, cache=None):
+    if cache is not None:
+        return cache.fetch('rights', rights, serializeRights, dict)
+
+    rightsDoc = RIGHTS_FIELDS.extract(rights)
+    RIGHTS_FIELDS.insertDates(rights, rightsDoc)
+    return rightsDoc
+
+
+def mergeAgents(agentRels, cache=None):
+    """Equivalent of ESDoc.mergeAgents, building one agent per distinct
+    agent name and accumulating the roles of each relationship.
+    """
+    agents = {}
+    for agentRel in agentRels:
+        agentDoc = agents.get(agentRel.agent.name, None)
+        if agentDoc is None:
+            agents[agentRel.agent.name] = serializeAgent(agentRel, cache=cache)
+        elif agentRel.role not in agentDoc['roles']:
+            agentDoc['roles'].append(agentRel.role)
+
+    return list(agents.values())
+
+
+def serializeAgent(agentRel, cache=None):
+    if cache is not None:
+        agentDoc = cache.fetch('agent', agentRel.agent, buildAgent, dict)
+    else:
+        agentDoc = buildAgent(agentRel.agent)
+    _setList(agentDoc, 'roles', [agentRel.role])
+    return agentDoc
+
+
+def buildAgent(agent):
+    agentDoc = AGENT_FIELDS.extract(agent)
+    _setList(agentDoc, 'aliases', [alias.alias for alias in agent.aliases])
+    AGENT_FIELDS.insertDates(agent, agentDoc)
+    return agentDoc
+
+
+def serializeInstance(instance, cache=None):
+    instanceDoc = INSTANCE_FIELDS.extract(instance)
+    instanceDoc['instance_id'] = instance.id
+    INSTANCE_FIELDS.insertDates(instance, instanceDoc)
+
+    pubDate = instanceDoc.get('pub_date', None)
+    if pubDate:
+        if pubDate['gte']:
+            instanceDoc['pub_date_sort'] = pubDate['gte']
+        if pubDate['lte']:
+            instanceDoc['pub_date_sort_desc'] = pubDate['lte']
+
+    _setList(instanceDoc, 'agents', mergeAgents(
+        instance.agent_instances, cache=cache
+    ))
+    _setList(instanceDoc, 'items', [
+        serializeItem(item) for item in instance.items if len(item.links) > 0
+    ])
+    _setList(instanceDoc, 'rights', [
+        serializeRights(rights, cache=cache) for rights in instance.rights
+    ])
+    _setList(instanceDoc, 'language', [
+        serializeLanguage(lang, cache=cache) for lang in instance.language
+    ])
+    _setList(instanceDoc, 'covers', list(filter(None, [
+        serializeCover(cover) for cover in instance.links
+    ])))
+
+    return instanceDoc
+
+
+def serializeItem(item):
+    itemDoc = ITEM_FIELDS.extract(item)
+
+    identifiers = [
+        serializeIdentifier(identifier) for identifier in item.identifiers
+    ]
+    links = [serializeLink(link) for link in item.links]
+
+    # Equivalent of Link.setLabel, using the unstripped identifier value
+    for link in links:
+        labelAddts = [getattr(item, 'source', None)]
+        if identifiers[0]['identifier']:
+            labelAddts.append(identifiers[0]['identifier'])
+        if link.get('ebook', None): labelAddts.append('eBook')
+        if link.get('images', None): labelAddts.append('images')
+        link['label'] = ' - '.join(labelAddts)
+
+    _setList(itemDoc, 'identifiers', [
+        _stripEmpty(identifier) for identifier in identifiers
+    ])
+    _setList(itemDoc, 'links', links)
+
+    return itemDoc
+
+
+def hashDocument(source):
+    """Return a stable digest of the content of a document. Keys are sorted
+    so that the digest does not depend on the order fields were set in.
+    """
+    content = {
+        field: value for field, value in source.items()
+        if field not in HASH_EXCLUDED_FIELDS
+    }
+    return hashlib.sha1(json.dumps(
+        content, sort_keys=True, separators=(',', ':'), default=str
+    ).encode('utf-8')).hexdigest()
+
+
+def _setList(doc, field, values):
+    if len(values) > 0:
+        doc[field] = values
+
+
+def _stripEmpty(doc):
+    return {
+        key: value for key, value in doc.items()
+        if value not in EMPTY_VALUES
+    }
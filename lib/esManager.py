@@ -1,7 +1,8 @@
+import asyncio
+import calendar
 import os
 import time
 import json
-from elasticsearch.helpers import bulk, BulkIndexError, streaming_bulk
 from elasticsearch import Elasticsearch
 from elasticsearch.exceptions import (
     ConnectionError,
@@ -30,7 +31,27 @@ from model.elasticDocs import (
     Rights
 )
 
-from lib.dbManager import retrieveRecords
+from lib.dbManager import (
+    retrieveRecords,
+    retrieveWorkIDs,
+    retrieveWorkRange,
+    retrieveVersions,
+    streamWorkUUIDs,
+    retrieveExistingUUIDs,
+    loadWorks
+)
+from lib.projectionManager import projectWorks
+from lib.docSerializer import serializeWork, hashDocument
+from lib.checkpointManager import createCheckpointStore, CheckpointTracker
+from lib.cacheManager import createDocCache
+from lib.workerManager import createTransformPool
+from lib.memoryManager import createMemoryGuard
+from lib.bulkManager import createBulkSink
+from lib.deadLetterManager import createDeadLetterSpool
+from lib.pipelineManager import AsyncPipeline
+from lib.esSerializer import createSerializer
+from lib.targetManager import createIndexTargets, IndexTarget
+from lib.reconcileManager import streamIndexIDs, mergeIDs, findFormerParents
 
 from helpers.logHelpers import createLog
 from helpers.errorHelpers import ESError
@@ -38,26 +59,51 @@ from helpers.errorHelpers import ESError
 logger = createLog('es_manager')
 
 class ESConnection():
-    def __init__(self):
+    def __init__(self, targets=None):
         self.index = os.environ['ES_INDEX']
+        # The indexes documents are written to, by default the live index and
+        # any set in INDEX_TARGETS, e.g. during a mapping migration
+        self.targets = targets
         self.client = None
         self.tries = 0
         self.batch = []
+        self.errors = []
+        self.cache = None
+        self.unchanged = 0
+        self.stale = 0
+        self.mark = None
+        self.deadline = None
+        self.stopped = False
+        self.indexExists = False
 
         self.createElasticConnection()
         self.createIndex()
 
+        if self.targets is None:
+            self.targets = createIndexTargets(self.index)
+        self.checkpoint = createCheckpointStore(self.client, self.index)
+        self.deadLetters = createDeadLetterSpool(self.index)
+
         configure_mappers()
 
     def createElasticConnection(self):
         host = os.environ['ES_HOST']
         port = os.environ['ES_PORT']
         timeout = int(os.environ['ES_TIMEOUT'])
+        # Request bodies, including bulk requests, can be gzipped to reduce
+        # the size of our large and repetitive documents on the wire
+        compress = os.environ.get('ES_COMPRESS', 'false').lower() == 'true'
+        # Keep a pooled keep-alive connection for every concurrent bulk
+        # request, so that none are opened and discarded during a run
+        poolSize = max(int(os.environ.get('BULK_MAX_CONCURRENCY', 8)), 10)
         logger.info('Creating connection to ElasticSearch')
         try:
             self.client = Elasticsearch(
                 hosts=[{'host': host, 'port': port}],
-                timeout=timeout
+                timeout=timeout,
+                serializer=createSerializer(),
+                http_compress=compress,
+                maxsize=poolSize
             )
         except ConnectionError:
             raise ESError('Failed to connect to ElasticSearch instance')
@@ -73,46 +119,632 @@ class ESConnection():
             logger.info('ElasticSearch index {} already exists'.format(
                 self.index
             ))
+        self.indexExists = True
+
+    def healthCheck(self):
+        """Check that the cluster can still be reached, after a run failed
+        with a transport error. The cached index check is cleared so that it
+        is repeated before the connection is used again.
+        """
+        self.indexExists = False
+        if self.client.ping() is False:
+            logger.warning('ElasticSearch cluster is unreachable')
+            return False
+        return True
     
-    def generateRecords(self, session):
-        """Process the current batch of updating records. This utilizes the
-        elasticsearch-py bulk helper to import records in chunks of the
-        provided size. If a record in the batch errors that is reported and
-        logged but it does not prevent the other records in the batch from
-        being imported.
+    def generateRecords(self, session, identifiers=None, rebuildIndex=None,
+                        workRange=None, deadline=None):
+        """Process the current batch of updating records. Records are written
+        with a BulkSink, in chunks limited by count and size with several
+        chunks in flight at once. If a record in the batch errors that is
+        reported and logged but it does not prevent the other records in the
+        batch from being imported. Records that fail are added to the dead
+        letter spool, to be retried with replayDeadLetters.
+
+        If a dict of identifiers (keyed by record type) is provided only the
+        works those identifiers belong to are indexed, otherwise all works
+        updated since the last checkpoint are. If the name of a rebuildIndex
+        is provided every work is written to that index instead, and if a
+        workRange of (afterID, lastID) is provided only the works with IDs in
+        that range are indexed.
+
+        If a deadline (a time.monotonic() value) is provided a scan of updated
+        works stops retrieving batches once it has passed. The batches already
+        built are still written and the checkpoint saved, so the next run
+        resumes from the first work that was not indexed. self.stopped is set
+        if the run was stopped early.
+
+        With INDEX_PIPELINE set to "async" the run is made with
+        generateRecordsAsync instead.
+        """
+        if os.environ.get('INDEX_PIPELINE', 'sync').lower() == 'async':
+            return asyncio.run(
+                self.generateRecordsAsync(
+                    session, identifiers, rebuildIndex, workRange, deadline
+                )
+            )
+
+        tracker = self._startRun(rebuildIndex, deadline)
+        try:
+            bulkSink = createBulkSink(self.client)
+            actions = self.process(
+                session, tracker, identifiers, rebuildIndex, workRange
+            )
+            for status, work in bulkSink.write(actions, raiseOnError=False):
+                self._recordResult(tracker, status, work)
+            self._resolveConflicts(session)
+            self._logRun()
+        finally:
+            self._finishRun(tracker)
+
+    async def generateRecordsAsync(self, session, identifiers=None,
+                                   rebuildIndex=None, workRange=None,
+                                   deadline=None):
+        """Equivalent of generateRecords that runs the database and bulk
+        stages of the run concurrently in an AsyncPipeline, so that the next
+        batch of works is loaded and built while earlier bulk requests are
+        still in flight.
+        """
+        tracker = self._startRun(rebuildIndex, deadline)
+        try:
+            pipeline = AsyncPipeline(self.client, createBulkSink(self.client))
+            batches = self.processBatches(
+                session, tracker, identifiers, rebuildIndex, workRange
+            )
+            async for status, work in pipeline.run(batches):
+                self._recordResult(tracker, status, work)
+            self._resolveConflicts(session)
+            self._logRun()
+        finally:
+            self._finishRun(tracker)
+
+    def _startRun(self, rebuildIndex=None, deadline=None):
+        self.success, self.failure = 0, 0
+        self.errors = []
+        self.conflicts = []
+        self.unchanged = 0
+        self.stale = 0
+        self.mark = None
+        self.deadline = deadline
+        self.stopped = False
+        # Sub-documents are only cached for the length of a single run
+        self.cache = createDocCache()
+        # A rebuild only moves the checkpoint once its index is live
+        return CheckpointTracker(
+            self.checkpoint if rebuildIndex is None else None,
+            lag=int(os.environ.get('CHECKPOINT_LAG', 300))
+        )
+
+    def _recordResult(self, tracker, status, work):
+        docID = ESConnection._getResultID(work)
+        if not status and ESConnection._getResultStatus(work) == 409:
+            # The stored document has a version at least as new as this one,
+            # which is checked once the writes of the run are complete
+            self.conflicts.append(work)
+        elif not status:
+            self._recordFailure(work)
+        else:
+            self.success += 1
+        # Failed records are retried from the dead letter spool, so they do
+        # not hold back the checkpoint
+        tracker.complete(docID)
+
+    def _recordFailure(self, work):
+        self.errors.append(work)
+        self.failure += 1
+        self.deadLetters.add(ESConnection._getResultID(work), work)
+
+    def _resolveConflicts(self, session):
+        """Check the writes of the run that were rejected as version
+        conflicts. A conflict is stale if the stored document has a strictly
+        newer version, as it was built from a later state of the database.
+        Otherwise, e.g. if an association was removed without raising the
+        version of the work, the work is rebuilt from the database and
+        written again at its own version with external_gte if its content
+        differs from the stored document. Any that fail are added to the
+        dead letter spool.
+
+        Works read from an exported snapshot (DB_SNAPSHOT) may be older than
+        the stored documents, so in a backfill every conflict is stale.
+        """
+        if len(self.conflicts) < 1:
+            return
+
+        conflicts, self.conflicts = self.conflicts, []
+        if os.environ.get('DB_SNAPSHOT', None):
+            self.stale += len(conflicts)
+            return
+
+        conflictIDs = {}
+        for result in conflicts:
+            for opResult in result.values():
+                conflictIDs.setdefault(
+                    opResult.get('_index', self.index), []
+                ).append(opResult['_id'])
+        logger.info('Checking {} version conflicts'.format(len(conflicts)))
+
+        storedDocs = {}
+        for index, docIDs in conflictIDs.items():
+            try:
+                docs = self.client.mget(
+                    index=index,
+                    doc_type=Work._doc_type.name,
+                    body={'ids': docIDs},
+                    _source_include=['content_hash']
+                )['docs']
+            except TransportError as err:
+                # Without the stored versions every conflict is rewritten
+                logger.warning('Unable to retrieve stored versions')
+                logger.debug(err)
+                docs = []
+            for doc in docs:
+                if doc.get('found', False):
+                    storedDocs[(index, doc['_id'])] = (
+                        doc.get('_version', 0),
+                        doc.get('_source', {}).get('content_hash', None)
+                    )
+
+        uuids = set(
+            docID for docIDs in conflictIDs.values() for docID in docIDs
+        )
+        esActions, _ = ESConnection.transformWorks(
+            session, retrieveWorkIDs(session, {'work': uuids}), self.cache
+        )
+        rebuilt = {esAction['_id']: esAction for _, esAction in esActions}
+        targets = {target.name: target for target in self.targets}
+
+        rewrites = []
+        for index, docIDs in conflictIDs.items():
+            target = targets.get(index, None) or IndexTarget(index)
+            for docID in docIDs:
+                esAction = rebuilt.get(docID, None)
+                if esAction is None:
+                    # The work no longer exists, so its document is left to
+                    # be deleted by reconcile
+                    self.stale += 1
+                    continue
+
+                version = esAction.get('_version', 0)
+                storedVersion, storedHash = storedDocs.get(
+                    (index, docID), (0, None)
+                )
+                if storedVersion > version:
+                    self.stale += 1
+                    continue
+                if storedHash == esAction['_source']['content_hash']:
+                    self.unchanged += 1
+                    continue
+
+                rewrite = dict(target.action(esAction))
+                rewrite['_version'] = version
+                rewrite['_version_type'] = 'external_gte'
+                rewrites.append(rewrite)
+
+        bulkSink = createBulkSink(self.client)
+        for status, work in bulkSink.write(rewrites, raiseOnError=False):
+            if status:
+                self.success += 1
+            elif ESConnection._getResultStatus(work) == 409:
+                # A strictly newer version was written since it was checked,
+                # built from a later state of the database than this one
+                self.stale += 1
+            else:
+                self._recordFailure(work)
+
+    def _logRun(self):
+        logger.info(
+            'Success {} | Failure: {} | Unchanged: {} | Stale: {}'.format(
+                self.success, self.failure, self.unchanged, self.stale
+            )
+        )
+        if self.failure > 0:
+            logger.info('One or more records failed to import')
+            logger.debug(self.errors)
+
+    def _finishRun(self, tracker):
+        self.deadLetters.flush()
+        # Record how far this run got, even if it failed partway through
+        tracker.save()
+        self.mark = tracker.mark
+        if self.cache is not None:
+            self.cache.logStats()
+
+    def replayDeadLetters(self, session):
+        """Reindex the works recorded in the dead letter spool. The spool is
+        cleared first so that any works that fail again are spooled afresh.
+        If the replay run itself fails the letters are restored, other than
+        those of works it already spooled again.
+        """
+        letters = self.deadLetters.read()
+        if len(letters) < 1:
+            logger.info('No dead letters to replay')
+            return
+
+        logger.info('Replaying {} dead letters'.format(len(letters)))
+        self.deadLetters.clear()
+        try:
+            self.generateRecords(
+                session, {'work': set(letter['id'] for letter in letters)}
+            )
+        except Exception:
+            respooled = set(
+                ESConnection._getResultID(error) for error in self.errors
+            )
+            self.deadLetters.extend([
+                letter for letter in letters if letter['id'] not in respooled
+            ])
+            self.deadLetters.flush()
+            raise
+
+    def reconcile(self, session, after=None, progress=None):
+        """Bring the index in line with the database, deleting the documents
+        of works that no longer exist (e.g. after being deleted or merged) and
+        indexing works that have no document. Work UUIDs and document IDs are
+        both streamed in ascending order and merge joined, with differences
+        handled in batches of RECONCILE_BATCH_SIZE, so memory use does not
+        grow with the size of either.
+
+        If after is provided only the IDs after it are compared. Every
+        RECONCILE_BATCH_SIZE IDs the differences found so far are handled and
+        the last ID compared is passed to progress, so that an interrupted
+        reconciliation can be resumed from it.
+        """
+        batchSize = int(os.environ.get('RECONCILE_BATCH_SIZE', 1000))
+        bulkSink = createBulkSink(self.client)
+        missing, orphans = [], []
+        compared = 0
+        self.missing, self.orphaned = 0, 0
+
+        comparison = mergeIDs(
+            streamWorkUUIDs(session, pageSize=batchSize, after=after),
+            streamIndexIDs(
+                self.client, self.index, Work._doc_type.name,
+                pageSize=batchSize, after=after
+            )
+        )
+        for state, docID in comparison:
+            if state == 'missing':
+                missing.append(docID)
+            elif state == 'orphan':
+                orphans.append(docID)
+
+            compared += 1
+            if compared >= batchSize:
+                self._indexMissing(session, missing)
+                self._deleteOrphans(session, bulkSink, orphans)
+                missing, orphans, compared = [], [], 0
+                if progress is not None:
+                    progress(docID)
+
+        self._indexMissing(session, missing)
+        self._deleteOrphans(session, bulkSink, orphans)
+
+        logger.info('Reconciled {} | Missing: {} | Orphaned: {}'.format(
+            self.index, self.missing, self.orphaned
+        ))
+
+    def findFormerParents(self, parents):
+        """Return the documents in the index that hold instances which now
+        belong to other works, with findFormerParents
+        """
+        return findFormerParents(
+            self.client, self.index, Work._doc_type.name, parents
+        )
+
+    def _indexMissing(self, session, uuids):
+        if len(uuids) < 1:
+            return
+
+        self.missing += len(uuids)
+        self.generateRecords(session, {'work': set(uuids)})
+
+    def _deleteOrphans(self, session, bulkSink, uuids):
+        # A work created after the database stream passed its UUID may have
+        # been indexed before the index stream reached it, so each orphan is
+        # confirmed to be missing from the database before it is deleted
+        existing = retrieveExistingUUIDs(session, uuids) if uuids else set()
+        orphans = [uuid for uuid in uuids if uuid not in existing]
+        if len(orphans) < 1:
+            return
+
+        deletes = (
+            {
+                '_op_type': 'delete', '_index': target.name,
+                '_type': Work._doc_type.name, '_id': uuid
+            }
+            for uuid in orphans for target in self.targets
+        )
+        for status, result in bulkSink.write(deletes, raiseOnError=False):
+            # A document that is already gone does not need deleting
+            if status or ESConnection._getResultStatus(result) == 404:
+                continue
+            logger.warning('Unable to delete orphaned document {}'.format(
+                ESConnection._getResultID(result)
+            ))
+            logger.debug(result)
+
+        self.orphaned += len(orphans)
+
+    def process(self, session, tracker=None, identifiers=None,
+                rebuildIndex=None, workRange=None):
+        for esActions in self.processBatches(
+            session, tracker, identifiers, rebuildIndex, workRange
+        ):
+            for esAction in esActions:
+                yield esAction
+
+    def processBatches(self, session, tracker=None, identifiers=None,
+                       rebuildIndex=None, workRange=None):
+        """Yield the bulk actions for the works to be indexed in this run, as
+        a list for each batch of works retrieved. Each document is built
+        once and an action for it is yielded for every index target. When
+        building a new index every work is retrieved and written to only that
+        index, without comparing content hashes with the live index.
+        """
+        targets = self.targets
+        if rebuildIndex is not None:
+            targets = [IndexTarget(rebuildIndex)]
+
+        if identifiers is not None:
+            # Targeted updates are not part of the ordered scan and so do not
+            # advance the checkpoint
+            tracker = None
+            workBatches = ESConnection._batchWorks(
+                retrieveWorkIDs(session, identifiers)
+            )
+        elif workRange is not None:
+            # Ranges are scanned in ID order, which the checkpoint cannot
+            # follow, so their progress is tracked by the caller
+            tracker = None
+            workBatches = retrieveWorkRange(session, *workRange)
+        elif rebuildIndex is not None:
+            workBatches = retrieveRecords(session, fullScan=True)
+        else:
+            checkpoint = self.checkpoint.load() if self.checkpoint else None
+            workBatches = self._limitBatches(
+                retrieveRecords(
+                    session, checkpoint=checkpoint,
+                    formerParents=self.findFormerParents
+                )
+            )
+
+        # Batches are split up if memory use nears the ceiling of the run
+        memoryGuard = createMemoryGuard()
+        if memoryGuard is not None:
+            workBatches = memoryGuard.batches(workBatches)
+
+        workBatches = ESConnection._trackBatches(workBatches, tracker)
+
+        # Documents are built either here or, if INDEX_WORKERS is set, in a
+        # pool of worker processes while this process writes to ElasticSearch
+        transformPool = createTransformPool(
+            ESConnection.transformWorks, memoryGuard
+        )
+        if transformPool is None:
+            results = (
+                ESConnection.transformWorks(session, workIDs, self.cache)
+                for workIDs in workBatches
+            )
+        else:
+            results = transformPool.map(workBatches)
+
+        for esActions, missingIDs in results:
+            for workID in missingIDs:
+                # The work was removed after its ID was retrieved
+                logger.warning('Unable to load work {}'.format(workID))
+                if tracker is not None:
+                    tracker.skip(workID)
+
+            targetActions = [
+                (workID, target.action(esAction))
+                for workID, esAction in esActions for target in targets
+            ]
+            if rebuildIndex is None:
+                targetActions = self.filterUnchanged(targetActions, tracker)
+
+            changedActions = []
+            for workID, esAction in targetActions:
+                if tracker is not None:
+                    tracker.bind(esAction['_id'], workID)
+                changedActions.append(esAction)
+            yield changedActions
+
+    @staticmethod
+    def transformWorks(session, workIDs, cache=None):
+        """Load a batch of works and build the bulk action for each, with the
+        content_hash of the document set. Returns a list of (work ID, action)
+        pairs and a list of the IDs of any works that could not be loaded.
+
+        Unless INDEX_VERSION_TYPE is "internal" each action carries an
+        external version, the latest date_modified across the work's graph,
+        so that ElasticSearch drops a write older than the stored document.
+        By default this is an external_gte version, so that a document can be
+        rewritten at the same version, e.g. once an association is removed.
+        """
+        versionType = os.environ.get(
+            'INDEX_VERSION_TYPE', 'external_gte'
+        ).lower()
+        versions = None
+        if versionType != 'internal':
+            # Versions are read before the works are loaded, so a change made
+            # in between can only give a document an older version than its
+            # content, which the next run then supersedes
+            versions = retrieveVersions(session, [w[0] for w in workIDs])
+
+        dbWorks = {
+            dbWork.id: dbWork
+            for dbWork in ESConnection._loadWorks(
+                session, [w[0] for w in workIDs]
+            )
+        }
+
+        esActions, missingIDs = [], []
+        for workID in workIDs:
+            dbWork = dbWorks.get(workID[0], None)
+            if dbWork is None:
+                missingIDs.append(workID[0])
+                continue
+
+            esAction = ESConnection._buildDocument(
+                session, workID, dbWork, cache=cache
+            )
+            esAction['_source']['content_hash'] = hashDocument(
+                esAction['_source']
+            )
+            if versions is not None:
+                esAction['_version'] = ESConnection._externalVersion(
+                    versions.get(workID[0], None) or workID[1]
+                )
+                esAction['_version_type'] = versionType
+            esActions.append((workID[0], esAction))
+
+        # The loaded records are not needed once their documents are built,
+        # so they are released rather than kept in the session's identity
+        # map for the rest of the run
+        session.expunge_all()
+
+        return esActions, missingIDs
+
+    def filterUnchanged(self, esActions, tracker=None):
+        """Drop the actions in a page of (work ID, action) pairs whose
+        content_hash matches the one already stored in the index they are
+        written to, as reindexing them would not change anything. The stored
+        hashes for every target index are fetched in a single mget per page,
+        so a document is still written to a new target that lacks it. This
+        can be disabled with SKIP_UNCHANGED, e.g. to rewrite every document
+        after a mapping change.
         """
-        success, failure = 0, 0
-        errors = []
+        if os.environ.get('SKIP_UNCHANGED', 'true').lower() != 'true'\
+                or len(esActions) < 1:
+            return esActions
+
         try:
-            for status, work in streaming_bulk(self.client, self.process(session)):
-                if not status:
-                    errors.append(work)
-                    failure += 1
-                else:
-                    success += 1
-            
-            logger.info('Success {} | Failure: {}'.format(success, failure))
-        except BulkIndexError as err:
-            logger.info('One or more records in the chunk failed to import')
+            storedDocs = self.client.mget(
+                doc_type=Work._doc_type.name,
+                body={'docs': [
+                    {
+                        '_index': esAction.get('_index', self.index),
+                        '_id': esAction['_id']
+                    }
+                    for _, esAction in esActions
+                ]},
+                _source_include=['content_hash']
+            )['docs']
+        except TransportError as err:
+            # Without the stored hashes every document is treated as changed
+            logger.warning('Unable to retrieve stored content hashes')
             logger.debug(err)
-            raise ESError('Not all records processed smoothly, check logs')
+            return esActions
+
+        storedHashes = {
+            (doc.get('_index', self.index), doc['_id']):
+                doc['_source'].get('content_hash', None)
+            for doc in storedDocs if doc.get('found', False)
+        }
+
+        changed, skipped = [], []
+        for workID, esAction in esActions:
+            contentHash = esAction['_source'].get('content_hash', None)
+            storedHash = storedHashes.get(
+                (esAction.get('_index', self.index), esAction['_id']), None
+            )
+            if contentHash is not None and storedHash == contentHash:
+                self.unchanged += 1
+                skipped.append(workID)
+                continue
+            changed.append((workID, esAction))
+
+        # A work is only done once none of its documents are left to write
+        if tracker is not None:
+            changedIDs = set(workID for workID, _ in changed)
+            for workID in dict.fromkeys(skipped):
+                if workID not in changedIDs:
+                    tracker.skip(workID)
+
+        return changed
+
+    @staticmethod
+    def _loadWorks(session, workIDs):
+        """Load a batch of works with the engine set in LOAD_ENGINE, either
+        "orm" (the default) to load eagerly populated ORM objects or
+        "projection" to select only the columns used in the ES documents.
+        """
+        if os.environ.get('LOAD_ENGINE', 'orm').lower() == 'projection':
+            return projectWorks(session, workIDs)
+        return loadWorks(session, workIDs)
+
+    @staticmethod
+    def _buildDocument(session, workID, dbWork, cache=None):
+        """Build the bulk action for a work with the serializer set in
+        DOC_SERIALIZER, either "dsl" (the default) to build the document from
+        the elasticsearch_dsl models or "dict" to build it directly as a dict.
+        """
+        if os.environ.get('DOC_SERIALIZER', 'dsl').lower() == 'dict':
+            return serializeWork(dbWork, cache=cache)
 
+        esWork = ESDoc(workID, session, dbRec=dbWork, cache=cache)
+        esWork.indexWork()
+        return esWork.work.to_dict(True)
 
-    def process(self, session):
-        for workID in retrieveRecords(session):
-            esWork = ESDoc(workID, session)
-            esWork.indexWork()
-            yield esWork.work.to_dict(True)
+    def _limitBatches(self, workBatches):
+        """Stop retrieving batches of works once the deadline of the run has
+        passed, leaving the rest to be indexed by the next run
+        """
+        for workIDs in workBatches:
+            if self.deadline is not None and time.monotonic() >= self.deadline:
+                logger.warning('Time budget exhausted, stopping run early')
+                self.stopped = True
+                break
+            yield workIDs
+
+    @staticmethod
+    def _trackBatches(workBatches, tracker):
+        """Add the works in each batch to the checkpoint tracker in the order
+        they were retrieved, as the batch is handed on to be transformed.
+        """
+        for workIDs in workBatches:
+            if tracker is not None:
+                for workID in workIDs:
+                    tracker.add(workID[0], (workID[1], workID[0]))
+            yield workIDs
+
+    @staticmethod
+    def _batchWorks(workIDs):
+        batchSize = int(os.environ.get('INDEX_BATCH_SIZE', 100))
+        for i in range(0, len(workIDs), batchSize):
+            yield workIDs[i:i + batchSize]
+
+    @staticmethod
+    def _externalVersion(modified):
+        """Convert a date_modified timestamp to the integer external version
+        of a document, in microseconds since the epoch
+        """
+        return calendar.timegm(modified.utctimetuple()) * 1000000\
+            + modified.microsecond
+
+    @staticmethod
+    def _getResultID(result):
+        """Extract the document ID from a bulk response item, which is keyed
+        by the operation type, e.g. {'index': {'_id': ...}}"""
+        for opResult in result.values():
+            return opResult.get('_id', None)
+
+    @staticmethod
+    def _getResultStatus(result):
+        for opResult in result.values():
+            return opResult.get('status', None)
 
 class ESDoc():
-    def __init__(self, workID, session):
+    def __init__(self, workID, session, dbRec=None, cache=None):
         self.workID = workID[0]
         self.session = session
-        self.dbRec = None
+        self.dbRec = dbRec
+        self.cache = cache
         self.work = self.createWork()
     
     def createWork(self):
-        self.dbRec = self.session.query(DBWork).get(self.workID)
+        if self.dbRec is None:
+            self.dbRec = self.session.query(DBWork).get(self.workID)
         logger.debug('Creating ES record for {}'.format(self.dbRec))
 
         workData = {
@@ -143,10 +775,9 @@ class ESDoc():
             )
             for subject in self.dbRec.subjects
         ]
-        self.work.agents = [
-            ESDoc.addAgent(self.work, agentWork)
-            for agentWork in list(self.dbRec.agent_works)
-        ]
+        self.work.agents = ESDoc.mergeAgents(
+            self.dbRec.agent_works, cache=self.cache
+        )
 
         self.work.identifiers = [
             ESDoc.addIdentifier(identifier)
@@ -166,12 +797,12 @@ class ESDoc():
         self.work.links = [ESDoc.addLink(link) for link in self.dbRec.links]
 
         self.work.language = [
-            ESDoc.addLanguage(lang)
+            ESDoc.addLanguage(lang, cache=self.cache)
             for lang in self.dbRec.language
         ]
 
         self.work.instances = [
-            ESDoc.addInstance(instance)
+            ESDoc.addInstance(instance, cache=self.cache)
             for instance in self.dbRec.instances
         ]
         logger.debug('{} instances retrieved for {}'.format(len(self.dbRec.instances), self.work.uuid))
@@ -215,7 +846,12 @@ class ESDoc():
         return Measurement(**measureData)
 
     @staticmethod
-    def addLanguage(language):
+    def addLanguage(language, cache=None):
+        if cache is not None:
+            return cache.fetch(
+                'language', language, ESDoc.addLanguage, ESDoc._copyInner
+            )
+
         languageData = {
             field: getattr(language, field, None)
             for field in Language.getFields()
@@ -237,7 +873,12 @@ class ESDoc():
         return None
 
     @staticmethod
-    def addRights(rights):
+    def addRights(rights, cache=None):
+        if cache is not None:
+            return cache.fetch(
+                'rights', rights, ESDoc.addRights, ESDoc._copyInner
+            )
+
         rightsData = {
             field: getattr(rights, field, None) for field in Rights.getFields()
         }
@@ -250,40 +891,62 @@ class ESDoc():
         return newRights
     
     @staticmethod
-    def addAgent(record, agentRel):
-        match = list(filter(
-            lambda x: True 
-            if agentRel.agent.name == x.name else False, record.agents
-        ))
-        if len(match) > 0:
-            existing = match[0]
-            existing.roles.append(agentRel.role)
+    def mergeAgents(agentRels, cache=None):
+        """Build a single agent for each distinct agent name in a set of
+        agent relationships, accumulating the roles of each relationship.
+        Agents are indexed by name in a dict so this is done in one pass.
+        """
+        agents = {}
+        for agentRel in agentRels:
+            esAgent = agents.get(agentRel.agent.name, None)
+            if esAgent is None:
+                agents[agentRel.agent.name] = ESDoc.addAgent(
+                    agentRel, cache=cache
+                )
+            elif agentRel.role not in esAgent.roles:
+                esAgent.roles.append(agentRel.role)
+
+        return list(agents.values())
+
+    @staticmethod
+    def addAgent(agentRel, cache=None):
+        if cache is not None:
+            esAgent = cache.fetch(
+                'agent', agentRel.agent, ESDoc.buildAgent, ESDoc._copyInner
+            )
         else:
-            agent = agentRel.agent
-            agentData = {
-                field: getattr(agent, field, None) 
-                for field in Agent.getFields()
-            }
-            esAgent = Agent(**agentData)
+            esAgent = ESDoc.buildAgent(agentRel.agent)
+
+        esAgent.roles = [agentRel.role]
 
-            esAgent.aliases = []
-            for alias in agent.aliases:
-                esAgent.aliases.append(alias.alias)
+        return esAgent
 
-            for dateType, date in ESDoc._loadDates(agent, ['birth_date', 'death_date']).items():
-                ESDoc._insertDate(esAgent, date, dateType)
+    @staticmethod
+    def buildAgent(agent):
+        """Build an agent without the role it has in a relationship"""
+        agentData = {
+            field: getattr(agent, field, None) 
+            for field in Agent.getFields()
+        }
+        esAgent = Agent(**agentData)
+
+        esAgent.aliases = []
+        for alias in agent.aliases:
+            esAgent.aliases.append(alias.alias)
 
-            esAgent.roles = [agentRel.role]
+        agentDates = ESDoc._loadDates(agent, ['birth_date', 'death_date'])
+        for dateType, date in agentDates.items():
+            ESDoc._insertDate(esAgent, date, dateType)
 
-            return esAgent
+        return esAgent
     
     @staticmethod
-    def addInstance(instance):
+    def addInstance(instance, cache=None):
         instanceData = {
             field: getattr(instance, field, None)
             for field in Instance.getFields()
         }
-        esInstance = Instance(**instanceData)
+        esInstance = Instance(instance_id=instance.id, **instanceData)
 
         for dateType, date in ESDoc._loadDates(instance, ['pub_date']).items():
             ESDoc._insertDate(esInstance, date, dateType)
@@ -299,10 +962,9 @@ class ESDoc():
         #    for identifier in instance.identifiers
         #]
 
-        esInstance.agents = [
-            ESDoc.addAgent(esInstance, agentInst)
-            for agentInst in instance.agent_instances
-        ]
+        esInstance.agents = ESDoc.mergeAgents(
+            instance.agent_instances, cache=cache
+        )
 
         # NOTE: The two relationships are commented out as they are not
         # currently used in the front-end application. But this data may
@@ -324,12 +986,12 @@ class ESDoc():
         ]
 
         esInstance.rights = [
-            ESDoc.addRights(rights)
+            ESDoc.addRights(rights, cache=cache)
             for rights in instance.rights
         ]
 
         esInstance.language = [
-            ESDoc.addLanguage(lang)
+            ESDoc.addLanguage(lang, cache=cache)
             for lang in instance.language
         ]
 
@@ -352,10 +1014,7 @@ class ESDoc():
             for identifier in item.identifiers
         ]
         
-        #esItem.agents = [
-        #    ESDoc.addAgent(esItem, agentItem)
-        #    for agentItem in item.agent_items
-        #]
+        #esItem.agents = ESDoc.mergeAgents(item.agent_items)
         
         esItem.links = [
             ESDoc.addLink(link)
@@ -421,3 +1080,10 @@ class ESDoc():
         )
         setattr(record, dateType, dateRange)
         setattr(record, dateType + '_display', date['display'])
+
+    @staticmethod
+    def _copyInner(innerDoc):
+        """Shallow copy of a cached inner document. Nested values are shared
+        with the cached document and so must not be modified in place.
+        """
+        return innerDoc.__class__(**innerDoc._d_)
@@ -0,0 +1,68 @@
+import os
+
+from elasticsearch.serializer import JSONSerializer
+from elasticsearch.exceptions import SerializationError
+from elasticsearch_dsl.utils import AttrDict, AttrList
+
+from helpers.logHelpers import createLog
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = createLog('es_serializer')
+
+
+def createSerializer():
+    """Create the serializer used by the ElasticSearch client for request
+    bodies, set in ES_SERIALIZER. This is either "json" (the default) for the
+    client's stdlib serializer or "orjson", which falls back to the stdlib
+    serializer if orjson is not installed.
+    """
+    serializerType = os.environ.get('ES_SERIALIZER', 'json').lower()
+
+    if serializerType == 'orjson':
+        if orjson is not None:
+            return ORJSONSerializer()
+        logger.warning('orjson is not installed, using stdlib serializer')
+    elif serializerType != 'json':
+        logger.warning('Unknown ES_SERIALIZER {}, using stdlib json'.format(
+            serializerType
+        ))
+
+    return ESJSONSerializer()
+
+
+class ESJSONSerializer(JSONSerializer):
+    """Stdlib serializer that also encodes any elasticsearch_dsl wrappers,
+    such as the Range set on DateRange fields, left in a document.
+    """
+    def default(self, data):
+        if isinstance(data, (AttrDict, AttrList)):
+            return data._l_ if isinstance(data, AttrList) else data.to_dict()
+        return super(ESJSONSerializer, self).default(data)
+
+
+class ORJSONSerializer(ESJSONSerializer):
+    """Serializer using orjson, which encodes the dates and UUIDs in our
+    documents natively and is several times faster than the stdlib encoder
+    for large nested documents. The output is equivalent to JSONSerializer,
+    compact and with non-ASCII characters left unescaped.
+    """
+    def dumps(self, data):
+        if isinstance(data, str):
+            return data
+
+        try:
+            return orjson.dumps(
+                data, default=self.default, option=orjson.OPT_NON_STR_KEYS
+            ).decode('utf-8')
+        except TypeError as e:
+            raise SerializationError(data, e)
+
+    def loads(self, s):
+        try:
+            return orjson.loads(s)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(s, e)
@@ -0,0 +1,90 @@
+import gc
+import os
+
+from helpers.logHelpers import createLog
+
+logger = createLog('memory_manager')
+
+
+def createMemoryGuard():
+    """Create the guard that keeps the memory used by a run under a ceiling.
+    The ceiling is set in MB with MEMORY_CEILING, and otherwise defaults to
+    80% of the memory of the Lambda function. No guard is created if neither
+    is set or the resident memory of the process cannot be read.
+
+    Each process only reads its own memory, so with INDEX_WORKERS the
+    ceiling is split evenly between the indexing process and its workers,
+    each of which runs its own guard.
+    """
+    ceiling = os.environ.get('MEMORY_CEILING', None)
+    if ceiling is None:
+        lambdaMemory = os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE', None)
+        if lambdaMemory is None:
+            return None
+        ceiling = int(lambdaMemory) * 0.8
+
+    if float(ceiling) <= 0 or currentRSS() is None:
+        return None
+
+    workerCount = int(os.environ.get('INDEX_WORKERS', 1))
+    processes = workerCount + 1 if workerCount > 1 else 1
+    return MemoryGuard(
+        int(float(ceiling) * 1024 * 1024) // processes,
+        int(os.environ.get('INDEX_BATCH_SIZE', 100)),
+        int(os.environ.get('MEMORY_MIN_BATCH_SIZE', 10))
+    )
+
+
+def currentRSS():
+    """Return the resident memory of this process in bytes, or None where it
+    is not available. This is read from /proc, as in the Lambda runtime,
+    rather than from getrusage, which only reports the peak.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class MemoryGuard():
+    """Splits the batches of works retrieved for a run into smaller batches
+    if the resident memory of the process nears the ceiling. Memory is
+    checked before each batch is handed on to be loaded and built, and if
+    it is still over the ceiling after a garbage collection the batch size
+    is halved, down to minBatchSize, for the rest of the run.
+    """
+    def __init__(self, ceiling, batchSize, minBatchSize=10):
+        self.ceiling = ceiling
+        self.batchSize = batchSize
+        self.minBatchSize = min(minBatchSize, batchSize)
+
+    def batches(self, workBatches):
+        for workIDs in workBatches:
+            start = 0
+            while start < len(workIDs):
+                self.check()
+                yield workIDs[start:start + self.batchSize]
+                start += self.batchSize
+
+    def check(self):
+        rss = currentRSS()
+        if rss is None or rss < self.ceiling:
+            return
+
+        gc.collect()
+        rss = currentRSS()
+        if rss is None or rss < self.ceiling:
+            return
+
+        if self.batchSize > self.minBatchSize:
+            self.batchSize = max(self.minBatchSize, self.batchSize // 2)
+            message = 'Memory use {}MB over ceiling, reduced batch size to {}'
+            logger.warning(message.format(
+                rss // (1024 * 1024), self.batchSize
+            ))
+
+    def reduce(self, batchSize):
+        """Adopt a smaller batch size, e.g. one reported by a worker"""
+        if batchSize is not None and batchSize < self.batchSize:
+            self.batchSize = max(self.minBatchSize, batchSize)
@@ -0,0 +1,90 @@
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from helpers.logHelpers import createLog
+
+try:
+    from elasticsearch_async import AsyncElasticsearch
+except ImportError:
+    AsyncElasticsearch = None
+
+logger = createLog('pipeline_manager')
+
+
+class AsyncPipeline():
+    """Runs the database and ElasticSearch stages of an indexing run
+    concurrently, so that the next batch of works is fetched and transformed
+    while the bulk requests for the previous one are still in flight.
+
+    The stages are joined by a queue of at most PIPELINE_QUEUE_SIZE batches,
+    so that fetching stops while ElasticSearch is unable to keep up. Batches
+    are always pulled from a single thread, as the SQLAlchemy session cannot
+    be shared between threads. Bulk requests are made with elasticsearch_async
+    where it is installed and otherwise from a pool of threads.
+    """
+    def __init__(self, client, sink):
+        self.client = client
+        self.sink = sink
+        self.queueSize = int(os.environ.get('PIPELINE_QUEUE_SIZE', 2))
+        self.asyncClient = None
+
+    async def run(self, batches):
+        """Index the actions in each list yielded by the batches iterator,
+        yielding the result of each as it is returned.
+        """
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=self.queueSize)
+        dbExecutor = ThreadPoolExecutor(max_workers=1)
+        bulkExecutor = ThreadPoolExecutor(
+            max_workers=self.sink.controller.maxConcurrency
+        )
+        send = self.createSender(loop, bulkExecutor)
+
+        producer = asyncio.ensure_future(
+            AsyncPipeline.produce(loop, dbExecutor, batches, queue)
+        )
+        try:
+            async for result in self.sink.writeAsync(queue, send):
+                yield result
+            await producer
+        finally:
+            if not producer.done():
+                producer.cancel()
+            if self.asyncClient is not None:
+                await self.asyncClient.transport.close()
+                self.asyncClient = None
+            dbExecutor.shutdown()
+            bulkExecutor.shutdown()
+
+    def createSender(self, loop, executor):
+        if AsyncElasticsearch is not None:
+            logger.debug('Sending bulk requests with elasticsearch_async')
+            self.asyncClient = AsyncElasticsearch(
+                hosts=self.client.transport.hosts,
+                **self.client.transport.kwargs
+            )
+            return lambda chunk: self.sink.sendChunkAsync(
+                chunk, self.asyncClient
+            )
+
+        logger.debug('Sending bulk requests from executor threads')
+        return lambda chunk: loop.run_in_executor(
+            executor, self.sink.sendChunk, chunk
+        )
+
+    @staticmethod
+    async def produce(loop, executor, batches, queue):
+        """Move batches onto the queue, always ending with None so that the
+        bulk stage finishes even if fetching a batch fails.
+        """
+        try:
+            while True:
+                batch = await loop.run_in_executor(
+                    executor, next, batches, None
+                )
+                if batch is None:
+                    break
+                await queue.put(batch)
+        finally:
+            await queue.put(None)
@@ -0,0 +1,231 @@
+from collections import defaultdict
+from types import SimpleNamespace
+
+from sqlalchemy import inspect
+
+from sfrCore import Work, Instance, Item
+
+from model.elasticDocs import (
+    Work as ESWork,
+    Instance as ESInstance,
+    Item as ESItem,
+    Agent as ESAgent,
+    Link as ESLink,
+    Language as ESLanguage,
+    Measurement as ESMeasurement,
+    Rights as ESRights,
+    Subject as ESSubject
+)
+
+from lib.dbManager import relatedModel
+
+from helpers.logHelpers import createLog
+
+logger = createLog('projection_manager')
+
+DATE_FIELDS = ['date_type', 'date_range', 'display_date']
+LINK_FIELDS = ESLink.getFields() + ['flags']
+
+
+def projectWorks(session, workIDs):
+    """Load a batch of works as lightweight records rather than ORM objects.
+    This is an alternative to dbManager.loadWorks that returns records with
+    the same attributes, so that they can be passed to the ESDoc builders.
+    """
+    return WorkProjector(session).project(workIDs)
+
+
+class WorkProjector():
+    """Assembles the graph of records needed to build ElasticSearch documents
+    for a batch of works from plain column projections. Only the columns named
+    in the getFields() of each ES model (plus join keys) are selected, with
+    one query per related table per batch. The rows are then stitched into
+    parent records in Python with dicts keyed by the parent ID.
+    """
+    def __init__(self, session):
+        self.session = session
+        self.agents = {}
+        self.identifiers = {}
+
+        self.AgentWork = relatedModel(Work.agent_works)
+        self.AgentInstance = relatedModel(Instance.agent_instances)
+        self.Agent = relatedModel(self.AgentWork.agent)
+        self.Identifier = relatedModel(Work.identifiers)
+        self.Rights = relatedModel(Instance.rights)
+
+    def project(self, workIDs):
+        workColumns = WorkProjector._fieldColumns(Work, ESWork.getFields())
+        works = {
+            row[0]: WorkProjector._createRecord(workColumns, row)
+            for row in self.session.query(*workColumns)
+                .filter(Work.id.in_(workIDs))
+                .order_by(Work.id)
+        }
+        logger.debug('Projected {} works'.format(len(works)))
+
+        self._attach(works, Work, Work.dates, 'dates', DATE_FIELDS)
+        self._attach(works, Work, Work.alt_titles, 'alt_titles', ['title'])
+        self._attach(
+            works, Work, Work.subjects, 'subjects', ESSubject.getFields()
+        )
+        self._attach(
+            works, Work, Work.measurements, 'measurements',
+            ESMeasurement.getFields()
+        )
+        self._attach(works, Work, Work.links, 'links', LINK_FIELDS)
+        self._attach(
+            works, Work, Work.language, 'language', ESLanguage.getFields()
+        )
+        self._attach(
+            works, Work, Work.identifiers, 'identifiers', ['type'],
+            shared=self.identifiers
+        )
+        self._attachAgents(
+            works, Work, Work.agent_works, 'agent_works', self.AgentWork
+        )
+
+        instances = self._attach(
+            works, Work, Work.instances, 'instances', ESInstance.getFields()
+        )
+        self._attach(instances, Instance, Instance.dates, 'dates', DATE_FIELDS)
+        self._attach(
+            instances, Instance, Instance.language, 'language',
+            ESLanguage.getFields()
+        )
+        self._attach(instances, Instance, Instance.links, 'links', LINK_FIELDS)
+        rights = self._attach(
+            instances, Instance, Instance.rights, 'rights',
+            ESRights.getFields()
+        )
+        self._attach(
+            rights, self.Rights, self.Rights.dates, 'dates', DATE_FIELDS
+        )
+        self._attachAgents(
+            instances, Instance, Instance.agent_instances, 'agent_instances',
+            self.AgentInstance
+        )
+
+        items = self._attach(
+            instances, Instance, Instance.items, 'items', ESItem.getFields()
+        )
+        self._attach(items, Item, Item.links, 'links', LINK_FIELDS)
+        self._attach(
+            items, Item, Item.identifiers, 'identifiers', ['type'],
+            shared=self.identifiers
+        )
+
+        self._attach(
+            self.agents, self.Agent, self.Agent.aliases, 'aliases', ['alias']
+        )
+        self._attach(
+            self.agents, self.Agent, self.Agent.dates, 'dates', DATE_FIELDS
+        )
+        self._attachIdentifierValues()
+
+        return list(works.values())
+
+    def _attach(self, parents, parentModel, relationship, attr, fields,
+                shared=None):
+        """Select the given fields of the records related to each parent and
+        append them to a list under attr on the parent. Records reached by
+        more than one parent (e.g. through an association table) are created
+        once and shared. The rows are ordered by primary key so that each list
+        is in a stable order, and a record is only attached once to a parent.
+        Returns a dict of the related records by ID.
+        """
+        children = {} if shared is None else shared
+        for parent in parents.values():
+            setattr(parent, attr, [])
+
+        if len(parents) < 1:
+            return {}
+
+        childModel = relatedModel(relationship)
+        columns = WorkProjector._fieldColumns(childModel, fields)
+        rows = self.session.query(parentModel.id, *columns)\
+            .join(relationship)\
+            .filter(parentModel.id.in_(list(parents.keys())))\
+            .order_by(parentModel.id, *inspect(childModel).primary_key)
+
+        attached = {}
+        seen = set()
+        for row in rows:
+            if (row[0], row[1]) in seen:
+                continue
+            seen.add((row[0], row[1]))
+
+            child = children.get(row[1], None)
+            if child is None:
+                child = WorkProjector._createRecord(columns, row[1:])
+                children[row[1]] = child
+            attached[row[1]] = child
+            getattr(parents[row[0]], attr).append(child)
+
+        return attached
+
+    def _attachAgents(self, parents, parentModel, relationship, attr,
+                      relModel):
+        """Agents are related through an association model that carries the
+        role of the agent, so they are selected along with that role. As in
+        _attach these are ordered by primary key and de-duplicated per parent.
+        """
+        for parent in parents.values():
+            setattr(parent, attr, [])
+
+        if len(parents) < 1:
+            return
+
+        columns = WorkProjector._fieldColumns(self.Agent, ESAgent.getFields())
+        rows = self.session.query(parentModel.id, relModel.role, *columns)\
+            .join(relationship)\
+            .join(relModel.agent)\
+            .filter(parentModel.id.in_(list(parents.keys())))\
+            .order_by(parentModel.id, *inspect(relModel).primary_key)
+
+        seen = set()
+        for row in rows:
+            if row[:3] in seen:
+                continue
+            seen.add(row[:3])
+
+            agent = self.agents.get(row[2], None)
+            if agent is None:
+                agent = WorkProjector._createRecord(columns, row[2:])
+                self.agents[row[2]] = agent
+            getattr(parents[row[0]], attr).append(
+                SimpleNamespace(role=row[1], agent=agent)
+            )
+
+    def _attachIdentifierValues(self):
+        """Identifier values are stored in a separate table for each type of
+        identifier, so these are selected with one query per type present.
+        """
+        identifierTypes = defaultdict(dict)
+        for identifierID, identifier in self.identifiers.items():
+            idType = identifier.type if identifier.type else 'generic'
+            identifierTypes[idType][identifierID] = identifier
+
+        for idType, identifiers in identifierTypes.items():
+            self._attach(
+                identifiers, self.Identifier,
+                getattr(self.Identifier, idType), idType, ['value']
+            )
+
+    @staticmethod
+    def _fieldColumns(model, fields):
+        """Return the mapped columns of the model for the named fields, always
+        leading with the primary key. Names that do not map to a column are
+        left unset on the record and read as None by the ESDoc builders.
+        """
+        columnNames = inspect(model).column_attrs.keys()
+        selected = ['id']
+        for field in fields:
+            if field in columnNames and field not in selected:
+                selected.append(field)
+        return [getattr(model, field) for field in selected]
+
+    @staticmethod
+    def _createRecord(columns, row):
+        return SimpleNamespace(**{
+            column.key: value for column, value in zip(columns, row)
+        })
@@ -0,0 +1,141 @@
+import json
+import os
+
+from helpers.logHelpers import createLog
+from helpers.errorHelpers import ReconcileError
+
+logger = createLog('reconcile_manager')
+
+
+def streamIndexIDs(client, index, docType, pageSize=1000, after=None):
+    """Yield the ID of every document in an index in ascending order, or of
+    those after the ID after. Pages are retrieved with search_after on the
+    uuid field, which holds the same value as the document ID, so no scroll
+    context is held open and memory use is bounded by the page size.
+    """
+    lastID = after
+    while True:
+        body = {
+            'size': pageSize,
+            'sort': [{'uuid': 'asc'}],
+            'query': {'match_all': {}}
+        }
+        if lastID is not None:
+            body['search_after'] = [lastID]
+
+        hits = client.search(
+            index=index, doc_type=docType, body=body, _source=False
+        )['hits']['hits']
+        for hit in hits:
+            yield hit['_id']
+
+        if len(hits) < pageSize:
+            break
+        lastID = hits[-1]['sort'][0]
+
+
+def findFormerParents(client, index, docType, parents, pageSize=1000):
+    """Find the documents that hold an instance other than the document of
+    the work it now belongs to, e.g. after it was moved in a merge. parents
+    maps the ID of each instance to the UUID of its current work. Returns a
+    dict of the ID of each such document to the IDs of the instances it
+    holds. Instances are matched on instance_id, so only documents written
+    since it was added to the mapping are found.
+    """
+    formerParents = {}
+    lastID = None
+    while True:
+        body = {
+            'size': pageSize,
+            'sort': [{'uuid': 'asc'}],
+            'query': {'nested': {
+                'path': 'instances',
+                'query': {
+                    'terms': {'instances.instance_id': list(parents.keys())}
+                },
+                'inner_hits': {
+                    '_source': ['instances.instance_id'], 'size': 100
+                }
+            }}
+        }
+        if lastID is not None:
+            body['search_after'] = [lastID]
+
+        hits = client.search(
+            index=index, doc_type=docType, body=body, _source=False
+        )['hits']['hits']
+        for hit in hits:
+            innerHits = hit['inner_hits']['instances']['hits']['hits']
+            for innerHit in innerHits:
+                instanceID = innerHit['_source']['instance_id']
+                if parents.get(instanceID, None) != hit['_id']:
+                    formerParents.setdefault(hit['_id'], []).append(instanceID)
+
+        if len(hits) < pageSize:
+            break
+        lastID = hits[-1]['sort'][0]
+
+    if len(formerParents) > 0:
+        logger.info('Found {} documents holding moved instances'.format(
+            len(formerParents)
+        ))
+    return formerParents
+
+
+def mergeIDs(dbIDs, indexIDs):
+    """Merge join two ascending streams of IDs, yielding ("missing", ID) for
+    each ID only in the database, ("orphan", ID) for each only in the index
+    and ("match", ID) for each in both, so that the caller can follow its
+    progress. Only the current ID from each stream is held in memory.
+    """
+    dbIDs, indexIDs = iter(dbIDs), iter(indexIDs)
+    dbID, indexID = next(dbIDs, None), next(indexIDs, None)
+
+    while dbID is not None or indexID is not None:
+        if indexID is None or (dbID is not None and dbID < indexID):
+            yield 'missing', dbID
+            dbID = next(dbIDs, None)
+        elif dbID is None or indexID < dbID:
+            yield 'orphan', indexID
+            indexID = next(indexIDs, None)
+        else:
+            yield 'match', dbID
+            dbID, indexID = next(dbIDs, None), next(indexIDs, None)
+
+
+class ReconcileCursor():
+    """The progress of a reconciliation, kept in a local JSON file as the last
+    ID up to which the index and database have been reconciled, so that an
+    interrupted reconciliation resumes after it rather than starting again.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.after = None
+
+    def load(self):
+        try:
+            with open(self.path) as cursorFile:
+                self.after = json.load(cursorFile)['after']
+        except FileNotFoundError:
+            self.after = None
+        except (ValueError, KeyError):
+            raise ReconcileError('Unable to parse reconcile cursor {}'.format(
+                self.path
+            ))
+        return self.after
+
+    def save(self, after):
+        self.after = after
+        # Write to a temporary file and swap it in so that an interrupted
+        # write never leaves a truncated cursor behind
+        tmpPath = '{}.tmp'.format(self.path)
+        with open(tmpPath, 'w') as cursorFile:
+            json.dump({'after': after}, cursorFile)
+        os.replace(tmpPath, self.path)
+
+    def clear(self):
+        self.after = None
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
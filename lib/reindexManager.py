@@ -0,0 +1,111 @@
+import os
+from datetime import datetime
+
+from elasticsearch.exceptions import NotFoundError
+
+from model.elasticDocs import Work
+
+from helpers.logHelpers import createLog
+
+logger = createLog('reindex_manager')
+
+# Settings disabled while a new index is bulk loaded, and restored afterwards
+LOAD_SETTINGS = ('refresh_interval', 'number_of_replicas')
+
+
+class IndexRebuild():
+    """Builds a fresh, versioned copy of the index behind the ES_INDEX alias.
+
+    The new index is created from the Work mapping with refreshes and replicas
+    disabled, so that it can be bulk loaded without either slowing the load or
+    disturbing searches on the live index. Once it is loaded the settings of
+    the live index are restored, the new index is force merged and the alias
+    is moved to it in a single atomic update. Earlier versions are left in
+    place, so a rebuild can be rolled back by pointing the alias at one again.
+
+    A rebuild outlasts a single Lambda invocation, so it is run from the
+    backfill command, which resumes one by passing the name of its index.
+    """
+    def __init__(self, client, alias, name=None):
+        self.client = client
+        self.alias = alias
+        self.name = name or '{}_{}'.format(
+            alias, datetime.utcnow().strftime('%Y%m%d%H%M%S')
+        )
+        self.mergeSegments = int(os.environ.get('REINDEX_MERGE_SEGMENTS', 1))
+        self.mergeTimeout = int(os.environ.get('REINDEX_MERGE_TIMEOUT', 600))
+
+    def create(self):
+        logger.info('Creating index {} for {}'.format(self.name, self.alias))
+        newIndex = Work._index.clone(name=self.name)
+        newIndex.settings(refresh_interval='-1', number_of_replicas=0)
+        newIndex.create(using=self.client)
+
+    def finish(self):
+        """Restore the live settings on the new index, merge it down and swap
+        the alias to it.
+        """
+        settings = self.liveSettings()
+        logger.info('Restoring settings {} on {}'.format(settings, self.name))
+        self.client.indices.put_settings(
+            index=self.name, body={'index': settings}
+        )
+
+        logger.info('Force merging {} to {} segments'.format(
+            self.name, self.mergeSegments
+        ))
+        self.client.indices.forcemerge(
+            index=self.name, max_num_segments=self.mergeSegments,
+            request_timeout=self.mergeTimeout
+        )
+        self.client.indices.refresh(index=self.name)
+
+        self.swapAlias()
+
+    def discard(self):
+        """Delete the new index after a failed load, leaving the alias as is"""
+        logger.warning('Deleting incomplete index {}'.format(self.name))
+        self.client.indices.delete(index=self.name, ignore=[404])
+
+    def liveSettings(self):
+        """Return the load settings of the index currently behind the alias.
+        Any that cannot be found are reset to the cluster default.
+        """
+        settings = {setting: None for setting in LOAD_SETTINGS}
+        try:
+            liveIndexes = self.client.indices.get_settings(
+                index=self.alias,
+                name=['index.{}'.format(s) for s in LOAD_SETTINGS]
+            )
+        except NotFoundError:
+            return settings
+
+        for liveIndex in liveIndexes.values():
+            indexSettings = liveIndex['settings'].get('index', {})
+            for setting in LOAD_SETTINGS:
+                settings[setting] = indexSettings.get(setting, None)
+            break
+
+        return settings
+
+    def swapAlias(self):
+        actions = [{'add': {'index': self.name, 'alias': self.alias}}]
+
+        if self.client.indices.exists_alias(name=self.alias):
+            oldIndexes = list(self.client.indices.get_alias(name=self.alias))
+            for oldIndex in oldIndexes:
+                actions.insert(0, {
+                    'remove': {'index': oldIndex, 'alias': self.alias}
+                })
+            logger.info('Moving alias {} from {} to {}'.format(
+                self.alias, ', '.join(oldIndexes), self.name
+            ))
+        elif self.client.indices.exists(index=self.alias):
+            # An alias cannot share its name with an index, so an index
+            # created before rebuilds were introduced is replaced outright
+            logger.warning('Replacing index {} with alias to {}'.format(
+                self.alias, self.name
+            ))
+            actions.insert(0, {'remove_index': {'index': self.alias}})
+
+        self.client.indices.update_aliases(body={'actions': actions})
@@ -0,0 +1,95 @@
+import json
+import os
+from importlib import import_module
+
+from helpers.logHelpers import createLog
+from helpers.errorHelpers import ESError
+
+logger = createLog('target_manager')
+
+
+def createIndexTargets(index):
+    """Create the indexes that each document is written to. The live index,
+    ES_INDEX, is always the first. Others, such as an index being built for
+    a new mapping, are added in INDEX_TARGETS as a JSON list of objects with
+    the keys:
+
+    - index: Name of the index
+    - include: Optional list of the only top-level fields to write
+    - exclude: Optional list of top-level fields to leave out
+    - serializer: Optional dotted path of a function that takes the source of
+      a document and returns the source to write to this index
+    """
+    targets = [IndexTarget(index)]
+
+    try:
+        targetConfigs = json.loads(os.environ.get('INDEX_TARGETS', '[]'))
+        for config in targetConfigs:
+            targets.append(IndexTarget(
+                config['index'],
+                include=config.get('include', None),
+                exclude=config.get('exclude', None),
+                serializer=loadSerializer(config.get('serializer', None))
+            ))
+    except (ValueError, TypeError, KeyError, AttributeError) as err:
+        raise ESError('Invalid INDEX_TARGETS configuration: {}'.format(err))
+
+    if len(targets) > 1:
+        logger.info('Writing documents to {}'.format(
+            ', '.join(target.name for target in targets)
+        ))
+
+    return targets
+
+
+def loadSerializer(path):
+    if path is None:
+        return None
+
+    moduleName, _, funcName = path.rpartition('.')
+    try:
+        return getattr(import_module(moduleName), funcName)
+    except (ImportError, AttributeError, ValueError):
+        raise ESError('Unable to load target serializer {}'.format(path))
+
+
+class IndexTarget():
+    """An index that documents are written to, with the serializer and/or
+    field projection applied to each document before it is written there.
+    Documents are built once for all targets and an action is derived from
+    each for every target, so writing to several indexes does not repeat the
+    database load or the transform.
+    """
+    def __init__(self, name, include=None, exclude=None, serializer=None):
+        self.name = name
+        self.include = set(include) if include is not None else None
+        self.exclude = set(exclude) if exclude is not None else set()
+        self.serializer = serializer
+
+    @property
+    def projected(self):
+        return self.include is not None or len(self.exclude) > 0\
+            or self.serializer is not None
+
+    def action(self, esAction):
+        """Derive the bulk action for this index from one built for the live
+        index. The action is returned as is if it needs no changes.
+        """
+        if esAction.get('_index', None) == self.name and not self.projected:
+            return esAction
+
+        targetAction = dict(esAction)
+        targetAction['_index'] = self.name
+        if '_source' in esAction and self.projected:
+            targetAction['_source'] = self.project(esAction['_source'])
+        return targetAction
+
+    def project(self, source):
+        if self.serializer is not None:
+            source = self.serializer(source)
+
+        return {
+            field: value for field, value in source.items()
+            if (self.include is None or field in self.include)
+            and field not in self.exclude
+        }
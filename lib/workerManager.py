@@ -0,0 +1,188 @@
+import os
+import time
+import traceback
+from multiprocessing import Process, Pipe
+from multiprocessing.connection import wait
+
+from sfrCore import SessionManager
+
+from lib.cacheManager import createDocCache
+from lib.dbManager import importSnapshot
+from lib.memoryManager import createMemoryGuard
+
+from helpers.logHelpers import createLog
+from helpers.errorHelpers import TransformError
+
+logger = createLog('worker_manager')
+
+
+def createTransformPool(transform, memoryGuard=None):
+    """Create a pool of INDEX_WORKERS processes that apply the transform to
+    batches of works. With the default of a single worker no pool is created
+    and batches are transformed in the indexing process itself. If the
+    memoryGuard of the run is given, the batch sizes the workers reduce to
+    are passed on to it.
+    """
+    workerCount = int(os.environ.get('INDEX_WORKERS', 1))
+    if workerCount < 2:
+        return None
+    return TransformPool(workerCount, transform, memoryGuard)
+
+
+def runWorker(conn, transform):
+    """Main loop of a worker process. Each worker opens its own database
+    session, as connections cannot be shared across processes, and then
+    transforms the batches of work IDs it receives until it is sent None.
+    The number of works transformed and the time spent on them are returned
+    once the worker is stopped.
+
+    The memory of the worker is checked after each batch, while its results
+    are still held, and the batch size of its guard is returned with them.
+    """
+    manager = SessionManager()
+    manager.generateEngine()
+    session = manager.createSession()
+    cache = createDocCache()
+    memoryGuard = createMemoryGuard()
+
+    # Workers started by a backfill worker read from the same snapshot of
+    # the database as it does
+    snapshotID = os.environ.get('DB_SNAPSHOT', None)
+    if snapshotID is not None:
+        importSnapshot(session, snapshotID)
+
+    works, busy = 0, 0
+    try:
+        while True:
+            workIDs = conn.recv()
+            if workIDs is None:
+                break
+
+            start = time.perf_counter()
+            try:
+                result = transform(session, workIDs, cache)
+                batchSize = None
+                if memoryGuard is not None:
+                    memoryGuard.check()
+                    batchSize = memoryGuard.batchSize
+                conn.send(('result', (result, batchSize)))
+            except Exception:
+                conn.send(('error', traceback.format_exc()))
+                break
+            busy += time.perf_counter() - start
+            works += len(workIDs)
+
+        if cache is not None:
+            cache.logStats()
+        conn.send(('stats', {'works': works, 'seconds': busy}))
+    finally:
+        manager.closeConnection()
+        conn.close()
+
+
+class TransformWorker():
+    def __init__(self, number, transform):
+        self.number = number
+        self.conn, workerConn = Pipe()
+        self.process = Process(
+            target=runWorker, args=(workerConn, transform), daemon=True
+        )
+        self.process.start()
+        workerConn.close()
+
+    def send(self, workIDs):
+        # Rows are sent as plain tuples as query result rows cannot always
+        # be pickled
+        self.conn.send([tuple(workID) for workID in workIDs])
+
+    def receive(self):
+        try:
+            msgType, payload = self.conn.recv()
+        except EOFError:
+            raise TransformError(
+                'Transform worker {} exited unexpectedly'.format(self.number)
+            )
+
+        if msgType == 'error':
+            raise TransformError('Transform worker {} failed\n{}'.format(
+                self.number, payload
+            ))
+        return msgType, payload
+
+    def stop(self):
+        """Stop the worker and log its throughput"""
+        self.conn.send(None)
+        msgType, stats = self.receive()
+        self.process.join()
+
+        seconds = stats['seconds']
+        logger.info('Worker {}: {} works in {:.1f}s ({:.1f} works/s)'.format(
+            self.number, stats['works'], seconds,
+            stats['works'] / seconds if seconds > 0 else 0
+        ))
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+
+
+class TransformPool():
+    """Applies a transform to batches of work IDs in a set of worker
+    processes. This uses a Pipe for each worker rather than a
+    multiprocessing Pool or Queue, as those depend on shared memory that is
+    not available in the Lambda runtime.
+
+    Each worker has at most one batch outstanding at a time, so at most one
+    result per worker is held waiting for the consumer. This bounds the
+    memory used and keeps the producer from running ahead of the bulk writer.
+    """
+    def __init__(self, workerCount, transform, memoryGuard=None):
+        self.workerCount = workerCount
+        self.transform = transform
+        self.memoryGuard = memoryGuard
+
+    def map(self, batches):
+        """Yield the result of the transform for each batch, in the order
+        that they are completed rather than the order they were sent in.
+        """
+        workers = [
+            TransformWorker(number, self.transform)
+            for number in range(self.workerCount)
+        ]
+        logger.info('Started {} transform workers'.format(self.workerCount))
+
+        stopped = False
+        try:
+            idle = list(workers)
+            busy = {}
+            batches = iter(batches)
+            exhausted = False
+            while True:
+                while len(idle) > 0 and not exhausted:
+                    workIDs = next(batches, None)
+                    if workIDs is None:
+                        exhausted = True
+                        break
+                    worker = idle.pop()
+                    worker.send(workIDs)
+                    busy[worker.conn] = worker
+
+                if len(busy) < 1:
+                    break
+
+                for conn in wait(list(busy.keys())):
+                    worker = busy.pop(conn)
+                    _, (result, batchSize) = worker.receive()
+                    if self.memoryGuard is not None:
+                        self.memoryGuard.reduce(batchSize)
+                    idle.append(worker)
+                    yield result
+
+            for worker in workers:
+                worker.stop()
+            stopped = True
+        finally:
+            if not stopped:
+                for worker in workers:
+                    worker.terminate()
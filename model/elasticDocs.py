@@ -158,6 +158,9 @@ class Item(BaseInner):
 
 
 class Instance(BaseInner):
+    # Database ID of the instance, with which a document that still holds an
+    # instance after it has moved to another work can be found
+    instance_id = Integer()
     title = Text(fields={'keyword': Keyword()})
     sub_title = Text(fields={'keyword': Keyword()})
     alt_titles = Text(fields={'keyword': Keyword()})
@@ -204,6 +207,7 @@ class Work(BaseDoc):
     created_display = Keyword(index=False)
     alt_titles = Text(fields={'keyword': Keyword()})
     summary = Text()
+    content_hash = Keyword(index=False)
 
     identifiers = Nested(Identifier)
     subjects = Nested(Subject)
@@ -0,0 +1,69 @@
+import argparse
+import os
+
+from sfrCore import SessionManager
+
+from lib.backfillManager import Backfill
+
+# Indexes every work in the database from the command line, without the time
+# limits of the Lambda function. The work IDs are split into a partition per
+# worker process and progress is kept in a state file, so rerunning the same
+# command after an interruption resumes the backfill where it stopped.
+# With --rebuild the works are loaded into a new index that replaces the live
+# one once complete.
+# Invoke with: python -m scripts.backfill --workers 4
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backfill the index')
+    parser.add_argument(
+        '--workers', type=int, default=4,
+        help='Number of partitions indexed concurrently'
+    )
+    parser.add_argument(
+        '--chunk-size', type=int, default=10000,
+        help='Number of work IDs indexed between progress updates'
+    )
+    parser.add_argument(
+        '--state', default=None,
+        help='Path of the file that backfill progress is kept in (default '
+             '[ES_INDEX]_backfill.json, or [ES_INDEX]_rebuild.json with '
+             '--rebuild)'
+    )
+    parser.add_argument(
+        '--rebuild', action='store_true',
+        help='Load the works into a new index that replaces the live index '
+             'once complete'
+    )
+    parser.add_argument(
+        '--no-snapshot', dest='snapshot', action='store_false',
+        help='Let each worker read the database as it changes rather than '
+             'from a shared snapshot'
+    )
+    parser.add_argument(
+        '--restart', action='store_true',
+        help='Discard any earlier progress and start again'
+    )
+    args = parser.parse_args()
+
+    statePath = args.state or '{}_{}.json'.format(
+        os.environ['ES_INDEX'], 'rebuild' if args.rebuild else 'backfill'
+    )
+    backfill = Backfill(
+        statePath, args.workers, args.chunk_size, snapshot=args.snapshot,
+        rebuild=args.rebuild
+    )
+    if args.restart:
+        backfill.reset()
+
+    manager = SessionManager()
+    manager.generateEngine()
+    session = manager.createSession()
+    try:
+        backfill.run(session)
+    finally:
+        manager.closeConnection()
+
+
+if __name__ == '__main__':
+    main()
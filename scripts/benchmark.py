@@ -0,0 +1,117 @@
+import argparse
+import gzip
+import os
+import time
+
+os.environ.setdefault('ES_INDEX', 'benchmark')
+
+from lib.esManager import ESDoc  # noqa: E402
+from lib.docSerializer import serializeWork  # noqa: E402
+from lib.esSerializer import (  # noqa: E402
+    ESJSONSerializer,
+    ORJSONSerializer,
+    orjson
+)
+from scripts.fixtures import buildWorks  # noqa: E402
+
+# Benchmarks for the document building stages of the indexer. These run
+# against the synthetic in-memory work records of scripts.fixtures, so no
+# database or ElasticSearch cluster is needed.
+# Invoke with: python -m scripts.benchmark serializer --works 1000
+
+
+def timeRun(method, works, rounds):
+    start = time.perf_counter()
+    for _ in range(rounds):
+        results = [method(work) for work in works]
+    return (time.perf_counter() - start) / rounds, results
+
+
+def buildDSL(work):
+    esWork = ESDoc((work.id,), None, dbRec=work)
+    esWork.indexWork()
+    return esWork.work.to_dict(True)
+
+
+def benchmarkSerializer(works, rounds):
+    dslTime, dslDocs = timeRun(buildDSL, works, rounds)
+    dictTime, dictDocs = timeRun(serializeWork, works, rounds)
+
+    print('Serializer benchmark, {} works, {} rounds'.format(
+        len(works), rounds
+    ))
+    print('  outputs identical: {}'.format(dslDocs == dictDocs))
+    print('  dsl:  {:8.1f} us/work'.format(dslTime / len(works) * 10 ** 6))
+    print('  dict: {:8.1f} us/work'.format(dictTime / len(works) * 10 ** 6))
+    print('  speedup: {:.1f}x'.format(dslTime / dictTime))
+
+
+def encodeBulkBody(serializer, actions):
+    """Encode bulk actions as the body of a single bulk request"""
+    lines = []
+    for action in actions:
+        meta = {
+            key: value for key, value in action.items() if key != '_source'
+        }
+        lines.append(serializer.dumps({'index': meta}))
+        lines.append(serializer.dumps(action['_source']))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def benchmarkEncoding(works, rounds):
+    actions = [serializeWork(work) for work in works]
+    serializers = [('json', ESJSONSerializer())]
+    if orjson is not None:
+        serializers.append(('orjson', ORJSONSerializer()))
+
+    print('Encoding benchmark, {} works, {} rounds (per 1,000 works)'.format(
+        len(works), rounds
+    ))
+    perThousand = 1000 / len(works)
+    encoded = []
+    for name, serializer in serializers:
+        encodeTime, bodies = timeRun(
+            lambda action: encodeBulkBody(serializer, [action]), actions,
+            rounds
+        )
+        body = b''.join(bodies)
+        encoded.append(body)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            compressed = gzip.compress(body)
+        compressTime = (time.perf_counter() - start) / rounds
+
+        print('  {}:'.format(name))
+        print('    encode: {:8.1f} ms, {:8.1f} KB'.format(
+            encodeTime * perThousand * 1000, len(body) * perThousand / 1024
+        ))
+        print('    gzip:   {:8.1f} ms, {:8.1f} KB ({:.1f}x smaller)'.format(
+            compressTime * perThousand * 1000,
+            len(compressed) * perThousand / 1024,
+            len(body) / len(compressed)
+        ))
+
+    if orjson is None:
+        print('  orjson is not installed, only the stdlib encoder was run')
+    else:
+        print('  outputs identical: {}'.format(encoded[0] == encoded[1]))
+
+
+BENCHMARKS = {
+    'serializer': benchmarkSerializer,
+    'encoding': benchmarkEncoding
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Indexer benchmarks')
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS.keys()))
+    parser.add_argument('--works', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=3)
+    args = parser.parse_args()
+
+    BENCHMARKS[args.benchmark](buildWorks(args.works), args.rounds)
+
+
+if __name__ == '__main__':
+    main()
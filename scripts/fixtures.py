@@ -0,0 +1,111 @@
+import random
+from datetime import datetime
+from types import SimpleNamespace
+
+# Synthetic in-memory work records shaped like the records returned by the
+# database loaders, used by scripts/benchmark.py and the serializer tests
+
+
+def buildDate(dateType, year):
+    return SimpleNamespace(
+        date_type=dateType,
+        display_date=str(year),
+        date_range=SimpleNamespace(
+            lower='{}-01-01'.format(year), upper='{}-12-31'.format(year)
+        )
+    )
+
+
+def buildIdentifier(value):
+    return SimpleNamespace(
+        id=random.randint(1, 10 ** 6), type=None,
+        generic=[SimpleNamespace(value=value)]
+    )
+
+
+def buildLink(linkID, cover=False):
+    return SimpleNamespace(
+        id=linkID, url='http://example.com/{}'.format(linkID),
+        media_type='image/jpeg' if cover else 'text/html', thumbnail=None,
+        flags={'local': False, 'ebook': True, 'cover': cover}
+    )
+
+
+def buildAgent(agentID):
+    return SimpleNamespace(
+        id=agentID, name='Agent {}'.format(agentID),
+        sort_name='agent, {}'.format(agentID), lcnaf=None,
+        viaf=str(agentID), biography=None,
+        aliases=[SimpleNamespace(alias='Alias {}'.format(agentID))],
+        dates=[buildDate('birth_date', 1800 + agentID % 100)]
+    )
+
+
+def buildWork(workID, agents, languages):
+    """Build a work record with a typical spread of related records"""
+    def agentRels(count, role):
+        return [
+            SimpleNamespace(role=role, agent=random.choice(agents))
+            for _ in range(count)
+        ]
+
+    instances = []
+    for i in range(random.randint(1, 8)):
+        items = [
+            SimpleNamespace(
+                id=i * 10 + j, source='gutenberg', content_type='ebook',
+                modified=datetime(2019, 1, 1), drm=None,
+                identifiers=[buildIdentifier('item{}{}'.format(i, j))],
+                links=[buildLink(i * 100 + j)]
+            )
+            for j in range(random.randint(0, 3))
+        ]
+        instances.append(SimpleNamespace(
+            id=i, title='Instance {}'.format(i), sub_title=None,
+            pub_place='New York', edition='1st', edition_statement=None,
+            table_of_contents=None, extent='300p', volume=None, summary=None,
+            dates=[buildDate('pub_date', 1900 + i)],
+            agent_instances=agentRels(random.randint(0, 3), 'publisher'),
+            items=items,
+            rights=[SimpleNamespace(
+                id=i, source='hathitrust', license='public_domain',
+                rights_statement='Public Domain', rights_reason=None,
+                dates=[buildDate('copyright_date', 1900)]
+            )],
+            language=random.sample(languages, 1),
+            links=[buildLink(1000 + i, cover=True), buildLink(2000 + i)]
+        ))
+
+    return SimpleNamespace(
+        id=workID, uuid='00000000-0000-0000-0000-{:012d}'.format(workID),
+        title='Work {}'.format(workID), sort_title='work {}'.format(workID),
+        sub_title=None, medium='text', series=None, series_position=None,
+        date_modified=datetime(2019, 6, 1),
+        dates=[buildDate('issued', 1900)],
+        alt_titles=[SimpleNamespace(title='Alternate {}'.format(workID))],
+        subjects=[
+            SimpleNamespace(
+                authority='lcsh', uri=None, subject='Subject {}'.format(s)
+            )
+            for s in range(random.randint(0, 5))
+        ],
+        agent_works=agentRels(random.randint(1, 4), 'author'),
+        identifiers=[buildIdentifier('work{}'.format(workID))],
+        measurements=[],
+        links=[buildLink(workID)],
+        language=random.sample(languages, 1),
+        instances=instances
+    )
+
+
+def buildWorks(count):
+    random.seed(count)
+    agents = [buildAgent(a) for a in range(max(count // 10, 10))]
+    names = ['english', 'french', 'german', 'spanish']
+    languages = [
+        SimpleNamespace(
+            id=langID, language=name, iso_2=name[:2], iso_3=name[:3]
+        )
+        for langID, name in enumerate(names)
+    ]
+    return [buildWork(w, agents, languages) for w in range(count)]
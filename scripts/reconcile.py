@@ -0,0 +1,47 @@
+import argparse
+import os
+
+from sfrCore import SessionManager
+
+from lib.esManager import ESConnection
+from lib.reconcileManager import ReconcileCursor
+
+# Reconciles the index with the database from the command line, without the
+# time limits of the Lambda function. The last ID reconciled is kept in a
+# cursor file, so rerunning the same command after an interruption resumes
+# the reconciliation where it stopped.
+# Invoke with: python -m scripts.reconcile
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Reconcile the index with the database'
+    )
+    parser.add_argument(
+        '--state', default='{}_reconcile.json'.format(os.environ['ES_INDEX']),
+        help='Path of the file that the reconcile cursor is kept in'
+    )
+    parser.add_argument(
+        '--restart', action='store_true',
+        help='Discard any earlier progress and start again'
+    )
+    args = parser.parse_args()
+
+    cursor = ReconcileCursor(args.state)
+    if args.restart:
+        cursor.clear()
+
+    manager = SessionManager()
+    manager.generateEngine()
+    session = manager.createSession()
+    try:
+        ESConnection().reconcile(
+            session, after=cursor.load(), progress=cursor.save
+        )
+        cursor.clear()
+    finally:
+        manager.closeConnection()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,15 @@
 import json
+import os
+import time
 import traceback
+import uuid
 
+from elasticsearch.exceptions import TransportError
 from sfrCore import SessionManager
 
 from helpers.errorHelpers import NoRecordsReceived, DataError, DBError, ESError
 from helpers.logHelpers import createLog
+from helpers.clientHelpers import createAWSClient
 from lib.esManager import ESConnection
 
 """Logger can be passed name of current module
@@ -21,17 +26,39 @@ until AWS decides to regenerate the container
 MANAGER = SessionManager()
 MANAGER.generateEngine()
 
+"""The ElasticSearch connection is likewise kept for the life of the container.
+It is created on the first invocation, which checks that the index exists and
+configures the mappers, and its pool of keep-alive connections is reused by
+later invocations. It is only checked and rebuilt after a transport error.
+"""
+ES_CONNECTION = None
+
 
 def handler(event, context):
-    """Central handler invoked by Lambda trigger. Begins processing of kinesis
-    stream.
+    """Central handler invoked by Lambda trigger. If invoked with a batch of
+    SQS messages only the works referenced in those messages are indexed. If
+    invoked with {"replay_dead_letters": true} the works that failed to index
+    in earlier runs are retried. Otherwise all recently updated records are
+    processed, for as long as the remaining time of the invocation allows.
     """
     logger.debug('Starting Lambda Execution')
 
-    # Process recently updated records in the database. This is adjustable, 
-    # looks back N seconds to retrieve records. Frequency of runs should be
-    # determined based of experience, does not need to be live
-    indexRecords()
+    records = event.get('Records', None)
+    if records:
+        # Index only the works referenced in the received messages
+        identifiers = parseRecords(records)
+        if len(identifiers) > 0:
+            indexRecords(identifiers)
+        else:
+            logger.warning('No valid messages received in SQS batch')
+    elif event.get('replay_dead_letters', False) is True:
+        indexRecords(replay=True)
+    else:
+        # Process recently updated records in the database. This resumes
+        # from the last checkpoint. Frequency of runs should be determined
+        # based of experience, does not need to be live
+        if indexRecords(deadline=getDeadline(context)) is False:
+            continueRun(context)
 
     logger.info('Successfully invoked lambda')
 
@@ -40,20 +67,138 @@ def handler(event, context):
     return True
 
 
-def indexRecords():
+def parseRecords(records):
+    """Parse a batch of SQS messages into a dict of the unique identifiers
+    received for each record type. Each message body should have the form
+    {"type": "work|instance|item", "identifier": "xxx"}. Invalid messages are
+    logged and skipped so that they do not block the rest of the batch.
+    """
+    identifiers = {}
+    for record in records:
+        try:
+            message = json.loads(record['body'])
+            recType = message['type'].lower()
+            identifier = message['identifier']
+            # Identifiers are collected in sets and used as query values, so
+            # they are checked against the type of the column they are
+            # compared with, a UUID for works and an integer row ID otherwise
+            if isinstance(identifier, bool)\
+                    or not isinstance(identifier, (str, int)):
+                raise TypeError('Invalid identifier {}'.format(identifier))
+            if recType == 'work':
+                identifier = str(uuid.UUID(identifier))
+            elif recType in ['instance', 'item']:
+                identifier = int(identifier)
+        except (KeyError, TypeError, AttributeError, ValueError):
+            logger.warning('Skipping invalid message {}'.format(record))
+            continue
+
+        if recType not in ['work', 'instance', 'item']:
+            logger.warning('Skipping message for unsupported type {}'.format(
+                recType
+            ))
+            continue
+
+        identifiers.setdefault(recType, set()).add(identifier)
+
+    return identifiers
+
+
+def indexRecords(identifiers=None, replay=False, deadline=None):
     """Processes the modified database records in the given period. Records are
     retrieved from the db, transformed into the ElasticSearch model and 
     processed in batches of 100. Errors are caught and logged within the ES
-    model.
+    model. If identifiers are provided only the works they reference are
+    processed, and if replay is set only the works in the dead letter spool.
+
+    If a deadline is provided a scan of updated records stops before it,
+    once the works already retrieved are indexed, and False is returned so
+    that the rest can be processed by a further invocation.
     """
-    logger.info('Creating connection to ElasticSearch index')
-    es = ESConnection()
+    es = getConnection()
 
     logger.info('Creating postgresql session')
     session = MANAGER.createSession()
 
-    logger.info('Loading recently updated records')
-    es.generateRecords(session)
+    try:
+        if replay:
+            logger.info('Replaying records from the dead letter spool')
+            es.replayDeadLetters(session)
+        else:
+            logger.info('Loading recently updated records')
+            es.generateRecords(session, identifiers, deadline=deadline)
+    except TransportError:
+        resetConnection(es)
+        raise
 
     logger.info('Close postgresql session')
     MANAGER.closeConnection()
+
+    return not es.stopped
+
+
+def getDeadline(context):
+    """Return the time.monotonic() value by which a run should stop, leaving
+    INDEX_TIME_RESERVE seconds of the invocation to write the works already
+    retrieved and save the checkpoint. Returns None if run without a Lambda
+    context.
+    """
+    if context is None:
+        return None
+
+    reserve = float(os.environ.get('INDEX_TIME_RESERVE', 120))
+    remaining = context.get_remaining_time_in_millis() / 1000
+    return time.monotonic() + remaining - reserve
+
+
+def continueRun(context):
+    """Invoke the function again to continue a run that stopped before its
+    deadline, if INDEX_CONTINUE is set. Otherwise the next scheduled run
+    resumes from the saved checkpoint. A run is never continued without a
+    checkpoint store, as the next run would scan the same window again.
+    """
+    if os.environ.get('INDEX_CONTINUE', 'false').lower() != 'true':
+        logger.info('Run stopped early, next run resumes from checkpoint')
+        return
+
+    if getConnection().checkpoint is None:
+        logger.warning('Run stopped early without a checkpoint to resume from')
+        return
+
+    logger.info('Run stopped early, invoking {} to continue it'.format(
+        context.function_name
+    ))
+    lambdaClient = createAWSClient('lambda', {
+        'region': os.environ.get('AWS_REGION', 'us-east-1')
+    })
+    lambdaClient.invoke(
+        FunctionName=context.function_name,
+        InvocationType='Event',
+        Payload=json.dumps({})
+    )
+
+
+def getConnection():
+    """Return the ESConnection cached for this container, creating it if this
+    is the first invocation or it was dropped after an error. The index check
+    is only repeated if it was cleared by a health check.
+    """
+    global ES_CONNECTION
+    if ES_CONNECTION is None:
+        logger.info('Creating connection to ElasticSearch index')
+        ES_CONNECTION = ESConnection()
+    elif ES_CONNECTION.indexExists is False:
+        ES_CONNECTION.createIndex()
+
+    return ES_CONNECTION
+
+
+def resetConnection(es):
+    """Health check the cached connection after a transport error, dropping
+    it so that it is rebuilt on the next invocation if the cluster cannot be
+    reached.
+    """
+    global ES_CONNECTION
+    if es.healthCheck() is False:
+        logger.warning('Discarding cached ElasticSearch connection')
+        ES_CONNECTION = None
@@ -0,0 +1,394 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import json
+import os
+import tempfile
+from datetime import datetime
+from multiprocessing import Pipe
+
+from helpers.errorHelpers import BackfillError
+from lib.workerManager import createTransformPool
+
+os.environ['ES_INDEX'] = 'test'
+
+from lib.backfillManager import (
+    partitionRange,
+    BackfillState,
+    RelayedDeadLetterSpool,
+    runPartition,
+    BackfillWorker,
+    Backfill
+)
+
+
+def mockTransform(session, workIDs, cache):
+    return [workID[0] for workID in workIDs]
+
+
+class MockPooledES():
+    """Stands in for ESConnection in a real backfill worker process, building
+    documents in a transform pool as generateRecords does with INDEX_WORKERS
+    """
+    def __init__(self):
+        self.success, self.failure, self.unchanged, self.stale = 0, 0, 0, 0
+
+    def generateRecords(self, session, rebuildIndex=None, workRange=None):
+        transformPool = createTransformPool(mockTransform)
+        afterID, lastID = workRange
+        batches = [[(workID, None)] for workID in range(afterID + 1, lastID + 1)]
+        self.success = len(list(transformPool.map(iter(batches))))
+
+
+class TestBackfillManager(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.statePath = os.path.join(self.tmpDir.name, 'state.json')
+
+        self.events = []
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def test_partition_range(self):
+        self.assertEqual(
+            partitionRange(1, 10, 3), [(0, 3), (3, 6), (6, 10)]
+        )
+
+    def test_partition_range_small(self):
+        self.assertEqual(partitionRange(5, 6, 4), [(4, 5), (5, 6)])
+
+    def test_state_create_save_load(self):
+        state = BackfillState.create(self.statePath, 1, 100, 2)
+        state.advance(0, 20, 15)
+        state.save()
+
+        loaded = BackfillState.load(self.statePath)
+        self.assertEqual(loaded.partitions, [
+            {'number': 0, 'after': 0, 'last': 50, 'done': 20, 'documents': 15},
+            {'number': 1, 'after': 50, 'last': 100, 'done': 50, 'documents': 0}
+        ])
+        self.assertEqual((loaded.span, loaded.remaining), (100, 80))
+
+    def test_state_pending(self):
+        state = BackfillState.create(self.statePath, 1, 100, 2)
+        state.advance(0, 50, 40)
+        self.assertEqual([part['number'] for part in state.pending], [1])
+
+    def test_state_load_missing(self):
+        self.assertIsNone(BackfillState.load(self.statePath))
+
+    def test_state_load_invalid(self):
+        with open(self.statePath, 'w') as stateFile:
+            stateFile.write('{"bad"')
+        with self.assertRaises(BackfillError):
+            BackfillState.load(self.statePath)
+
+    def test_relayed_dead_letters(self):
+        mockConn = MagicMock()
+        spool = RelayedDeadLetterSpool(mockConn)
+        spool.flush()
+        mockConn.send.assert_not_called()
+        spool.add('uuid1', {'status': 400})
+        spool.flush()
+        msgType, letters = mockConn.send.call_args[0][0]
+        self.assertEqual((msgType, letters[0]['id']), ('letters', 'uuid1'))
+        self.assertEqual(spool.letters, [])
+
+    @patch('lib.esManager.ESConnection')
+    @patch('lib.backfillManager.SessionManager')
+    def test_run_partition(self, mock_manager, mock_es):
+        mockES = mock_es.return_value
+        mockES.success, mockES.failure, mockES.unchanged, mockES.stale = 3, 1, 1, 0
+        mockConn = MagicMock()
+        partition = {'number': 0, 'after': 0, 'last': 25, 'done': 5}
+        runPartition(mockConn, partition, 10)
+        session = mock_manager.return_value.createSession.return_value
+        self.assertEqual(
+            [c[1]['workRange'] for c in mockES.generateRecords.call_args_list],
+            [(5, 15), (15, 25)]
+        )
+        mockES.generateRecords.assert_called_with(
+            session, rebuildIndex=None, workRange=(15, 25)
+        )
+        self.assertEqual(
+            [c[0][0] for c in mockConn.send.call_args_list],
+            [('progress', (15, 5)), ('progress', (25, 5))]
+        )
+        mockConn.close.assert_called_once()
+        mock_manager.return_value.closeConnection.assert_called_once()
+
+    @patch('lib.esManager.ESConnection')
+    @patch('lib.backfillManager.SessionManager')
+    def test_run_partition_error(self, mock_manager, mock_es):
+        mock_es.return_value.generateRecords.side_effect = ValueError
+        mockConn = MagicMock()
+        runPartition(mockConn, {'number': 0, 'last': 25, 'done': 5}, 10)
+        self.assertEqual(mockConn.send.call_args[0][0][0], 'error')
+        mockConn.close.assert_called_once()
+
+    @patch('lib.esManager.ESConnection')
+    @patch('lib.backfillManager.SessionManager')
+    def test_run_partition_rebuild(self, mock_manager, mock_es):
+        mockES = mock_es.return_value
+        mockES.success, mockES.failure, mockES.unchanged, mockES.stale = 1, 0, 0, 0
+        runPartition(
+            MagicMock(), {'number': 0, 'last': 15, 'done': 5}, 10,
+            rebuildIndex='test_1'
+        )
+        mockES.generateRecords.assert_called_once_with(
+            mock_manager.return_value.createSession.return_value,
+            rebuildIndex='test_1', workRange=(5, 15)
+        )
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.retrieveIDBounds', return_value=(1, 100))
+    def test_load_state_new(self, mock_bounds, mock_spool):
+        backfill = Backfill(self.statePath, 4, 10)
+        state = backfill.loadState('session')
+        self.assertEqual(len(state.partitions), 4)
+        self.assertTrue(os.path.exists(self.statePath))
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.retrieveIDBounds')
+    def test_load_state_resume(self, mock_bounds, mock_spool):
+        BackfillState.create(self.statePath, 1, 100, 2).save()
+        backfill = Backfill(self.statePath, 4, 10)
+        state = backfill.loadState('session')
+        self.assertEqual(len(state.partitions), 2)
+        mock_bounds.assert_not_called()
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.retrieveLatestMark')
+    @patch('lib.backfillManager.IndexRebuild')
+    @patch('lib.backfillManager.retrieveIDBounds', return_value=(1, 100))
+    def test_load_state_rebuild(self, mock_bounds, mock_rebuild, mock_mark, mock_spool):
+        mock_rebuild.return_value.name = 'test_1'
+        mock_mark.return_value = (datetime(2019, 1, 1), 99)
+        backfill = Backfill(self.statePath, 2, 10, rebuild=True)
+        backfill.es = MagicMock(index='test')
+        backfill.loadState('session')
+
+        mock_rebuild.assert_called_once_with(backfill.es.client, 'test')
+        mock_rebuild.return_value.create.assert_called_once()
+        mock_mark.assert_called_once_with('session')
+        self.assertEqual(BackfillState.load(self.statePath).rebuild, {
+            'index': 'test_1',
+            'mark': {'date_modified': '2019-01-01T00:00:00.000000', 'id': 99},
+            'live': False
+        })
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    def test_load_state_mismatch(self, mock_spool):
+        BackfillState.create(self.statePath, 1, 100, 2).save()
+        with self.assertRaises(BackfillError):
+            Backfill(self.statePath, 2, 10, rebuild=True).loadState('session')
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.IndexRebuild')
+    def test_reset_rebuild(self, mock_rebuild, mock_spool):
+        state = BackfillState.create(self.statePath, 1, 100, 2)
+        state.rebuild = {'index': 'test_1', 'mark': None, 'live': False}
+        state.save()
+        backfill = Backfill(self.statePath, 2, 10, rebuild=True)
+        backfill.es = MagicMock()
+        backfill.reset()
+        mock_rebuild.assert_called_once_with(backfill.es.client, 'test', 'test_1')
+        mock_rebuild.return_value.discard.assert_called_once()
+        self.assertFalse(os.path.exists(self.statePath))
+
+    def createRebuildState(self, done=False):
+        state = BackfillState.create(self.statePath, 1, 100, 2)
+        if done:
+            for partition in state.partitions:
+                state.advance(partition['number'], partition['last'], 10)
+        state.rebuild = {
+            'index': 'test_1',
+            'mark': {'date_modified': '2019-01-01T00:00:00.000000', 'id': 99},
+            'live': False
+        }
+        state.save()
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.IndexRebuild')
+    @patch('lib.backfillManager.BackfillWorker')
+    def test_run_rebuild(self, mock_worker, mock_rebuild, mock_spool):
+        self.createRebuildState()
+        mock_worker.side_effect = self.mockWorkers({
+            0: [('progress', (50, 20))], 1: [('progress', (100, 20))]
+        })
+        backfill = Backfill(self.statePath, 2, 50, rebuild=True)
+        backfill.es = MagicMock(index='test')
+        backfill.es.checkpoint.load.return_value = (datetime(2019, 2, 1), 5)
+        backfill.run('session')
+
+        self.assertEqual(
+            [c[0][3] for c in mock_worker.call_args_list], ['test_1', 'test_1']
+        )
+        mock_rebuild.assert_called_once_with(backfill.es.client, 'test', 'test_1')
+        mock_rebuild.return_value.finish.assert_called_once()
+        # The changes made since the rebuild started are indexed again
+        backfill.es.checkpoint.save.assert_called_once_with(
+            (datetime(2019, 1, 1), 99)
+        )
+        self.assertTrue(BackfillState.load(self.statePath).rebuild['live'])
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.IndexRebuild')
+    @patch('lib.backfillManager.BackfillWorker')
+    def test_run_rebuild_resume_finish(self, mock_worker, mock_rebuild, mock_spool):
+        self.createRebuildState(done=True)
+        backfill = Backfill(self.statePath, 2, 50, rebuild=True)
+        backfill.es = MagicMock(index='test')
+        backfill.es.checkpoint.load.return_value = (datetime(2018, 12, 1), 5)
+        backfill.run('session')
+
+        mock_worker.assert_not_called()
+        mock_rebuild.return_value.finish.assert_called_once()
+        backfill.es.checkpoint.save.assert_not_called()
+
+        backfill.run('session')
+        mock_rebuild.return_value.finish.assert_called_once()
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.IndexRebuild')
+    @patch('lib.backfillManager.BackfillWorker')
+    def test_run_rebuild_failed(self, mock_worker, mock_rebuild, mock_spool):
+        self.createRebuildState()
+        mock_worker.side_effect = self.mockWorkers({
+            0: [('error', 'Traceback')], 1: [('progress', (100, 20))]
+        })
+        backfill = Backfill(self.statePath, 2, 50, rebuild=True)
+        backfill.es = MagicMock()
+        with self.assertRaises(BackfillError):
+            backfill.run('session')
+        mock_rebuild.return_value.finish.assert_not_called()
+        mock_rebuild.return_value.discard.assert_not_called()
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.retrieveIDBounds', return_value=(None, None))
+    @patch('lib.backfillManager.BackfillWorker')
+    def test_run_empty(self, mock_worker, mock_bounds, mock_spool):
+        Backfill(self.statePath, 4, 10).run('session')
+        mock_worker.assert_not_called()
+
+    @patch('lib.esManager.ESConnection')
+    @patch('lib.backfillManager.importSnapshot')
+    @patch('lib.backfillManager.SessionManager')
+    def test_run_partition_snapshot(self, mock_manager, mock_import, mock_es):
+        # The snapshot is imported, and published to the transform workers,
+        # before any chunk is indexed
+        def mockGenerate(session, rebuildIndex=None, workRange=None):
+            mock_import.assert_called_once_with(session, 'snap-1')
+            self.assertEqual(os.environ['DB_SNAPSHOT'], 'snap-1')
+
+        mock_es.return_value.generateRecords.side_effect = mockGenerate
+        mockES = mock_es.return_value
+        mockES.success, mockES.failure, mockES.unchanged, mockES.stale = 1, 0, 0, 0
+        mockConn = MagicMock()
+        with patch.dict(os.environ, {}):
+            runPartition(mockConn, {'number': 0, 'last': 15, 'done': 5}, 10, 'snap-1')
+        mock_es.return_value.generateRecords.assert_called_once()
+        mockConn.send.assert_called_once_with(('progress', (15, 1)))
+
+    @patch.dict(os.environ, {'INDEX_WORKERS': '2', 'DOC_CACHE_SIZE': '0'})
+    @patch('lib.esManager.ESConnection', MockPooledES)
+    @patch('lib.workerManager.SessionManager')
+    @patch('lib.backfillManager.SessionManager')
+    def test_worker_transform_pool(self, mock_manager, mock_pool_manager):
+        worker = BackfillWorker({'number': 0, 'last': 6, 'done': 0}, 3)
+        messages = []
+        while True:
+            message = worker.receive()
+            messages.append(message)
+            if message[0] == 'exit':
+                break
+        worker.process.join()
+        self.assertEqual(messages, [
+            ('progress', (3, 3)), ('progress', (6, 3)), ('exit', None)
+        ])
+
+    def mockWorkers(self, messages):
+        """Create fake workers whose messages are waiting in their pipes"""
+        def createWorker(partition, chunkSize, snapshotID=None,
+                         rebuildIndex=None):
+            worker = MagicMock()
+            worker.process.join.side_effect = lambda: self.events.append(
+                'exit {}'.format(partition['number'])
+            )
+            worker.number = partition['number']
+            worker.conn, workerConn = Pipe()
+            for message in messages[partition['number']]:
+                workerConn.send(message)
+            workerConn.close()
+            worker.receive.side_effect = lambda: BackfillWorker.receive(worker)
+            return worker
+        return createWorker
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.retrieveIDBounds', return_value=(1, 100))
+    @patch('lib.backfillManager.BackfillWorker')
+    def test_run(self, mock_worker, mock_bounds, mock_spool):
+        mock_worker.side_effect = self.mockWorkers({
+            0: [('progress', (25, 20)), ('progress', (50, 22))],
+            1: [('letters', [{'id': 'uuid1'}]), ('progress', (100, 40))]
+        })
+        Backfill(self.statePath, 2, 25).run('session')
+
+        with open(self.statePath) as stateFile:
+            partitions = json.load(stateFile)['partitions']
+        self.assertEqual(
+            [(part['done'], part['documents']) for part in partitions],
+            [(50, 42), (100, 40)]
+        )
+        mock_spool.return_value.extend.assert_called_once_with(
+            [{'id': 'uuid1'}]
+        )
+        mock_spool.return_value.flush.assert_called_once()
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.retrieveIDBounds', return_value=(1, 100))
+    @patch('lib.backfillManager.BackfillWorker')
+    def test_run_partition_failed(self, mock_worker, mock_bounds, mock_spool):
+        mock_worker.side_effect = self.mockWorkers({
+            0: [('progress', (25, 20)), ('error', 'Traceback')],
+            1: [('progress', (100, 40))]
+        })
+        with self.assertRaises(BackfillError):
+            Backfill(self.statePath, 2, 25).run('session')
+
+        # The failed partition is resumed from its last completed chunk
+        state = BackfillState.load(self.statePath)
+        self.assertEqual(
+            [(part['number'], part['done']) for part in state.pending],
+            [(0, 25)]
+        )
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.exportSnapshot', return_value='snap-1')
+    @patch('lib.backfillManager.retrieveIDBounds', return_value=(1, 100))
+    @patch('lib.backfillManager.BackfillWorker')
+    def test_run_snapshot(self, mock_worker, mock_bounds, mock_export, mock_spool):
+        mockSession = MagicMock()
+        mockSession.rollback.side_effect = lambda: self.events.append('release')
+        mock_worker.side_effect = self.mockWorkers({
+            0: [('progress', (50, 20))],
+            1: [('progress', (75, 20)), ('progress', (100, 20))]
+        })
+        Backfill(self.statePath, 2, 25, snapshot=True).run(mockSession)
+        mock_export.assert_called_once_with(mockSession)
+        self.assertEqual(
+            [c[0][2] for c in mock_worker.call_args_list], ['snap-1', 'snap-1']
+        )
+        # Transform workers import the snapshot for every chunk, so it is
+        # only released once every partition has finished
+        self.assertEqual(sorted(self.events[:2]), ['exit 0', 'exit 1'])
+        self.assertEqual(self.events[2:], ['release'])
+
+    @patch('lib.backfillManager.createDeadLetterSpool')
+    @patch('lib.backfillManager.retrieveIDBounds', return_value=(1, 100))
+    @patch('lib.backfillManager.BackfillWorker')
+    def test_run_without_snapshot(self, mock_worker, mock_bounds, mock_spool):
+        mockSession = MagicMock()
+        mock_worker.side_effect = self.mockWorkers({0: [('progress', (100, 5))]})
+        Backfill(self.statePath, 1, 100).run(mockSession)
+        mockSession.rollback.assert_not_called()
@@ -0,0 +1,359 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import asyncio
+import json
+
+from elasticsearch.exceptions import (
+    ConnectionError, ConnectionTimeout, TransportError
+)
+from elasticsearch.helpers import BulkIndexError
+from elasticsearch.serializer import JSONSerializer
+
+from lib.bulkManager import (
+    createBulkSink,
+    createChunkController,
+    BulkSink,
+    ChunkController
+)
+
+
+def mockBulk(body):
+    """Echo an index result for each document in a bulk request, failing any
+    document with an ID starting with "bad" and rejecting any starting with
+    "busy"
+    """
+    items = []
+    for line in body.strip().split('\n')[::2]:
+        docID = json.loads(line)['index']['_id']
+        status = 201
+        if docID.startswith('bad'):
+            status = 400
+        elif docID.startswith('busy'):
+            status = 429
+        items.append({'index': {'_id': docID, 'status': status}})
+    return {'items': items}
+
+
+def buildAction(docID, title='Test'):
+    return {
+        '_index': 'test', '_type': 'doc', '_id': docID,
+        '_source': {'title': title}
+    }
+
+
+class TestChunkController(unittest.TestCase):
+    @patch.dict('os.environ', {
+        'BULK_CHUNK_SIZE': '100', 'BULK_CONCURRENCY': '2',
+        'BULK_TARGET_LATENCY': '5', 'BULK_MAX_CHUNK_SIZE': '1000',
+        'BULK_MAX_CONCURRENCY': '6'
+    })
+    def test_create_controller(self):
+        testController = createChunkController()
+        self.assertEqual(testController.chunkSize, 100)
+        self.assertEqual(testController.concurrency, 2)
+        self.assertEqual(testController.targetLatency, 5)
+        self.assertEqual(testController.maxChunkSize, 1000)
+        self.assertEqual(testController.maxConcurrency, 6)
+
+    def test_grow_under_target(self):
+        testController = ChunkController(100, 2, maxChunkSize=115)
+        testController.record(0.5, 100)
+        self.assertEqual(testController.chunkSize, 110)
+        self.assertEqual(testController.concurrency, 3)
+        testController.record(0.5, 100)
+        self.assertEqual(testController.chunkSize, 115)
+        self.assertEqual(testController.indexed, 200)
+
+    def test_hold_over_target(self):
+        testController = ChunkController(100, 2)
+        testController.record(3, 100)
+        self.assertEqual(testController.chunkSize, 100)
+        self.assertEqual(testController.concurrency, 2)
+
+    def test_back_off_on_rejection(self):
+        testController = ChunkController(100, 4)
+        testController.record(0.5, 100, rejected=10)
+        self.assertEqual(testController.chunkSize, 50)
+        self.assertEqual(testController.concurrency, 2)
+        self.assertEqual(testController.indexed, 90)
+
+        for _ in range(5):
+            testController.backOff()
+        self.assertEqual(testController.chunkSize, 10)
+        self.assertEqual(testController.concurrency, 1)
+
+    def test_fixed_without_target(self):
+        testController = ChunkController(100, 2, targetLatency=0)
+        testController.record(0.5, 100)
+        testController.record(0.5, 100, rejected=10)
+        self.assertEqual(testController.chunkSize, 100)
+        self.assertEqual(testController.concurrency, 2)
+
+
+class TestBulkSink(unittest.TestCase):
+    def setUp(self):
+        self.mockClient = MagicMock()
+        self.mockClient.transport.serializer = JSONSerializer()
+        self.mockClient.bulk.side_effect = mockBulk
+
+    def createSink(self, chunkSize=500, concurrency=2, **kwargs):
+        kwargs.setdefault('retryBackoff', 0)
+        return BulkSink(
+            self.mockClient,
+            ChunkController(chunkSize, concurrency, targetLatency=0),
+            **kwargs
+        )
+
+    @patch.dict('os.environ', {
+        'BULK_CHUNK_BYTES': '1000', 'BULK_MAX_RETRIES': '5',
+        'BULK_RETRY_BACKOFF': '0.5', 'BULK_MAX_RETRY_BACKOFF': '10'
+    })
+    def test_create_sink(self):
+        testSink = createBulkSink(self.mockClient)
+        self.assertEqual(testSink.chunkBytes, 1000)
+        self.assertEqual(testSink.maxRetries, 5)
+        self.assertEqual(testSink.retryBackoff, 0.5)
+        self.assertEqual(testSink.maxRetryBackoff, 10)
+        self.assertIsInstance(testSink.controller, ChunkController)
+
+    def test_chunk_by_count(self):
+        testSink = self.createSink(chunkSize=2)
+        actions = iter([buildAction(str(i)) for i in range(5)])
+        chunks = []
+        chunk = testSink.nextChunk(actions)
+        while chunk is not None:
+            chunks.append(chunk)
+            chunk = testSink.nextChunk(actions)
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 2, 1])
+        self.assertEqual(json.loads(chunks[0][0].lines[0]), {
+            'index': {'_index': 'test', '_type': 'doc', '_id': '0'}
+        })
+        self.assertEqual(json.loads(chunks[0][0].lines[1]), {'title': 'Test'})
+
+    def test_chunk_by_bytes(self):
+        testSink = self.createSink(chunkBytes=200)
+        actions = iter([
+            buildAction('1'), buildAction('2'), buildAction('3', 'x' * 300),
+            buildAction('4')
+        ])
+        chunks = []
+        chunk = testSink.nextChunk(actions)
+        while chunk is not None:
+            chunks.append(chunk)
+            chunk = testSink.nextChunk(actions)
+
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1, 1])
+
+    def test_shared_source_serialized_once(self):
+        testSink = self.createSink()
+        testSource = {'title': 'Test'}
+        testSink.serializer = MagicMock(wraps=JSONSerializer())
+        actions = iter([
+            {'_index': 'test', '_id': '1', '_source': testSource},
+            {'_index': 'test_v2', '_id': '1', '_source': testSource},
+            buildAction('2')
+        ])
+        chunk = testSink.nextChunk(actions)
+        self.assertEqual(chunk[0].lines[1], chunk[1].lines[1])
+        self.assertEqual(json.loads(chunk[1].lines[0])['index']['_index'], 'test_v2')
+        self.assertEqual(testSink.serializer.dumps.call_count, 5)
+
+    def test_write(self):
+        testSink = self.createSink(chunkSize=2)
+        results = list(testSink.write([buildAction(str(i)) for i in range(5)]))
+        self.assertEqual(
+            [item['index']['_id'] for _, item in results],
+            ['0', '1', '2', '3', '4']
+        )
+        self.assertTrue(all(ok for ok, _ in results))
+        self.assertEqual(self.mockClient.bulk.call_count, 3)
+
+    def test_write_errors(self):
+        testSink = self.createSink(chunkSize=2)
+        results = []
+        with self.assertRaises(BulkIndexError) as err:
+            for result in testSink.write([
+                buildAction('1'), buildAction('bad2'), buildAction('3')
+            ]):
+                results.append(result)
+
+        self.assertEqual([ok for ok, _ in results], [True, False, True])
+        self.assertEqual(len(err.exception.errors), 1)
+
+    def test_write_no_raise(self):
+        testSink = self.createSink()
+        results = list(testSink.write([buildAction('bad1')], raiseOnError=False))
+        self.assertEqual(results, [
+            (False, {'index': {'_id': 'bad1', 'status': 400}})
+        ])
+
+    def test_write_retries_rejected(self):
+        responses = [
+            {'items': [
+                {'index': {'_id': '1', 'status': 201}},
+                {'index': {'_id': '2', 'status': 503}}
+            ]},
+            {'items': [{'index': {'_id': '2', 'status': 201}}]}
+        ]
+        self.mockClient.bulk.side_effect = responses
+        testSink = self.createSink()
+        results = list(testSink.write([buildAction('1'), buildAction('2')]))
+        self.assertEqual(
+            [(ok, item['index']['_id']) for ok, item in results],
+            [(True, '1'), (True, '2')]
+        )
+        self.assertEqual(self.mockClient.bulk.call_count, 2)
+
+    def test_write_rejected_retries_exhausted(self):
+        testSink = self.createSink(maxRetries=2)
+        results = list(testSink.write([buildAction('busy1')], raiseOnError=False))
+        self.assertEqual(results, [
+            (False, {'index': {'_id': 'busy1', 'status': 429}})
+        ])
+        self.assertEqual(self.mockClient.bulk.call_count, 3)
+
+    def test_write_timeout(self):
+        self.mockClient.bulk.side_effect = [
+            ConnectionTimeout('TIMEOUT', 'timed out', None),
+            {'items': [{'index': {'_id': '1', 'status': 201}}]}
+        ]
+        testSink = self.createSink()
+        testSink.controller.targetLatency = 2
+        testSink.controller.backOff = MagicMock()
+        results = list(testSink.write([buildAction('1')]))
+        self.assertEqual(results, [(True, {'index': {'_id': '1', 'status': 201}})])
+        testSink.controller.backOff.assert_called_once()
+
+    def test_write_timeout_retries_exhausted(self):
+        self.mockClient.bulk.side_effect = ConnectionTimeout(
+            'TIMEOUT', 'timed out', None
+        )
+        testSink = self.createSink(maxRetries=0)
+        results = list(testSink.write([buildAction('1')], raiseOnError=False))
+        self.assertEqual(results, [(False, {'index': {
+            '_index': 'test', '_type': 'doc', '_id': '1', 'status': 408,
+            'error': 'Bulk request timed out'
+        }})])
+
+    def test_write_request_rejected(self):
+        self.mockClient.bulk.side_effect = [
+            TransportError(429, 'es_rejected_execution_exception', {}),
+            TransportError(503, 'unavailable', {}),
+            {'items': [{'index': {'_id': '1', 'status': 201}}]}
+        ]
+        testSink = self.createSink(retryBackoff=0)
+        testSink.controller.targetLatency = 2
+        testSink.controller.backOff = MagicMock()
+        results = list(testSink.write([buildAction('1')]))
+        self.assertEqual(results, [(True, {'index': {'_id': '1', 'status': 201}})])
+        self.assertEqual(testSink.controller.backOff.call_count, 2)
+
+    def test_write_connection_error_retries_exhausted(self):
+        self.mockClient.bulk.side_effect = ConnectionError(
+            'N/A', 'connection refused', None
+        )
+        testSink = self.createSink(maxRetries=1, retryBackoff=0)
+        results = list(testSink.write([buildAction('1')], raiseOnError=False))
+        self.assertEqual(self.mockClient.bulk.call_count, 2)
+        self.assertEqual(
+            [(ok, item['index']['status']) for ok, item in results],
+            [(False, 503)]
+        )
+
+    def test_write_request_error(self):
+        self.mockClient.bulk.side_effect = TransportError(400, 'bad', {})
+        testSink = self.createSink()
+        with self.assertRaises(TransportError):
+            list(testSink.write([buildAction('1')]))
+
+    @patch('lib.bulkManager.random.uniform', side_effect=lambda low, high: high)
+    def test_retry_backoff(self, mock_uniform):
+        testSink = self.createSink(
+            maxRetries=5, retryBackoff=1, maxRetryBackoff=5
+        )
+        testEntries = [MagicMock(attempts=0) for _ in range(2)]
+        with patch('lib.bulkManager.time.monotonic', return_value=100):
+            for _ in range(4):
+                testSink._retry(testEntries[0])
+            testSink._retry(testEntries[1])
+
+        self.assertEqual(
+            sorted(readyAt for readyAt, _, _ in testSink.retries),
+            [101, 101, 102, 104, 105]
+        )
+        self.assertEqual(testEntries[0].attempts, 4)
+
+    def test_retries_do_not_stall_stream(self):
+        self.mockClient.bulk.side_effect = [
+            {'items': [{'index': {'_id': '1', 'status': 429}}]},
+            {'items': [{'index': {'_id': '2', 'status': 201}}]},
+            {'items': [{'index': {'_id': '1', 'status': 201}}]}
+        ]
+        testSink = self.createSink(chunkSize=1, concurrency=1, retryBackoff=0.2)
+        results = list(testSink.write([buildAction('1'), buildAction('2')]))
+        self.assertEqual(
+            [item['index']['_id'] for _, item in results], ['2', '1']
+        )
+
+    def writeAsync(self, testSink, batches):
+        async def runWrite():
+            queue = asyncio.Queue()
+            for batch in batches:
+                queue.put_nowait(batch)
+            queue.put_nowait(None)
+
+            async def send(chunk):
+                return testSink.sendChunk(chunk)
+
+            return [result async for result in testSink.writeAsync(queue, send)]
+
+        return asyncio.run(runWrite())
+
+    def test_write_async(self):
+        testSink = self.createSink(chunkSize=2)
+        results = self.writeAsync(testSink, [
+            [buildAction('1'), buildAction('2'), buildAction('3')],
+            [buildAction('bad4')]
+        ])
+        self.assertEqual(
+            sorted((ok, item['index']['_id']) for ok, item in results),
+            [(False, 'bad4'), (True, '1'), (True, '2'), (True, '3')]
+        )
+        self.assertEqual(self.mockClient.bulk.call_count, 2)
+
+    def test_write_async_retries_rejected(self):
+        self.mockClient.bulk.side_effect = [
+            {'items': [{'index': {'_id': '1', 'status': 429}}]},
+            {'items': [{'index': {'_id': '1', 'status': 201}}]}
+        ]
+        testSink = self.createSink()
+        results = self.writeAsync(testSink, [[buildAction('1')]])
+        self.assertEqual(results, [(True, {'index': {'_id': '1', 'status': 201}})])
+        self.assertEqual(self.mockClient.bulk.call_count, 2)
+
+    def test_write_async_retries_request_rejected(self):
+        asyncClient = MagicMock()
+
+        async def mockBulk(body):
+            return self.mockClient.bulk(body)
+        asyncClient.bulk = mockBulk
+        self.mockClient.bulk.side_effect = [
+            TransportError(503, 'unavailable', {}),
+            {'items': [{'index': {'_id': '1', 'status': 201}}]}
+        ]
+        testSink = self.createSink(retryBackoff=0)
+
+        async def runWrite():
+            queue = asyncio.Queue()
+            queue.put_nowait([buildAction('1')])
+            queue.put_nowait(None)
+
+            async def send(chunk):
+                return await testSink.sendChunkAsync(chunk, asyncClient)
+
+            return [result async for result in testSink.writeAsync(queue, send)]
+
+        results = asyncio.run(runWrite())
+        self.assertEqual(results, [(True, {'index': {'_id': '1', 'status': 201}})])
+        self.assertEqual(self.mockClient.bulk.call_count, 2)
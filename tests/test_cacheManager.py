@@ -0,0 +1,70 @@
+import unittest
+from unittest.mock import patch, MagicMock
+from types import SimpleNamespace
+from datetime import datetime
+
+from lib.cacheManager import createDocCache, DocCache
+
+
+class TestCacheManager(unittest.TestCase):
+    @patch.dict('os.environ', {'DOC_CACHE_SIZE': '5'})
+    def test_create_cache(self):
+        testCache = createDocCache()
+        self.assertEqual(testCache.maxSize, 5)
+
+    @patch.dict('os.environ', {'DOC_CACHE_SIZE': '0'})
+    def test_create_cache_disabled(self):
+        self.assertEqual(createDocCache(), None)
+
+    def test_fetch_hit_returns_copy(self):
+        testCache = DocCache(5)
+        mockBuild = MagicMock(return_value={'name': 'test'})
+        testRec = SimpleNamespace(id=1, date_modified=datetime(2019, 1, 1))
+
+        firstDoc = testCache.fetch('agent', testRec, mockBuild, dict)
+        secondDoc = testCache.fetch('agent', testRec, mockBuild, dict)
+
+        mockBuild.assert_called_once_with(testRec)
+        self.assertEqual(firstDoc, {'name': 'test'})
+        self.assertEqual(secondDoc, {'name': 'test'})
+        self.assertIsNot(firstDoc, secondDoc)
+        self.assertEqual(testCache.hits, 1)
+        self.assertEqual(testCache.misses, 1)
+
+    def test_fetch_keyed_on_type_and_modified(self):
+        testCache = DocCache(5)
+        mockBuild = MagicMock(return_value={})
+
+        testCache.fetch('agent', SimpleNamespace(id=1), mockBuild, dict)
+        testCache.fetch('language', SimpleNamespace(id=1), mockBuild, dict)
+        testCache.fetch(
+            'agent', SimpleNamespace(id=1, date_modified=datetime(2019, 1, 1)),
+            mockBuild, dict
+        )
+        self.assertEqual(mockBuild.call_count, 3)
+        self.assertEqual(testCache.misses, 3)
+
+    def test_fetch_no_id(self):
+        testCache = DocCache(5)
+        mockBuild = MagicMock(return_value={})
+
+        testCache.fetch('agent', SimpleNamespace(), mockBuild, dict)
+        testCache.fetch('agent', SimpleNamespace(), mockBuild, dict)
+        self.assertEqual(mockBuild.call_count, 2)
+        self.assertEqual(len(testCache.docs), 0)
+
+    def test_fetch_evicts_least_recent(self):
+        testCache = DocCache(2)
+        mockBuild = MagicMock(return_value={})
+        recs = [SimpleNamespace(id=i) for i in range(3)]
+
+        testCache.fetch('agent', recs[0], mockBuild, dict)
+        testCache.fetch('agent', recs[1], mockBuild, dict)
+        testCache.fetch('agent', recs[0], mockBuild, dict)
+        testCache.fetch('agent', recs[2], mockBuild, dict)
+
+        self.assertEqual(testCache.evictions, 1)
+        self.assertEqual(
+            list(testCache.docs.keys()),
+            [('agent', 0, None), ('agent', 2, None)]
+        )
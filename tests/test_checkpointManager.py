@@ -0,0 +1,127 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import os
+import tempfile
+from datetime import datetime, timedelta
+
+from elasticsearch.exceptions import NotFoundError
+
+from lib.checkpointManager import (
+    createCheckpointStore,
+    CheckpointStore,
+    CheckpointTracker,
+    ESCheckpointStore,
+    FileCheckpointStore,
+    SQLiteCheckpointStore
+)
+from helpers.errorHelpers import CheckpointError
+
+
+class TestCheckpointManager(unittest.TestCase):
+    testMark = (datetime(2019, 6, 1, 12, 30, 15, 120), 42)
+
+    @patch.dict(os.environ, {'CHECKPOINT_BACKEND': 'none'})
+    def test_create_store_disabled(self):
+        self.assertEqual(createCheckpointStore('client', 'test'), None)
+
+    @patch.dict(os.environ, {}, clear=True)
+    def test_create_store_default(self):
+        store = createCheckpointStore('client', 'test')
+        self.assertIsInstance(store, ESCheckpointStore)
+        self.assertEqual(store.index, 'test_checkpoints')
+        self.assertEqual(store.name, 'test')
+
+    @patch.dict(os.environ, {'CHECKPOINT_BACKEND': 'bad'})
+    def test_create_store_invalid(self):
+        with self.assertRaises(CheckpointError):
+            createCheckpointStore('client', 'test')
+
+    def test_file_store(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            store = FileCheckpointStore(os.path.join(tmpDir, 'cp.json'), 'test')
+            self.assertEqual(store.load(), None)
+            store.save(self.testMark)
+            self.assertEqual(store.load(), self.testMark)
+            otherStore = FileCheckpointStore(store.path, 'other')
+            self.assertEqual(otherStore.load(), None)
+
+    def test_sqlite_store(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            store = SQLiteCheckpointStore(os.path.join(tmpDir, 'cp.db'), 'test')
+            self.assertEqual(store.load(), None)
+            store.save(self.testMark)
+            store.save(self.testMark)
+            self.assertEqual(store.load(), self.testMark)
+
+    def test_es_store(self):
+        mockClient = MagicMock()
+        store = ESCheckpointStore(mockClient, 'test_checkpoints', 'test')
+        store.save(self.testMark)
+        savedBody = mockClient.index.call_args[1]['body']
+        self.assertEqual(savedBody['id'], 42)
+
+        mockClient.get.return_value = {'_source': savedBody}
+        self.assertEqual(store.load(), self.testMark)
+
+    def test_es_store_missing(self):
+        mockClient = MagicMock()
+        mockClient.get.side_effect = NotFoundError
+        store = ESCheckpointStore(mockClient, 'test_checkpoints', 'test')
+        self.assertEqual(store.load(), None)
+
+    def test_store_incomplete_backend(self):
+        class LoadOnlyStore(CheckpointStore):
+            def load(self):
+                return None
+
+        with self.assertRaises(TypeError):
+            LoadOnlyStore('test')
+
+    def test_tracker_advances_contiguous(self):
+        tracker = CheckpointTracker(MagicMock())
+        for workID in range(1, 4):
+            tracker.add(workID, ('date{}'.format(workID), workID))
+            tracker.bind('uuid{}'.format(workID), workID)
+
+        tracker.complete('uuid2')
+        self.assertEqual(tracker.mark, None)
+        tracker.complete('uuid1')
+        self.assertEqual(tracker.mark, ('date2', 2))
+        tracker.complete('uuid3')
+        self.assertEqual(tracker.mark, ('date3', 3))
+
+        tracker.save()
+        tracker.store.save.assert_called_once_with(('date3', 3))
+
+    def test_tracker_waits_for_copies(self):
+        tracker = CheckpointTracker(MagicMock())
+        tracker.add(1, ('date1', 1))
+        tracker.bind('uuid1', 1)
+        tracker.bind('uuid1', 1)
+        tracker.complete('uuid1')
+        self.assertEqual(tracker.mark, None)
+        tracker.complete('uuid1')
+        self.assertEqual(tracker.mark, ('date1', 1))
+
+    def test_tracker_no_progress(self):
+        tracker = CheckpointTracker(MagicMock())
+        tracker.add(1, ('date1', 1))
+        tracker.complete('unknown')
+        tracker.save()
+        tracker.store.save.assert_not_called()
+
+    def test_tracker_lag(self):
+        tracker = CheckpointTracker(MagicMock(), lag=300)
+        recent = datetime.utcnow()
+        tracker.add(1, (datetime(2019, 1, 1), 1))
+        tracker.add(2, (recent, 2))
+        tracker.skip(1)
+        tracker.save()
+        tracker.store.save.assert_called_once_with((datetime(2019, 1, 1), 1))
+
+        tracker.skip(2)
+        tracker.save()
+        cutoff, workID = tracker.store.save.call_args[0][0]
+        self.assertLess(cutoff, recent - timedelta(seconds=299))
+        self.assertEqual(workID, 0)
+        self.assertEqual(tracker.mark, (recent, 2))
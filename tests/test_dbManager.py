@@ -1,6 +1,7 @@
 import unittest
 from unittest.mock import patch, Mock, MagicMock, call
 import os
+from datetime import datetime
 
 from helpers.errorHelpers import DBError, DataError
 
@@ -10,7 +11,21 @@ os.environ['DB_HOST'] = 'test'
 os.environ['DB_PORT'] = 'test'
 os.environ['DB_NAME'] = 'test'
 
-from lib.dbManager import retrieveRecords
+from lib.dbManager import (
+    retrieveRecords,
+    retrieveGraphChanges,
+    _addFormerParents,
+    _mergeChanges,
+    retrieveWorkRange,
+    retrieveIDBounds,
+    exportSnapshot,
+    importSnapshot,
+    retrieveWorkIDs,
+    retrieveVersions,
+    streamWorkUUIDs,
+    retrieveExistingUUIDs,
+    loadWorks
+)
 
 
 class TestDBManager(unittest.TestCase):
@@ -18,9 +33,256 @@ class TestDBManager(unittest.TestCase):
     @patch.dict(os.environ, {'INDEX_PERIOD': '5', 'ES_INDEX': 'test'})
     def test_get_records(self):
         mockSession = MagicMock()
-        mockSession.query.return_value.yield_per.return_value.filter.return_value.all.return_value = [
-            'work1',
-            'work2'
+        mockSession.query.return_value.filter.return_value.order_by.return_value.limit.return_value.all.return_value = [
+            ('work1',),
+            ('work2',)
         ]
         res = list(retrieveRecords(mockSession))
+        self.assertEqual(res, [[('work1',), ('work2',)]])
+
+    def test_get_records_full_scan(self):
+        mockSession = MagicMock()
+        mockWindow = mockSession.query.return_value
+        mockWindow.order_by.return_value.limit.return_value.all.return_value = [
+            ('work1',)
+        ]
+        res = list(retrieveRecords(mockSession, fullScan=True))
+        self.assertEqual(res, [[('work1',)]])
+        mockWindow.filter.assert_not_called()
+
+    @patch.dict(os.environ, {'INDEX_PERIOD': '5', 'ES_INDEX': 'test'})
+    def test_get_records_paged(self):
+        mockSession = MagicMock()
+        mockWindow = mockSession.query.return_value.filter.return_value
+        mockWindow.order_by.return_value.limit.return_value.all.return_value = [
+            (1, 'date1'), (2, 'date2')
+        ]
+        mockPage = mockWindow.filter.return_value.order_by.return_value.limit.return_value
+        mockPage.all.side_effect = [[(3, 'date3'), (4, 'date4')], [(5, 'date5')]]
+        res = list(retrieveRecords(mockSession, pageSize=2))
+        self.assertEqual(res, [
+            [(1, 'date1'), (2, 'date2')],
+            [(3, 'date3'), (4, 'date4')],
+            [(5, 'date5')]
+        ])
+        mockWindow.order_by.return_value.limit.assert_called_once_with(2)
+        self.assertEqual(mockPage.all.call_count, 2)
+
+    @patch.dict(os.environ, {'INDEX_PERIOD': '5', 'INDEX_BATCH_SIZE': '50'})
+    def test_get_records_empty(self):
+        mockSession = MagicMock()
+        mockWindow = mockSession.query.return_value.filter.return_value
+        mockWindow.order_by.return_value.limit.return_value.all.return_value = []
+        res = list(retrieveRecords(mockSession))
+        self.assertEqual(res, [])
+        mockWindow.order_by.return_value.limit.assert_called_once_with(50)
+
+    @patch.dict(os.environ, {'INDEX_PERIOD': '5'})
+    def test_get_records_from_checkpoint(self):
+        mockSession = MagicMock()
+        mockWindow = mockSession.query.return_value
+        mockWindow.filter.return_value.order_by.return_value.limit.return_value.all.return_value = [
+            (7, datetime(2019, 1, 1))
+        ]
+        res = list(retrieveRecords(
+            mockSession, checkpoint=(datetime(2018, 1, 1), 6)
+        ))
+        self.assertEqual(res, [[(7, datetime(2019, 1, 1))]])
+        mockWindow.filter.assert_called_once()
+
+    @patch.dict(os.environ, {'INDEX_PERIOD': '5', 'INDEX_CHANGE_SCOPE': 'graph'})
+    @patch('lib.dbManager.retrieveGraphChanges')
+    def test_get_records_graph_scope(self, mock_changes):
+        mock_changes.return_value = iter([[(1, 'date1')]])
+        mockSession = MagicMock()
+        res = list(retrieveRecords(mockSession, pageSize=2))
+        self.assertEqual(res, [[(1, 'date1')]])
+        mock_changes.assert_called_once_with(mockSession, 2, None, None)
+
+    @patch.dict(os.environ, {'INDEX_CHANGE_SCOPE': 'graph'})
+    @patch('lib.dbManager.retrieveGraphChanges')
+    def test_get_records_graph_scope_full_scan(self, mock_changes):
+        mockSession = MagicMock()
+        mockWindow = mockSession.query.return_value
+        mockWindow.order_by.return_value.limit.return_value.all.return_value = []
+        self.assertEqual(list(retrieveRecords(mockSession, fullScan=True)), [])
+        mock_changes.assert_not_called()
+
+    @patch.dict(os.environ, {'INDEX_PERIOD': '5'})
+    @patch('lib.dbManager._addFormerParents')
+    @patch('lib.dbManager._createGraphChanges')
+    def test_get_graph_changes(self, mock_create, mock_former):
+        mockSession = MagicMock()
+        mockQuery = mockSession.query.return_value
+        mockQuery.order_by.return_value.limit.return_value.all.return_value = [
+            (1, datetime(2019, 1, 1)), (2, datetime(2019, 1, 2))
+        ]
+        mockPage = mockQuery.filter.return_value.order_by.return_value.limit.return_value
+        mockPage.all.return_value = [(3, datetime(2019, 1, 3))]
+        res = list(retrieveGraphChanges(mockSession, 2))
+        self.assertEqual(res, [
+            [(1, datetime(2019, 1, 1)), (2, datetime(2019, 1, 2))],
+            [(3, datetime(2019, 1, 3))]
+        ])
+        # The change set is built once for the window and dropped at the end
+        mock_create.assert_called_once()
+        mock_create.return_value.drop.assert_called_once()
+        mock_former.assert_not_called()
+
+    @patch('lib.dbManager._addFormerParents')
+    @patch('lib.dbManager._createGraphChanges')
+    def test_get_graph_changes_from_checkpoint(self, mock_create, mock_former):
+        mockSession = MagicMock()
+        mockQuery = mockSession.query.return_value
+        mockQuery.filter.return_value.order_by.return_value.limit.return_value.all.return_value = []
+        formerParents = MagicMock()
+        res = list(retrieveGraphChanges(
+            mockSession, 2, checkpoint=(datetime(2018, 1, 1), 6),
+            formerParents=formerParents
+        ))
+        self.assertEqual(res, [])
+        mock_create.assert_called_once_with(mockSession, datetime(2018, 1, 1))
+        mock_former.assert_called_once_with(
+            mockSession, mock_create.return_value, datetime(2018, 1, 1),
+            formerParents, 2
+        )
+        mockQuery.filter.assert_called_once()
+        mock_create.return_value.drop.assert_called_once()
+
+    @patch('lib.dbManager._mergeChanges')
+    def test_add_former_parents(self, mock_merge):
+        mockSession = MagicMock()
+        mockQuery = mockSession.query.return_value
+        mockInstances = mockQuery.select_from.return_value.join.return_value.filter.return_value
+        mockInstances.order_by.return_value.limit.return_value.all.return_value = [
+            (1, datetime(2019, 1, 1), 'UUID-A'), (2, datetime(2019, 1, 2), 'uuid-b')
+        ]
+        mockQuery.filter.return_value.all.return_value = [(9, 'uuid-c')]
+        formerParents = MagicMock(return_value={'uuid-c': [1, 2]})
+
+        _addFormerParents(mockSession, 'changes', datetime(2019, 1, 1), formerParents, 5)
+        formerParents.assert_called_once_with({1: 'uuid-a', 2: 'uuid-b'})
+        mock_merge.assert_called_once_with(
+            mockSession, 'changes', {9: datetime(2019, 1, 2)}
+        )
+
+    def test_merge_changes(self):
+        mockSession = MagicMock()
+        mockSession.query.return_value.filter.return_value.all.return_value = [
+            (9, datetime(2019, 1, 1)), (10, datetime(2019, 1, 5))
+        ]
+        mockChanges = MagicMock()
+        _mergeChanges(mockSession, mockChanges, {
+            9: datetime(2019, 1, 2), 10: datetime(2019, 1, 3),
+            11: datetime(2019, 1, 3)
+        })
+        # Work 9 is moved later, work 10 is kept and work 11 is added
+        mockChanges.update.assert_called_once()
+        mockChanges.insert.return_value.values.assert_called_once_with(
+            work_id=11, modified=datetime(2019, 1, 3)
+        )
+        self.assertEqual(mockSession.execute.call_count, 2)
+
+    def test_get_work_range(self):
+        mockSession = MagicMock()
+        mockPage = mockSession.query.return_value.filter.return_value.order_by.return_value.limit.return_value
+        mockPage.all.side_effect = [[(2, 'date2'), (5, 'date5')], [(7, 'date7')]]
+        res = list(retrieveWorkRange(mockSession, 1, 10, pageSize=2))
+        self.assertEqual(res, [[(2, 'date2'), (5, 'date5')], [(7, 'date7')]])
+        self.assertEqual(mockPage.all.call_count, 2)
+
+    def test_get_work_range_empty(self):
+        mockSession = MagicMock()
+        self.assertEqual(list(retrieveWorkRange(mockSession, 10, 10)), [])
+        mockSession.query.assert_not_called()
+
+    def test_get_id_bounds(self):
+        mockSession = MagicMock()
+        mockSession.query.return_value.one.return_value = (1, 100)
+        self.assertEqual(retrieveIDBounds(mockSession), (1, 100))
+
+    def test_export_snapshot(self):
+        mockSession = MagicMock()
+        mockSession.execute.return_value.scalar.return_value = 'snap-1'
+        self.assertEqual(exportSnapshot(mockSession), 'snap-1')
+        mockSession.rollback.assert_called_once()
+        statements = [str(c[0][0]) for c in mockSession.execute.call_args_list]
+        self.assertEqual(statements, [
+            'SET TRANSACTION ISOLATION LEVEL REPEATABLE READ',
+            'SELECT pg_export_snapshot()'
+        ])
+
+    def test_import_snapshot(self):
+        mockSession = MagicMock()
+        importSnapshot(mockSession, 'snap-1')
+        mockSession.rollback.assert_called_once()
+        statement, params = mockSession.execute.call_args[0]
+        self.assertEqual(str(statement), 'SET TRANSACTION SNAPSHOT :snapshot')
+        self.assertEqual(params, {'snapshot': 'snap-1'})
+
+    def test_get_work_ids(self):
+        mockSession = MagicMock()
+        mockWork = mockSession.query.return_value.filter.return_value
+        mockWork.union.return_value.order_by.return_value.all.return_value = [
+            (1, 'date1'), (2, 'date2')
+        ]
+        res = retrieveWorkIDs(mockSession, {'work': {'uuid1'}, 'item': {3}})
+        self.assertEqual(res, [(1, 'date1'), (2, 'date2')])
+        self.assertEqual(mockSession.query.call_count, 2)
+        mockWork.union.assert_called_once()
+
+    def test_get_work_ids_empty(self):
+        mockSession = MagicMock()
+        self.assertEqual(retrieveWorkIDs(mockSession, {}), [])
+        mockSession.query.assert_not_called()
+
+    def test_get_versions(self):
+        mockSession = MagicMock()
+        mockWork = mockSession.query.return_value.filter.return_value
+        mockWork.union_all.return_value.all.return_value = [
+            (1, datetime(2019, 1, 1)), (2, datetime(2019, 1, 2)),
+            (1, datetime(2019, 2, 1)), (1, None)
+        ]
+        res = retrieveVersions(mockSession, [1, 2])
+        self.assertEqual(res, {
+            1: datetime(2019, 2, 1), 2: datetime(2019, 1, 2)
+        })
+        self.assertGreater(len(mockWork.union_all.call_args[0]), 10)
+
+    def test_stream_work_uuids(self):
+        mockSession = MagicMock()
+        mockQuery = mockSession.query.return_value
+        mockQuery.order_by.return_value.limit.return_value.all.return_value = [
+            ('UUID1',), ('uuid2',)
+        ]
+        mockPage = mockQuery.filter.return_value.order_by.return_value.limit.return_value
+        mockPage.all.return_value = [('uuid3',)]
+        res = list(streamWorkUUIDs(mockSession, pageSize=2))
+        self.assertEqual(res, ['uuid1', 'uuid2', 'uuid3'])
+        mockQuery.filter.assert_called_once()
+
+    def test_stream_work_uuids_after(self):
+        mockSession = MagicMock()
+        mockQuery = mockSession.query.return_value
+        mockPage = mockQuery.filter.return_value.order_by.return_value.limit.return_value
+        mockPage.all.return_value = [('uuid3',)]
+        res = list(streamWorkUUIDs(mockSession, pageSize=2, after='uuid2'))
+        self.assertEqual(res, ['uuid3'])
+        mockQuery.order_by.assert_not_called()
+
+    def test_get_existing_uuids(self):
+        mockSession = MagicMock()
+        mockSession.query.return_value.filter.return_value.all.return_value = [
+            ('uuid1',)
+        ]
+        res = retrieveExistingUUIDs(mockSession, ['uuid1', 'uuid2'])
+        self.assertEqual(res, {'uuid1'})
+
+    def test_load_works(self):
+        mockSession = MagicMock()
+        mockQuery = mockSession.query.return_value.options.return_value
+        mockQuery.filter.return_value.all.return_value = ['work1', 'work2']
+        res = loadWorks(mockSession, [1, 2])
         self.assertEqual(res, ['work1', 'work2'])
+        loadOptions = mockSession.query.return_value.options.call_args[0]
+        self.assertGreater(len(loadOptions), 10)
@@ -0,0 +1,154 @@
+import unittest
+from unittest.mock import patch
+import gzip
+import json
+import os
+import tempfile
+
+from botocore.exceptions import ClientError
+
+from lib.deadLetterManager import (
+    createDeadLetterSpool,
+    DeadLetterSpool,
+    S3DeadLetterSpool
+)
+
+
+class TestDeadLetterManager(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.TemporaryDirectory()
+        self.spoolPath = os.path.join(self.tmpDir.name, 'letters.ndjson.gz')
+
+    def tearDown(self):
+        self.tmpDir.cleanup()
+
+    def test_create_spool_default(self):
+        testSpool = createDeadLetterSpool('test')
+        self.assertIsInstance(testSpool, DeadLetterSpool)
+        self.assertEqual(
+            os.path.basename(testSpool.path), 'test_dead_letters.ndjson.gz'
+        )
+
+    @patch('lib.deadLetterManager.createAWSClient')
+    @patch.dict('os.environ', {'DEAD_LETTER_BUCKET': 'bucket'})
+    def test_create_spool_s3(self, mock_client):
+        testSpool = createDeadLetterSpool('test')
+        self.assertIsInstance(testSpool, S3DeadLetterSpool)
+        self.assertEqual(testSpool.bucket, 'bucket')
+        self.assertEqual(testSpool.prefix, 'test/dead_letters/')
+
+    def test_flush_and_read(self):
+        testSpool = DeadLetterSpool(self.spoolPath)
+        testSpool.add('uuid1', {'index': {'status': 400}})
+        testSpool.flush()
+        testSpool.add('uuid2', {'index': {'status': 500}})
+        testSpool.flush()
+
+        self.assertEqual(testSpool.letters, [])
+        letters = testSpool.read()
+        self.assertEqual(
+            [letter['id'] for letter in letters], ['uuid1', 'uuid2']
+        )
+        self.assertEqual(letters[0]['error'], {'index': {'status': 400}})
+
+        with gzip.open(self.spoolPath, 'rt') as spoolFile:
+            self.assertEqual(json.loads(spoolFile.readline())['id'], 'uuid1')
+
+    def test_flush_empty(self):
+        testSpool = DeadLetterSpool(self.spoolPath)
+        testSpool.flush()
+        self.assertFalse(os.path.exists(self.spoolPath))
+
+    def test_read_missing_and_clear(self):
+        testSpool = DeadLetterSpool(self.spoolPath)
+        self.assertEqual(testSpool.read(), [])
+        testSpool.add('uuid1', {})
+        testSpool.flush()
+        testSpool.clear()
+        self.assertEqual(testSpool.read(), [])
+        testSpool.clear()
+
+    def mockS3(self, mock_client, objects):
+        """Back the mocked S3 client with a dict of gzipped spool objects"""
+        s3 = mock_client.return_value
+
+        def upload(path, bucket, key):
+            with open(path, 'rb') as spoolFile:
+                objects[key] = spoolFile.read()
+
+        def download(bucket, key, path):
+            if key not in objects:
+                raise ClientError({'Error': {'Code': '404'}}, 'GetObject')
+            with open(path, 'wb') as spoolFile:
+                spoolFile.write(objects[key])
+
+        s3.upload_file.side_effect = upload
+        s3.download_file.side_effect = download
+        s3.get_paginator.return_value.paginate.side_effect = lambda **kw: [
+            {'Contents': [{'Key': key} for key in sorted(objects)]}
+        ]
+        return s3
+
+    @patch('lib.deadLetterManager.createAWSClient')
+    def test_s3_flush(self, mock_client):
+        objects = {}
+        s3 = self.mockS3(mock_client, objects)
+        testSpool = S3DeadLetterSpool(self.spoolPath, 'bucket', 'letters/')
+        testSpool.add('uuid1', {})
+        testSpool.flush()
+        testSpool.add('uuid2', {})
+        testSpool.flush()
+
+        # Each flush writes its own object, without reading the others
+        self.assertEqual(len(objects), 2)
+        self.assertTrue(all(key.startswith('letters/') for key in objects))
+        s3.download_file.assert_not_called()
+        self.assertFalse(os.path.exists(self.spoolPath))
+        self.assertEqual(
+            [letter['id'] for letter in testSpool.read()],
+            ['uuid1', 'uuid2']
+        )
+
+    @patch('lib.deadLetterManager.createAWSClient')
+    def test_s3_clear_read_keys(self, mock_client):
+        objects = {}
+        s3 = self.mockS3(mock_client, objects)
+        testSpool = S3DeadLetterSpool(self.spoolPath, 'bucket', 'letters/')
+        testSpool.add('uuid1', {})
+        testSpool.flush()
+        readKey = list(objects)[0]
+        self.assertEqual(len(testSpool.read()), 1)
+
+        # Letters flushed after the spool was read are not cleared
+        otherSpool = S3DeadLetterSpool(self.spoolPath, 'bucket', 'letters/')
+        otherSpool.add('uuid2', {})
+        otherSpool.flush()
+        testSpool.clear()
+        s3.delete_objects.assert_called_once_with(
+            Bucket='bucket', Delete={'Objects': [{'Key': readKey}]}
+        )
+        testSpool.clear()
+        s3.delete_objects.assert_called_once()
+
+    @patch('lib.deadLetterManager.createAWSClient')
+    def test_s3_read_deleted_object(self, mock_client):
+        s3 = self.mockS3(mock_client, {})
+        s3.get_paginator.return_value.paginate.side_effect = lambda **kw: [
+            {'Contents': [{'Key': 'letters/gone'}]}
+        ]
+        testSpool = S3DeadLetterSpool(self.spoolPath, 'bucket', 'letters/')
+        self.assertEqual(testSpool.read(), [])
+        self.assertEqual(testSpool.readKeys, [])
+
+    @patch('lib.deadLetterManager.createAWSClient')
+    def test_s3_download_error(self, mock_client):
+        s3 = self.mockS3(mock_client, {})
+        s3.get_paginator.return_value.paginate.side_effect = lambda **kw: [
+            {'Contents': [{'Key': 'letters/denied'}]}
+        ]
+        s3.download_file.side_effect = ClientError(
+            {'Error': {'Code': '403'}}, 'GetObject'
+        )
+        testSpool = S3DeadLetterSpool(self.spoolPath, 'bucket', 'letters/')
+        with self.assertRaises(ClientError):
+            testSpool.read()
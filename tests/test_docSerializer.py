@@ -0,0 +1,124 @@
+import unittest
+import os
+from types import SimpleNamespace
+
+os.environ['ES_INDEX'] = 'test'
+
+from sfrCore import Work as DBWork
+
+from model.elasticDocs import Work
+from lib.docSerializer import (
+    ModelSerializer,
+    serializeWork,
+    serializeLink,
+    serializeCover,
+    mergeAgents,
+    hashDocument
+)
+from lib.esManager import ESDoc
+from lib.cacheManager import DocCache
+from scripts.fixtures import buildWorks
+
+
+class TestDocSerializer(unittest.TestCase):
+
+    def test_model_fields(self):
+        workFields = ModelSerializer(Work, DBWork)
+        self.assertIn('uuid', workFields.fields)
+        self.assertNotIn('language', workFields.fields)
+        self.assertEqual(workFields.dateFields, ['issued', 'created'])
+
+    def test_extract_skips_empty(self):
+        workFields = ModelSerializer(Work, DBWork)
+        testRec = SimpleNamespace(**{field: None for field in workFields.fields})
+        testRec.title = 'Test Title'
+        testRec.medium = ''
+        self.assertEqual(
+            workFields.extract(testRec), {'title': 'Test Title', 'medium': ''}
+        )
+
+    def test_insert_dates(self):
+        workFields = ModelSerializer(Work, DBWork)
+        testRec = SimpleNamespace(dates=[
+            SimpleNamespace(
+                date_type='issued', display_date='2019',
+                date_range=SimpleNamespace(lower='2019-01-01', upper=None)
+            ),
+            SimpleNamespace(
+                date_type='created', display_date='2018', date_range=None
+            ),
+            SimpleNamespace(
+                date_type='other', display_date='2017', date_range=None
+            )
+        ])
+        doc = {}
+        workFields.insertDates(testRec, doc)
+        self.assertEqual(doc, {
+            'issued': {'gte': '2019-01-01', 'lte': None},
+            'issued_display': '2019'
+        })
+
+    def test_serialize_link(self):
+        testLink = SimpleNamespace(
+            id=1, url='test/url', media_type='test', thumbnail=None,
+            flags='{"local": false, "ebook": null}'
+        )
+        self.assertEqual(serializeLink(testLink), {
+            'url': 'test/url', 'media_type': 'test', 'unique_id': 1,
+            'local': False
+        })
+
+    def test_serialize_cover(self):
+        testCover = SimpleNamespace(
+            url='testURL', media_type='image/test', flags={'cover': True}
+        )
+        self.assertEqual(
+            serializeCover(testCover),
+            {'url': 'testURL', 'media_type': 'image/test'}
+        )
+        testCover.flags = '{"cover": false}'
+        self.assertEqual(serializeCover(testCover), None)
+
+    def test_merge_agents(self):
+        testAgent = SimpleNamespace(
+            id=1, name='Author', sort_name=None, lcnaf=None, viaf=None,
+            biography=None, aliases=[], dates=[]
+        )
+        agentDocs = mergeAgents([
+            SimpleNamespace(role='author', agent=testAgent),
+            SimpleNamespace(role='illustrator', agent=testAgent),
+            SimpleNamespace(role='author', agent=testAgent)
+        ])
+        self.assertEqual(len(agentDocs), 1)
+        self.assertEqual(agentDocs[0]['roles'], ['author', 'illustrator'])
+
+    def test_hash_document(self):
+        testHash = hashDocument({'title': 'Test', 'agents': [{'name': 'a'}]})
+        self.assertEqual(
+            testHash,
+            hashDocument({'agents': [{'name': 'a'}], 'title': 'Test'})
+        )
+        self.assertEqual(testHash, hashDocument({
+            'title': 'Test', 'agents': [{'name': 'a'}],
+            'date_modified': '2019-01-01', 'content_hash': testHash
+        }))
+        self.assertNotEqual(testHash, hashDocument({'title': 'Other'}))
+
+    def test_serialize_matches_dsl(self):
+        for work in buildWorks(25):
+            esWork = ESDoc((work.id,), None, dbRec=work)
+            esWork.indexWork()
+            self.assertEqual(serializeWork(work), esWork.work.to_dict(True))
+
+    def test_serialize_cached_matches_dsl(self):
+        dslCache = DocCache(100)
+        dictCache = DocCache(100)
+        for work in buildWorks(25):
+            esWork = ESDoc((work.id,), None, dbRec=work, cache=dslCache)
+            esWork.indexWork()
+            self.assertEqual(
+                serializeWork(work, cache=dictCache),
+                esWork.work.to_dict(True)
+            )
+        self.assertGreater(dictCache.hits, 0)
+        self.assertEqual(dslCache.hits, dictCache.hits)
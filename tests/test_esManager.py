@@ -1,5 +1,6 @@
 import unittest
 import os
+from datetime import datetime
 from unittest.mock import patch, MagicMock, call
 from elasticsearch.exceptions import ConnectionError, TransportError, ConflictError
 from elasticsearch.helpers import BulkIndexError
@@ -10,9 +11,25 @@ from helpers.errorHelpers import ESError
 os.environ['ES_INDEX'] = 'test'
 
 from lib.esManager import ESConnection, ESDoc
+from lib.targetManager import IndexTarget
+from lib.cacheManager import DocCache
+from lib.docSerializer import hashDocument
 from helpers.errorHelpers import ESError
 
-@patch.dict('os.environ', {'ES_HOST': 'test', 'ES_PORT': '9200', 'ES_TIMEOUT': '60'})
+
+def mockLoadWorks(session, workIDs):
+    return [MagicMock(id=workID) for workID in workIDs]
+
+
+def mockFilterUnchanged(esActions, tracker=None):
+    return esActions
+
+
+def mockRetrieveVersions(session, workIDs):
+    return {workID: datetime(2019, 1, workID) for workID in workIDs}
+
+
+@patch.dict('os.environ', {'ES_HOST': 'test', 'ES_PORT': '9200', 'ES_TIMEOUT': '60', 'CHECKPOINT_BACKEND': 'none'})
 class TestESManager(unittest.TestCase):
     @patch('lib.esManager.ESConnection.createElasticConnection')
     @patch('lib.esManager.ESConnection.createIndex')
@@ -27,7 +44,31 @@ class TestESManager(unittest.TestCase):
     def test_connection_create(self, mock_index, mock_instance, mock_elastic):
         inst = ESConnection()
         self.assertEqual(inst.client, 'default')
-    
+        self.assertEqual(mock_elastic.call_args[1]['http_compress'], False)
+
+    @patch.dict('os.environ', {'ES_COMPRESS': 'true', 'ES_SERIALIZER': 'orjson'})
+    @patch('lib.esManager.createSerializer', return_value='serializer')
+    @patch('lib.esManager.Elasticsearch', return_value='default')
+    @patch('lib.esManager.ESConnection')
+    @patch('lib.esManager.ESConnection.createIndex')
+    def test_connection_create_options(self, mock_index, mock_instance, mock_elastic, mock_serializer):
+        ESConnection()
+        mock_elastic.assert_called_once_with(
+            hosts=[{'host': 'test', 'port': '9200'}], timeout=60,
+            serializer='serializer', http_compress=True, maxsize=10
+        )
+
+    @patch('lib.esManager.Work')
+    @patch('lib.esManager.Elasticsearch')
+    def test_health_check(self, mock_elastic, mock_work):
+        inst = ESConnection()
+        self.assertTrue(inst.indexExists)
+        mock_elastic.return_value.ping.return_value = True
+        self.assertTrue(inst.healthCheck())
+        self.assertFalse(inst.indexExists)
+        mock_elastic.return_value.ping.return_value = False
+        self.assertFalse(inst.healthCheck())
+
     client_mock = MagicMock(name='test_client')
     client_mock.indices.exists.return_value = False
 
@@ -59,46 +100,575 @@ class TestESManager(unittest.TestCase):
         self.assertIsInstance(inst.client, MagicMock)
         mock_work.init.assert_not_called()
     
-    @patch('lib.esManager.streaming_bulk', return_value=iter([(True, 1)]))
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.createBulkSink')
     @patch('lib.esManager.ESConnection.process', side_effect=[1])
     @patch('lib.esManager.Elasticsearch', return_value=client_mock)
-    def test_generate_success(self, mock_elastic, mock_process, mock_stream):
+    def test_generate_success(self, mock_elastic, mock_process, mock_sink, mock_spool):
+        mock_sink.return_value.write.return_value = iter([
+            (True, {'index': {'_id': 'uuid1'}})
+        ])
         inst = ESConnection()
         inst.generateRecords('session')
-        mock_stream.assert_has_calls([call(TestESManager.client_mock, 1)])
+        mock_sink.assert_called_once_with(TestESManager.client_mock)
+        mock_sink.return_value.write.assert_called_once_with(
+            1, raiseOnError=False
+        )
+        mock_spool.return_value.add.assert_not_called()
+
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.createBulkSink')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_generate_saves_checkpoint(self, mock_elastic, mock_sink, mock_spool):
+        inst = ESConnection()
+        inst.checkpoint = MagicMock()
+
+        def mockProcess(session, tracker, identifiers, rebuildIndex, workRange):
+            tracker.add(1, (datetime(2019, 1, 1), 1))
+            tracker.bind('uuid1', 1)
+            tracker.add(2, (datetime(2019, 1, 2), 2))
+            tracker.bind('uuid2', 2)
+            return 'actions'
+
+        mock_sink.return_value.write.return_value = iter([
+            (True, {'index': {'_id': 'uuid1'}}),
+            (False, {'index': {'_id': 'uuid2'}})
+        ])
+        with patch.object(inst, 'process', side_effect=mockProcess):
+            inst.generateRecords('session')
+        # The failed work is spooled and so does not hold back the checkpoint
+        inst.checkpoint.save.assert_called_once_with(
+            (datetime(2019, 1, 2), 2)
+        )
+
+    @patch('lib.esManager.retrieveRecords', return_value=[])
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_process_from_checkpoint(self, mock_elastic, mock_retrieve):
+        inst = ESConnection()
+        inst.checkpoint = MagicMock()
+        inst.checkpoint.load.return_value = ('date1', 1)
+        list(inst.process('session'))
+        mock_retrieve.assert_called_once_with(
+            'session', checkpoint=('date1', 1),
+            formerParents=inst.findFormerParents
+        )
     
-    @patch('lib.esManager.streaming_bulk', return_value=iter([(False, 1)]))
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.createBulkSink')
     @patch('lib.esManager.ESConnection.process', side_effect=[1])
     @patch('lib.esManager.Elasticsearch', return_value=client_mock)
-    def test_generate_failure(self, mock_elastic, mock_process, mock_stream):
+    def test_generate_failure(self, mock_elastic, mock_process, mock_sink, mock_spool):
+        failedItem = {'index': {'_id': 'uuid1', 'status': 400}}
+        mock_sink.return_value.write.return_value = iter([(False, failedItem)])
         inst = ESConnection()
         inst.generateRecords('session')
-        mock_stream.assert_has_calls([call(TestESManager.client_mock, 1)])
+        mock_spool.return_value.add.assert_called_once_with('uuid1', failedItem)
+        mock_spool.return_value.flush.assert_called_once()
     
-    @patch('lib.esManager.streaming_bulk', side_effect=BulkIndexError)
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.createBulkSink')
+    @patch('lib.esManager.ESConnection.process', side_effect=[1])
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_generate_version_conflict(self, mock_elastic, mock_process, mock_sink, mock_spool):
+        conflict = {'index': {'_index': 'test', '_id': 'uuid1', 'status': 409}}
+        mock_sink.return_value.write.return_value = iter([(False, conflict)])
+        inst = ESConnection()
+        with patch.object(inst, '_resolveConflicts') as mock_resolve:
+            mock_resolve.side_effect = lambda session: self.assertEqual(
+                inst.conflicts, [conflict]
+            )
+            inst.generateRecords('session')
+        mock_resolve.assert_called_once_with('session')
+        self.assertEqual((inst.success, inst.failure, inst.stale), (0, 0, 0))
+        mock_spool.return_value.add.assert_not_called()
+
+    def mockConflicts(self, inst, storedDocs, rebuilt):
+        inst.conflicts = [
+            {'index': {'_index': 'test', '_id': docID, 'status': 409}}
+            for docID in rebuilt
+        ]
+        inst.client.mget.return_value = {'docs': storedDocs}
+        return [
+            (i, {
+                '_index': 'test', '_id': docID, '_version': version,
+                '_version_type': 'external_gte',
+                '_source': {'content_hash': contentHash}
+            })
+            for i, (docID, (version, contentHash)) in enumerate(rebuilt.items())
+        ], []
+
+    @patch('lib.esManager.createBulkSink')
+    @patch('lib.esManager.retrieveWorkIDs', return_value=[(1, None), (2, None)])
+    @patch('lib.esManager.ESConnection.transformWorks')
+    @patch('lib.esManager.Elasticsearch')
+    def test_resolve_conflicts(self, mock_elastic, mock_transform, mock_ids, mock_sink):
+        inst = ESConnection()
+        inst.deadLetters = MagicMock()
+        inst._startRun()
+        mock_transform.return_value = self.mockConflicts(inst, [
+            {'_id': 'uuid1', 'found': True, '_version': 20, '_source': {'content_hash': 'a'}},
+            {'_id': 'uuid2', 'found': True, '_version': 20, '_source': {'content_hash': 'old'}},
+            {'_id': 'uuid3', 'found': True, '_version': 10, '_source': {'content_hash': 'old'}},
+            {'_id': 'uuid4', 'found': True, '_version': 10, '_source': {'content_hash': 'd'}},
+            {'_id': 'uuid5', 'found': True, '_version': 10, '_source': {'content_hash': 'old'}}
+        ], {
+            'uuid1': (10, 'a'), 'uuid2': (10, 'b'), 'uuid3': (10, 'c'),
+            'uuid4': (10, 'd'), 'uuid5': (10, 'e')
+        })
+        mock_sink.return_value.write.return_value = iter([
+            (True, {'index': {'_id': 'uuid3'}}),
+            (False, {'index': {'_id': 'uuid5', 'status': 400}})
+        ])
+
+        inst._resolveConflicts('session')
+
+        self.assertEqual(
+            mock_ids.call_args[0][1],
+            {'work': {'uuid1', 'uuid2', 'uuid3', 'uuid4', 'uuid5'}}
+        )
+        # Documents with a strictly newer stored version are stale whatever
+        # their content, and only those whose content differs at the same
+        # version are rewritten
+        rewrites = mock_sink.return_value.write.call_args[0][0]
+        self.assertEqual(
+            [(r['_id'], r['_version'], r['_version_type']) for r in rewrites],
+            [('uuid3', 10, 'external_gte'), ('uuid5', 10, 'external_gte')]
+        )
+        self.assertEqual(
+            (inst.success, inst.failure, inst.stale, inst.unchanged),
+            (1, 1, 2, 1)
+        )
+        inst.deadLetters.add.assert_called_once()
+        self.assertEqual(inst.conflicts, [])
+
+    @patch.dict(os.environ, {'DB_SNAPSHOT': 'snapshot1'})
+    @patch('lib.esManager.createBulkSink')
+    @patch('lib.esManager.ESConnection.transformWorks')
+    @patch('lib.esManager.Elasticsearch')
+    def test_resolve_conflicts_snapshot(self, mock_elastic, mock_transform, mock_sink):
+        inst = ESConnection()
+        inst._startRun()
+        inst.conflicts = [
+            {'index': {'_index': 'test', '_id': 'uuid1', 'status': 409}}
+        ]
+        inst._resolveConflicts('session')
+        self.assertEqual((inst.stale, inst.conflicts), (1, []))
+        inst.client.mget.assert_not_called()
+        mock_transform.assert_not_called()
+        mock_sink.assert_not_called()
+
+    @patch('lib.esManager.createBulkSink')
+    @patch('lib.esManager.retrieveWorkIDs', return_value=[])
+    @patch('lib.esManager.ESConnection.transformWorks', return_value=([], []))
+    @patch('lib.esManager.Elasticsearch')
+    def test_resolve_conflicts_deleted_work(self, mock_elastic, mock_transform, mock_ids, mock_sink):
+        inst = ESConnection()
+        inst._startRun()
+        inst.conflicts = [{'index': {'_index': 'test', '_id': 'uuid1', 'status': 409}}]
+        inst.client.mget.return_value = {'docs': []}
+        mock_sink.return_value.write.return_value = iter([])
+        inst._resolveConflicts('session')
+        self.assertEqual(inst.stale, 1)
+        self.assertEqual(mock_sink.return_value.write.call_args[0][0], [])
+
+    @patch('lib.esManager.createBulkSink')
+    @patch('lib.esManager.Elasticsearch')
+    def test_resolve_conflicts_none(self, mock_elastic, mock_sink):
+        inst = ESConnection()
+        inst._startRun()
+        inst._resolveConflicts('session')
+        mock_sink.assert_not_called()
+        inst.client.mget.assert_not_called()
+
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.createBulkSink')
     @patch('lib.esManager.ESConnection.process', side_effect=[1])
     @patch('lib.esManager.Elasticsearch', return_value=client_mock)
-    def test_generate_error(self, mock_elastic, mock_process, mock_stream):
+    def test_generate_error(self, mock_elastic, mock_process, mock_sink, mock_spool):
+        mock_sink.return_value.write.side_effect = ConnectionError
         inst = ESConnection()
-        try:
+        inst.checkpoint = MagicMock()
+        with self.assertRaises(ConnectionError):
             inst.generateRecords('session')
-        except ESError:
-            pass
-        self.assertRaises(ESError)
+        mock_spool.return_value.flush.assert_called_once()
+
+    @patch.dict('os.environ', {'INDEX_PIPELINE': 'async'})
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.createBulkSink')
+    @patch('lib.esManager.AsyncPipeline')
+    @patch('lib.esManager.ESConnection.processBatches', return_value='batches')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_generate_async(self, mock_elastic, mock_batches, mock_pipeline, mock_sink, mock_spool):
+        async def mockRun(batches):
+            yield True, {'index': {'_id': 'uuid1'}}
+            yield False, {'index': {'_id': 'uuid2', 'status': 400}}
+
+        mock_pipeline.return_value.run.side_effect = mockRun
+        inst = ESConnection()
+        inst.generateRecords('session')
+        mock_pipeline.assert_called_once_with(
+            TestESManager.client_mock, mock_sink.return_value
+        )
+        mock_pipeline.return_value.run.assert_called_once_with('batches')
+        self.assertEqual((inst.success, inst.failure), (1, 1))
+        mock_spool.return_value.add.assert_called_once()
+        mock_spool.return_value.flush.assert_called_once()
 
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_replay_dead_letters(self, mock_elastic, mock_spool):
+        mock_spool.return_value.read.return_value = [
+            {'id': 'uuid1', 'error': {}}, {'id': 'uuid2', 'error': {}}
+        ]
+        inst = ESConnection()
+        with patch.object(inst, 'generateRecords') as mock_generate:
+            inst.replayDeadLetters('session')
+        mock_spool.return_value.clear.assert_called_once()
+        mock_generate.assert_called_once_with(
+            'session', {'work': {'uuid1', 'uuid2'}}
+        )
+
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_replay_dead_letters_failure(self, mock_elastic, mock_spool):
+        letters = [{'id': 'uuid1', 'error': {}}]
+        mock_spool.return_value.read.return_value = letters
+        inst = ESConnection()
+        with patch.object(inst, 'generateRecords', side_effect=ESError('err')):
+            with self.assertRaises(ESError):
+                inst.replayDeadLetters('session')
+        mock_spool.return_value.extend.assert_called_once_with(letters)
+        mock_spool.return_value.flush.assert_called_once()
+
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_replay_dead_letters_failure_respooled(self, mock_elastic, mock_spool):
+        letters = [{'id': 'uuid1', 'error': {}}, {'id': 'uuid2', 'error': {}}]
+        mock_spool.return_value.read.return_value = letters
+        inst = ESConnection()
+
+        def mockGenerate(session, identifiers):
+            # uuid1 failed again, and was spooled, before the run failed
+            inst.errors = [{'index': {'_id': 'uuid1', 'status': 400}}]
+            raise ESError('err')
+
+        with patch.object(inst, 'generateRecords', side_effect=mockGenerate):
+            with self.assertRaises(ESError):
+                inst.replayDeadLetters('session')
+        mock_spool.return_value.extend.assert_called_once_with([letters[1]])
+
+    @patch('lib.esManager.createDeadLetterSpool')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_replay_dead_letters_empty(self, mock_elastic, mock_spool):
+        mock_spool.return_value.read.return_value = []
+        inst = ESConnection()
+        with patch.object(inst, 'generateRecords') as mock_generate:
+            inst.replayDeadLetters('session')
+        mock_generate.assert_not_called()
+        mock_spool.return_value.clear.assert_not_called()
+
+    @patch('lib.esManager.retrieveVersions', side_effect=mockRetrieveVersions)
+    @patch('lib.esManager.ESConnection.filterUnchanged', side_effect=mockFilterUnchanged)
     @patch('lib.esManager.retrieveRecords')
+    @patch('lib.esManager.loadWorks', side_effect=mockLoadWorks)
     @patch('lib.esManager.ESDoc.indexWork')
     @patch('lib.esManager.Elasticsearch', return_value=client_mock)
-    def test_process(self, mock_elastic, mock_index, mock_retrieve):
-        mock_retrieve.return_value = ['work1', 'work2', 'work3']
+    def test_process(self, mock_elastic, mock_index, mock_load, mock_retrieve, mock_filter, mock_versions):
+        mock_retrieve.return_value = [[(1, 'date1'), (2, 'date2'), (3, 'date3')]]
         with patch('lib.esManager.ESDoc.createWork') as mock_create:
             mock_dict = MagicMock()
-            mock_dict.to_dict.side_effect = ['work1', 'work2', 'work3']
+            mock_dict.to_dict.side_effect = [
+                {'_id': 'work{}'.format(i), '_source': {}} for i in range(1, 4)
+            ]
             mock_create.return_value = mock_dict
             inst = ESConnection()
-            res = list(inst.process('session'))
-            self.assertEqual(res, ['work1', 'work2', 'work3'])
-    
+            mockSession = MagicMock()
+            res = list(inst.process(mockSession))
+            self.assertEqual(
+                [r['_id'] for r in res], ['work1', 'work2', 'work3']
+            )
+            self.assertIn('content_hash', res[0]['_source'])
+            self.assertEqual(res[0]['_version'], 1546300800000000)
+            self.assertEqual(res[0]['_version_type'], 'external_gte')
+            mock_load.assert_called_once_with(mockSession, [1, 2, 3])
+            # The loaded works are released once their documents are built
+            mockSession.expunge_all.assert_called_once()
+
+    @patch.dict('os.environ', {'INDEX_VERSION_TYPE': 'internal'})
+    @patch('lib.esManager.retrieveVersions')
+    @patch('lib.esManager.loadWorks', return_value=[MagicMock(id=1)])
+    @patch('lib.esManager.ESDoc')
+    def test_transform_works_unversioned(self, mock_doc, mock_load, mock_versions):
+        mock_doc.return_value.work.to_dict.return_value = {
+            '_id': 'uuid1', '_source': {}
+        }
+        esActions, _ = ESConnection.transformWorks(MagicMock(), [(1, 'date1')])
+        self.assertNotIn('_version', esActions[0][1])
+        mock_versions.assert_not_called()
+
+    @patch('lib.esManager.retrieveVersions', side_effect=mockRetrieveVersions)
+    @patch('lib.esManager.ESConnection.filterUnchanged', side_effect=mockFilterUnchanged)
+    @patch('lib.esManager.retrieveRecords')
+    @patch('lib.esManager.loadWorks', return_value=[MagicMock(id=2)])
+    @patch('lib.esManager.ESDoc')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_process_missing_work(self, mock_elastic, mock_doc, mock_load, mock_retrieve, mock_filter, mock_versions):
+        mock_retrieve.return_value = [[(1, 'date1'), (2, 'date2')]]
+        mock_doc.return_value.work.to_dict.return_value = {
+            '_id': 'uuid2', '_source': {}
+        }
+        inst = ESConnection()
+        tracker = MagicMock()
+        res = list(inst.process(MagicMock(), tracker))
+        self.assertEqual([r['_id'] for r in res], ['uuid2'])
+        tracker.skip.assert_called_once_with(1)
+        tracker.bind.assert_called_once_with('uuid2', 2)
+
+    @patch('lib.esManager.retrieveVersions', side_effect=mockRetrieveVersions)
+    @patch('lib.esManager.ESConnection.filterUnchanged', side_effect=mockFilterUnchanged)
+    @patch('lib.esManager.retrieveRecords')
+    @patch('lib.esManager.retrieveWorkIDs')
+    @patch('lib.esManager.loadWorks', side_effect=mockLoadWorks)
+    @patch('lib.esManager.ESDoc')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_process_targeted(self, mock_elastic, mock_doc, mock_load, mock_ids, mock_retrieve, mock_filter, mock_versions):
+        mock_ids.return_value = [(1, 'date1'), (2, 'date2'), (3, 'date3')]
+        mock_doc.return_value.work.to_dict.side_effect = [
+            {'_id': 'work{}'.format(i), '_source': {}} for i in range(1, 4)
+        ]
+        inst = ESConnection()
+        tracker = MagicMock()
+        mockSession = MagicMock()
+        with patch.dict('os.environ', {'INDEX_BATCH_SIZE': '2'}):
+            res = list(inst.process(mockSession, tracker, {'work': {'uuid1'}}))
+        self.assertEqual([r['_id'] for r in res], ['work1', 'work2', 'work3'])
+        mock_ids.assert_called_once_with(mockSession, {'work': {'uuid1'}})
+        self.assertEqual(mockSession.expunge_all.call_count, 2)
+        mock_retrieve.assert_not_called()
+        tracker.add.assert_not_called()
+
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_limit_batches(self, mock_elastic):
+        inst = ESConnection()
+        inst.deadline = 100
+        with patch('lib.esManager.time.monotonic', side_effect=[50, 99, 100]):
+            res = list(inst._limitBatches(iter([[1], [2], [3], [4]])))
+        self.assertEqual(res, [[1], [2]])
+        self.assertTrue(inst.stopped)
+
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_limit_batches_no_deadline(self, mock_elastic):
+        inst = ESConnection()
+        res = list(inst._limitBatches(iter([[1], [2]])))
+        self.assertEqual(res, [[1], [2]])
+        self.assertFalse(inst.stopped)
+
+    @patch('lib.esManager.retrieveWorkRange')
+    @patch('lib.esManager.retrieveRecords')
+    @patch('lib.esManager.createTransformPool')
+    @patch('lib.esManager.ESConnection.filterUnchanged', side_effect=mockFilterUnchanged)
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_process_work_range(self, mock_elastic, mock_filter, mock_pool, mock_retrieve, mock_range):
+        mock_range.return_value = [[(2, 'date2')]]
+        mock_pool.return_value.map.return_value = [
+            ([(2, {'_index': 'test', '_id': 'uuid2'})], [])
+        ]
+        inst = ESConnection()
+        tracker = MagicMock()
+        res = list(inst.process('session', tracker, workRange=(1, 10)))
+        self.assertEqual(res, [{'_index': 'test', '_id': 'uuid2'}])
+        mock_range.assert_called_once_with('session', 1, 10)
+        mock_retrieve.assert_not_called()
+        tracker.bind.assert_not_called()
+
+    @patch('lib.esManager.retrieveRecords')
+    @patch('lib.esManager.createTransformPool')
+    @patch('lib.esManager.ESConnection.filterUnchanged', side_effect=mockFilterUnchanged)
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_process_transform_pool(self, mock_elastic, mock_filter, mock_pool, mock_retrieve):
+        mock_retrieve.return_value = [[(1, 'date1'), (2, 'date2')]]
+        mock_pool.return_value.map.return_value = [
+            ([(2, {'_index': 'test', '_id': 'uuid2'})], [1])
+        ]
+        inst = ESConnection()
+        tracker = MagicMock()
+        res = list(inst.process('session', tracker))
+        self.assertEqual(res, [{'_index': 'test', '_id': 'uuid2'}])
+        mock_pool.assert_called_once_with(ESConnection.transformWorks, None)
+        tracker.skip.assert_called_once_with(1)
+        tracker.bind.assert_called_once_with('uuid2', 2)
+
+    @patch('lib.esManager.retrieveRecords')
+    @patch('lib.esManager.createTransformPool')
+    @patch('lib.esManager.ESConnection.filterUnchanged')
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_process_rebuild(self, mock_elastic, mock_filter, mock_pool, mock_retrieve):
+        mock_retrieve.return_value = [[(1, 'date1')]]
+        mock_pool.return_value.map.return_value = [
+            ([(1, {'_index': 'test', '_id': 'uuid1'})], [])
+        ]
+        inst = ESConnection()
+        inst.checkpoint = MagicMock()
+        res = list(inst.process('session', MagicMock(), rebuildIndex='test_1'))
+        self.assertEqual(res, [{'_index': 'test_1', '_id': 'uuid1'}])
+        mock_retrieve.assert_called_once_with('session', fullScan=True)
+        inst.checkpoint.load.assert_not_called()
+        mock_filter.assert_not_called()
+
+    @patch('lib.esManager.retrieveRecords')
+    @patch('lib.esManager.createTransformPool')
+    @patch('lib.esManager.ESConnection.filterUnchanged', side_effect=mockFilterUnchanged)
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_process_targets(self, mock_elastic, mock_filter, mock_pool, mock_retrieve):
+        mock_retrieve.return_value = [[(1, 'date1')]]
+        testSource = {'title': 'Test', 'summary': 'Summary'}
+        mock_pool.return_value.map.return_value = [
+            ([(1, {'_index': 'test', '_id': 'uuid1', '_source': testSource})], [])
+        ]
+        inst = ESConnection(targets=[
+            IndexTarget('test'), IndexTarget('test_v2', exclude=['summary'])
+        ])
+        tracker = MagicMock()
+        res = list(inst.process('session', tracker))
+        self.assertEqual(res, [
+            {'_index': 'test', '_id': 'uuid1', '_source': testSource},
+            {'_index': 'test_v2', '_id': 'uuid1', '_source': {'title': 'Test'}}
+        ])
+        self.assertEqual(tracker.bind.call_count, 2)
+
+    @patch.dict('os.environ', {'RECONCILE_BATCH_SIZE': '2'})
+    @patch('lib.esManager.createBulkSink')
+    @patch('lib.esManager.retrieveExistingUUIDs', return_value={'uuid4'})
+    @patch('lib.esManager.streamIndexIDs', return_value=iter(['uuid2', 'uuid3', 'uuid4']))
+    @patch('lib.esManager.streamWorkUUIDs', return_value=iter(['uuid1', 'uuid2']))
+    @patch('lib.esManager.Elasticsearch', return_value=client_mock)
+    def test_reconcile(self, mock_elastic, mock_db, mock_index, mock_existing, mock_sink):
+        deletes = []
+
+        def mockWrite(actions, raiseOnError):
+            for action in actions:
+                deletes.append(action)
+                yield False, {'delete': {'_id': action['_id'], 'status': 404}}
+
+        mock_sink.return_value.write.side_effect = mockWrite
+        inst = ESConnection()
+        progress = MagicMock()
+        with patch.object(inst, 'generateRecords') as mock_generate:
+            inst.reconcile('session', after='uuid0', progress=progress)
+
+        mock_db.assert_called_once_with('session', pageSize=2, after='uuid0')
+        self.assertEqual(mock_index.call_args[1]['after'], 'uuid0')
+        mock_generate.assert_called_once_with('session', {'work': {'uuid1'}})
+        mock_existing.assert_called_once_with('session', ['uuid3', 'uuid4'])
+        # Progress is recorded once the differences up to each ID are handled
+        self.assertEqual(progress.call_args_list, [call('uuid2'), call('uuid4')])
+        self.assertEqual(deletes, [{
+            '_op_type': 'delete', '_index': 'test', '_type': 'doc',
+            '_id': 'uuid3'
+        }])
+        self.assertEqual((inst.missing, inst.orphaned), (1, 1))
+
+    @patch('lib.esManager.findFormerParents', return_value={'uuid2': [1]})
+    @patch('lib.esManager.Elasticsearch')
+    def test_find_former_parents(self, mock_elastic, mock_find):
+        inst = ESConnection()
+        self.assertEqual(inst.findFormerParents({1: 'uuid1'}), {'uuid2': [1]})
+        mock_find.assert_called_once_with(inst.client, 'test', 'doc', {1: 'uuid1'})
+
+    @patch('lib.esManager.Elasticsearch')
+    def test_filter_unchanged(self, mock_elastic):
+        inst = ESConnection()
+        tracker = MagicMock()
+        storedHash = hashDocument({'title': 'Unchanged'})
+        esActions = [
+            (1, {'_index': 'test', '_id': 'uuid1', '_source': {'content_hash': storedHash}}),
+            (2, {'_index': 'test', '_id': 'uuid2', '_source': {'content_hash': 'new'}}),
+            (3, {'_index': 'test', '_id': 'uuid3', '_source': {'content_hash': 'new'}})
+        ]
+        inst.client.mget.return_value = {'docs': [
+            {'_index': 'test', '_id': 'uuid1', 'found': True, '_source': {'content_hash': storedHash}},
+            {'_index': 'test', '_id': 'uuid2', 'found': True, '_source': {'content_hash': 'old'}},
+            {'_index': 'test', '_id': 'uuid3', 'found': False}
+        ]}
+
+        changed = inst.filterUnchanged(esActions, tracker)
+        self.assertEqual([workID for workID, _ in changed], [2, 3])
+        self.assertEqual(inst.unchanged, 1)
+        tracker.skip.assert_called_once_with(1)
+        self.assertEqual(
+            inst.client.mget.call_args[1]['body'],
+            {'docs': [
+                {'_index': 'test', '_id': 'uuid1'},
+                {'_index': 'test', '_id': 'uuid2'},
+                {'_index': 'test', '_id': 'uuid3'}
+            ]}
+        )
+
+    @patch('lib.esManager.Elasticsearch')
+    def test_filter_unchanged_targets(self, mock_elastic):
+        inst = ESConnection()
+        tracker = MagicMock()
+        esActions = [
+            (1, {'_index': 'test', '_id': 'uuid1', '_source': {'content_hash': 'a'}}),
+            (1, {'_index': 'new', '_id': 'uuid1', '_source': {'content_hash': 'a'}}),
+            (1, {'_index': 'other', '_id': 'uuid1', '_source': {'title': 'a'}}),
+            (2, {'_index': 'test', '_id': 'uuid2', '_source': {'content_hash': 'b'}}),
+            (2, {'_index': 'new', '_id': 'uuid2', '_source': {'content_hash': 'b'}})
+        ]
+        inst.client.mget.return_value = {'docs': [
+            {'_index': 'test', '_id': 'uuid1', 'found': True, '_source': {'content_hash': 'a'}},
+            {'_index': 'new', '_id': 'uuid1', 'found': False},
+            {'_index': 'other', '_id': 'uuid1', 'found': True, '_source': {}},
+            {'_index': 'test', '_id': 'uuid2', 'found': True, '_source': {'content_hash': 'b'}},
+            {'_index': 'new', '_id': 'uuid2', 'found': True, '_source': {'content_hash': 'b'}}
+        ]}
+
+        changed = inst.filterUnchanged(esActions, tracker)
+        # Documents missing from a target, or written without their hash,
+        # are still written there even if they are unchanged in the live index
+        self.assertEqual(
+            [esAction['_index'] for _, esAction in changed], ['new', 'other']
+        )
+        self.assertEqual(inst.unchanged, 3)
+        tracker.skip.assert_called_once_with(2)
+
+    @patch('lib.esManager.Elasticsearch')
+    def test_filter_unchanged_disabled(self, mock_elastic):
+        inst = ESConnection()
+        esActions = [(1, {'_id': 'uuid1', '_source': {'content_hash': 'a'}})]
+        with patch.dict('os.environ', {'SKIP_UNCHANGED': 'false'}):
+            self.assertEqual(inst.filterUnchanged(esActions), esActions)
+        inst.client.mget.assert_not_called()
+
+    @patch('lib.esManager.Elasticsearch')
+    def test_filter_unchanged_mget_error(self, mock_elastic):
+        inst = ESConnection()
+        inst.client.mget.side_effect = TransportError(500, 'error')
+        esActions = [(1, {'_id': 'uuid1', '_source': {'content_hash': 'a'}})]
+        self.assertEqual(inst.filterUnchanged(esActions), esActions)
+
+    @patch('lib.esManager.loadWorks', return_value='orm')
+    @patch('lib.esManager.projectWorks', return_value='projection')
+    def test_load_works_engine(self, mock_project, mock_load):
+        self.assertEqual(ESConnection._loadWorks('session', [1]), 'orm')
+        with patch.dict('os.environ', {'LOAD_ENGINE': 'projection'}):
+            self.assertEqual(ESConnection._loadWorks('session', [1]), 'projection')
+        mock_project.assert_called_once_with('session', [1])
+
+    @patch('lib.esManager.serializeWork', return_value='dictWork')
+    @patch('lib.esManager.ESDoc')
+    def test_build_document_serializer(self, mock_doc, mock_serialize):
+        mock_doc.return_value.work.to_dict.return_value = 'dslWork'
+        self.assertEqual(
+            ESConnection._buildDocument('session', (1,), 'dbWork'), 'dslWork'
+        )
+        with patch.dict('os.environ', {'DOC_SERIALIZER': 'dict'}):
+            self.assertEqual(
+                ESConnection._buildDocument('session', (1,), 'dbWork'),
+                'dictWork'
+            )
+        mock_serialize.assert_called_once_with('dbWork', cache=None)
+
     @patch('lib.esManager.ESDoc.createWork', return_value='testWork')
     def test_init_esdoc(self, mock_create):
         newDoc = ESDoc(('work1',), 'session')
@@ -106,6 +676,13 @@ class TestESManager(unittest.TestCase):
         self.assertEqual(newDoc.session, 'session')
         self.assertEqual(newDoc.dbRec, None)
         self.assertEqual(newDoc.work, 'testWork')
+
+    @patch('lib.esManager.Work', return_value={'title': 'test', 'uuid': '000'})
+    def test_create_es_work_preloaded(self, mock_work):
+        mock_session = MagicMock()
+        testDoc = ESDoc(('1',), mock_session, dbRec=TestDict(uuid=0))
+        mock_session.query.assert_not_called()
+        self.assertEqual(testDoc.dbRec.uuid, 0)
     
     @patch('lib.esManager.Work', return_value={'title': 'test', 'uuid': '000'})
     def test_create_es_work(self, mock_work):
@@ -196,6 +773,45 @@ class TestESManager(unittest.TestCase):
         coverRec = ESDoc.addCover(testCover)
         self.assertEqual(coverRec, None)
     
+    def test_merge_agents(self):
+        def testRel(name, role):
+            testAgent = TestDict(**{'name': name, 'aliases': [], 'dates': []})
+            return TestDict(**{'agent': testAgent, 'role': role})
+
+        agentRecs = ESDoc.mergeAgents([
+            testRel('Author', 'author'),
+            testRel('Editor', 'editor'),
+            testRel('Author', 'illustrator'),
+            testRel('Author', 'author')
+        ])
+        self.assertEqual(len(agentRecs), 2)
+        self.assertEqual(agentRecs[0].name, 'Author')
+        self.assertEqual(list(agentRecs[0].roles), ['author', 'illustrator'])
+        self.assertEqual(list(agentRecs[1].roles), ['editor'])
+
+    def test_merge_agents_cached(self):
+        testAgent = TestDict(**{
+            'id': 1, 'name': 'Author', 'dates': [],
+            'aliases': [TestDict(**{'alias': 'Alias'})]
+        })
+        testCache = DocCache(10)
+
+        firstRecs = ESDoc.mergeAgents(
+            [TestDict(**{'agent': testAgent, 'role': 'author'})],
+            cache=testCache
+        )
+        secondRecs = ESDoc.mergeAgents(
+            [TestDict(**{'agent': testAgent, 'role': 'editor'})],
+            cache=testCache
+        )
+        self.assertEqual(testCache.hits, 1)
+        self.assertEqual(testCache.misses, 1)
+        self.assertIsNot(firstRecs[0], secondRecs[0])
+        self.assertEqual(list(firstRecs[0].roles), ['author'])
+        self.assertEqual(list(secondRecs[0].roles), ['editor'])
+        self.assertEqual(secondRecs[0].name, 'Author')
+        self.assertEqual(list(secondRecs[0].aliases), ['Alias'])
+
     def test_insert_instance_w_pub_date(self):
         testInstance = MagicMock()
         testDate = MagicMock()
@@ -205,10 +821,12 @@ class TestESManager(unittest.TestCase):
         dateObj.date_type = 'pub_date'
         dateObj.display_date = '2019'
         dateObj.date_range = testDate
+        testInstance.id = 5
         testInstance.title = 'Test Title'
         testInstance.dates = [dateObj]
         newInstance = ESDoc.addInstance(testInstance)
 
+        self.assertEqual(newInstance.instance_id, 5)
         self.assertEqual(newInstance.title, 'Test Title')
         self.assertEqual(newInstance.pub_date_sort, '2019-01-01')
         self.assertEqual(newInstance.pub_date_sort_desc, '2019-12-31')
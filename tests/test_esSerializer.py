@@ -0,0 +1,72 @@
+import unittest
+from unittest.mock import patch
+import json
+import uuid
+from datetime import date, datetime
+from decimal import Decimal
+
+from elasticsearch.exceptions import SerializationError
+from elasticsearch_dsl.wrappers import Range
+
+from lib.esSerializer import (
+    createSerializer,
+    ESJSONSerializer,
+    ORJSONSerializer,
+    orjson
+)
+
+requiresORJSON = unittest.skipIf(orjson is None, 'orjson is not installed')
+
+
+TEST_DOC = {
+    'title': 'Tést',
+    'date_modified': datetime(2019, 6, 1, 12, 30, 15, 500),
+    'issued': Range(gte=date(1900, 1, 1), lte=date(1900, 12, 31)),
+    'uuid': uuid.UUID('00000000-0000-0000-0000-000000000001'),
+    'score': Decimal('1.5'),
+    'instances': [{'id': 1, 'pub_place': None}]
+}
+
+
+class TestESSerializer(unittest.TestCase):
+    def test_create_default(self):
+        self.assertIsInstance(createSerializer(), ESJSONSerializer)
+        self.assertNotIsInstance(createSerializer(), ORJSONSerializer)
+
+    @requiresORJSON
+    @patch.dict('os.environ', {'ES_SERIALIZER': 'orjson'})
+    def test_create_orjson(self):
+        self.assertIsInstance(createSerializer(), ORJSONSerializer)
+
+    @patch.dict('os.environ', {'ES_SERIALIZER': 'orjson'})
+    @patch('lib.esSerializer.orjson', None)
+    def test_create_orjson_fallback(self):
+        testSerializer = createSerializer()
+        self.assertIsInstance(testSerializer, ESJSONSerializer)
+        self.assertNotIsInstance(testSerializer, ORJSONSerializer)
+
+    def test_stdlib_dumps(self):
+        testJSON = ESJSONSerializer().dumps(TEST_DOC)
+        self.assertIn('"title":"Tést"', testJSON)
+        self.assertEqual(json.loads(testJSON)['issued'], {
+            'gte': '1900-01-01', 'lte': '1900-12-31'
+        })
+
+    @requiresORJSON
+    def test_orjson_matches_stdlib(self):
+        self.assertEqual(
+            ORJSONSerializer().dumps(TEST_DOC), ESJSONSerializer().dumps(TEST_DOC)
+        )
+
+    @requiresORJSON
+    def test_orjson_strings_and_loads(self):
+        testSerializer = ORJSONSerializer()
+        self.assertEqual(testSerializer.dumps('{"a":1}'), '{"a":1}')
+        self.assertEqual(testSerializer.loads('{"a":1}'), {'a': 1})
+        with self.assertRaises(SerializationError):
+            testSerializer.loads('{bad')
+
+    @requiresORJSON
+    def test_orjson_unserializable(self):
+        with self.assertRaises(SerializationError):
+            ORJSONSerializer().dumps({'a': object()})
@@ -2,6 +2,8 @@ import unittest
 from unittest.mock import patch, call, MagicMock
 import os
 
+from elasticsearch.exceptions import TransportError, ConnectionError
+
 from helpers.errorHelpers import ESError
 
 os.environ['DB_USER'] = 'test'
@@ -15,7 +17,11 @@ os.environ['ES_INDEX'] = 'test'
 # us to re-use db connections across Lambda invocations, but it requires a
 # little testing weirdness, e.g. we need to mock it on import to prevent errors
 with patch('service.SessionManager') as mock_db:
-    from service import handler, indexRecords
+    from service import (
+        handler, indexRecords, parseRecords, getDeadline, continueRun
+    )
+
+UUID1 = '1b4e28ba-2fa1-11d2-883f-0016d3cca427'
 
 
 class TestHandler(unittest.TestCase):
@@ -29,8 +35,188 @@ class TestHandler(unittest.TestCase):
         mock_index.assert_called_once()
         self.assertTrue(resp)
 
+    @patch('service.continueRun')
+    @patch('service.getDeadline', return_value=100)
+    @patch('service.indexRecords', return_value=False)
+    def test_handler_stopped_early(self, mock_index, mock_deadline,
+                                   mock_continue):
+        mockContext = MagicMock()
+        resp = handler({}, mockContext)
+        mock_deadline.assert_called_once_with(mockContext)
+        mock_index.assert_called_once_with(deadline=100)
+        mock_continue.assert_called_once_with(mockContext)
+        self.assertTrue(resp)
+
+    @patch('service.continueRun')
+    @patch('service.indexRecords', return_value=True)
+    def test_handler_completed(self, mock_index, mock_continue):
+        handler({}, None)
+        mock_index.assert_called_once_with(deadline=None)
+        mock_continue.assert_not_called()
+
+    @patch.dict(os.environ, {'INDEX_TIME_RESERVE': '60'})
+    @patch('service.time.monotonic', return_value=1000)
+    def test_get_deadline(self, mock_time):
+        mockContext = MagicMock()
+        mockContext.get_remaining_time_in_millis.return_value = 900000
+        self.assertEqual(getDeadline(mockContext), 1840)
+        self.assertIsNone(getDeadline(None))
+
+    @patch.dict(os.environ, {'INDEX_CONTINUE': 'true'})
+    @patch('service.getConnection')
+    @patch('service.createAWSClient')
+    def test_continue_run(self, mock_client, mock_connection):
+        mockContext = MagicMock()
+        mockContext.function_name = 'sfr-es-manager'
+        continueRun(mockContext)
+        mock_client.return_value.invoke.assert_called_once_with(
+            FunctionName='sfr-es-manager', InvocationType='Event', Payload='{}'
+        )
+
+    @patch('service.createAWSClient')
+    def test_continue_run_disabled(self, mock_client):
+        continueRun(MagicMock())
+        mock_client.assert_not_called()
+
+    @patch.dict(os.environ, {'INDEX_CONTINUE': 'true'})
+    @patch('service.getConnection')
+    @patch('service.createAWSClient')
+    def test_continue_run_no_checkpoint(self, mock_client, mock_connection):
+        # With CHECKPOINT_BACKEND=none each run rescans the same window, so
+        # continuing it would chain invocations forever
+        mock_connection.return_value.checkpoint = None
+        continueRun(MagicMock())
+        mock_client.assert_not_called()
+
+    @patch('service.indexRecords', return_value=True)
+    def test_handler_sqs(self, mock_index):
+        testRec = {
+            'Records': [
+                {'body': '{"type": "work", "identifier": "%s"}' % UUID1},
+                {'body': '{"type": "instance", "identifier": 1}'}
+            ]
+        }
+        resp = handler(testRec, None)
+        mock_index.assert_called_once_with({
+            'work': {UUID1}, 'instance': {1}
+        })
+        self.assertTrue(resp)
+
+    @patch('service.indexRecords', return_value=True)
+    def test_handler_sqs_no_valid_messages(self, mock_index):
+        resp = handler({'Records': [{'body': 'bad'}]}, None)
+        mock_index.assert_not_called()
+        self.assertTrue(resp)
+
+    @patch('service.indexRecords', return_value=True)
+    def test_handler_replay(self, mock_index):
+        resp = handler({'replay_dead_letters': True}, None)
+        mock_index.assert_called_once_with(replay=True)
+        self.assertTrue(resp)
+
+    def test_parse_records_dedupe(self):
+        identifiers = parseRecords([
+            {'body': '{"type": "work", "identifier": "%s"}' % UUID1},
+            {'body': '{"type": "Work", "identifier": "%s"}' % UUID1.upper()},
+            {'body': '{"type": "item", "identifier": 5}'},
+            {'body': '{"type": "item", "identifier": "5"}'},
+            {'body': '{"type": "item", "identifier": 6}'},
+            {'body': '{"type": "agent", "identifier": 7}'},
+            {'body': '{"identifier": 8}'},
+            {'nobody': True}
+        ])
+        self.assertEqual(identifiers, {'work': {UUID1}, 'item': {5, 6}})
+
+    def test_parse_records_invalid_identifier(self):
+        identifiers = parseRecords([
+            {'body': '{"type": "work", "identifier": ["uuid1"]}'},
+            {'body': '{"type": "work", "identifier": {"id": "uuid2"}}'},
+            {'body': '{"type": "item", "identifier": null}'},
+            {'body': '{"type": "item", "identifier": true}'},
+            {'body': '{"type": "work", "identifier": "%s"}' % UUID1}
+        ])
+        self.assertEqual(identifiers, {'work': {UUID1}})
+
+    def test_parse_records_malformed_identifier(self):
+        identifiers = parseRecords([
+            {'body': '{"type": "work", "identifier": "abc"}'},
+            {'body': '{"type": "work", "identifier": 5}'},
+            {'body': '{"type": "instance", "identifier": "abc"}'},
+            {'body': '{"type": "item", "identifier": "1.5"}'},
+            {'body': '{"type": "instance", "identifier": "12"}'}
+        ])
+        self.assertEqual(identifiers, {'instance': {12}})
+
+    @patch('service.ES_CONNECTION', None)
     def test_parse_records_success(self):
         mock_es = MagicMock()
         with patch('service.ESConnection', return_value=mock_es) as mock_conn:
             indexRecords()
             mock_es.generateRecords.assert_called_once()
+
+    @patch('service.ES_CONNECTION', None)
+    def test_index_records_stopped(self):
+        mock_es = MagicMock()
+        mock_es.stopped = True
+        with patch('service.ESConnection', return_value=mock_es):
+            self.assertFalse(indexRecords(deadline=100))
+        mock_es.generateRecords.assert_called_once_with(
+            unittest.mock.ANY, None, deadline=100
+        )
+
+    @patch('service.ES_CONNECTION', None)
+    def test_index_records_targeted(self):
+        mock_es = MagicMock()
+        with patch('service.ESConnection', return_value=mock_es) as mock_conn:
+            indexRecords({'work': {'uuid1'}})
+            mock_es.generateRecords.assert_called_once_with(
+                unittest.mock.ANY, {'work': {'uuid1'}}, deadline=None
+            )
+
+    @patch('service.ES_CONNECTION', None)
+    def test_index_records_replay(self):
+        mock_es = MagicMock()
+        with patch('service.ESConnection', return_value=mock_es) as mock_conn:
+            indexRecords(replay=True)
+            mock_es.replayDeadLetters.assert_called_once()
+            mock_es.generateRecords.assert_not_called()
+
+    @patch('service.ES_CONNECTION', None)
+    def test_index_records_reuses_connection(self):
+        mock_es = MagicMock(indexExists=True)
+        with patch('service.ESConnection', return_value=mock_es) as mock_conn:
+            indexRecords()
+            indexRecords()
+            mock_conn.assert_called_once()
+            mock_es.createIndex.assert_not_called()
+            self.assertEqual(mock_es.generateRecords.call_count, 2)
+
+    @patch('service.ES_CONNECTION', None)
+    def test_index_records_transport_error(self):
+        mock_es = MagicMock(indexExists=True)
+        mock_es.generateRecords.side_effect = [TransportError('N/A', 'err'), None]
+
+        def mockHealthCheck():
+            mock_es.indexExists = False
+            return True
+
+        mock_es.healthCheck.side_effect = mockHealthCheck
+        with patch('service.ESConnection', return_value=mock_es) as mock_conn:
+            with self.assertRaises(TransportError):
+                indexRecords()
+            indexRecords()
+            # The cluster was reachable, so the connection is kept and only
+            # the index check is repeated
+            mock_conn.assert_called_once()
+            mock_es.createIndex.assert_called_once()
+
+    @patch('service.ES_CONNECTION', None)
+    def test_index_records_connection_lost(self):
+        mock_es = MagicMock(indexExists=True)
+        mock_es.generateRecords.side_effect = ConnectionError('N/A', 'err')
+        mock_es.healthCheck.return_value = False
+        with patch('service.ESConnection', return_value=mock_es) as mock_conn:
+            for _ in range(2):
+                with self.assertRaises(ConnectionError):
+                    indexRecords()
+            self.assertEqual(mock_conn.call_count, 2)
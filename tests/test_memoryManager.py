@@ -0,0 +1,91 @@
+import unittest
+from unittest.mock import patch
+import os
+
+from lib.memoryManager import createMemoryGuard, currentRSS, MemoryGuard
+
+MB = 1024 * 1024
+
+
+class TestMemoryManager(unittest.TestCase):
+    @patch.dict(os.environ, {}, clear=True)
+    def test_create_guard_default(self):
+        self.assertIsNone(createMemoryGuard())
+
+    @patch.dict(os.environ, {
+        'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '3008', 'INDEX_BATCH_SIZE': '50'
+    }, clear=True)
+    @patch('lib.memoryManager.currentRSS', return_value=100 * MB)
+    def test_create_guard_lambda(self, mock_rss):
+        guard = createMemoryGuard()
+        self.assertEqual(guard.ceiling, int(3008 * 0.8 * MB))
+        self.assertEqual((guard.batchSize, guard.minBatchSize), (50, 10))
+
+    @patch.dict(os.environ, {
+        'AWS_LAMBDA_FUNCTION_MEMORY_SIZE': '3008', 'MEMORY_CEILING': '1024'
+    }, clear=True)
+    @patch('lib.memoryManager.currentRSS', return_value=100 * MB)
+    def test_create_guard_ceiling(self, mock_rss):
+        self.assertEqual(createMemoryGuard().ceiling, 1024 * MB)
+
+    @patch.dict(os.environ, {
+        'MEMORY_CEILING': '1200', 'INDEX_WORKERS': '3'
+    }, clear=True)
+    @patch('lib.memoryManager.currentRSS', return_value=100 * MB)
+    def test_create_guard_workers(self, mock_rss):
+        self.assertEqual(createMemoryGuard().ceiling, 300 * MB)
+
+    @patch.dict(os.environ, {'MEMORY_CEILING': '0'}, clear=True)
+    def test_create_guard_disabled(self):
+        self.assertIsNone(createMemoryGuard())
+
+    @patch.dict(os.environ, {'MEMORY_CEILING': '1024'}, clear=True)
+    @patch('lib.memoryManager.currentRSS', return_value=None)
+    def test_create_guard_unavailable(self, mock_rss):
+        self.assertIsNone(createMemoryGuard())
+
+    def test_current_rss(self):
+        rss = currentRSS()
+        if rss is not None:
+            self.assertGreater(rss, 0)
+
+    @patch('lib.memoryManager.currentRSS', return_value=100 * MB)
+    def test_batches_under_ceiling(self, mock_rss):
+        guard = MemoryGuard(200 * MB, 4)
+        res = list(guard.batches(iter([[1, 2, 3], [4, 5, 6, 7, 8]])))
+        self.assertEqual(res, [[1, 2, 3], [4, 5, 6, 7], [8]])
+
+    @patch('lib.memoryManager.gc.collect')
+    @patch('lib.memoryManager.currentRSS')
+    def test_batches_over_ceiling(self, mock_rss, mock_gc):
+        mock_rss.side_effect = [100 * MB, 300 * MB, 300 * MB] + [100 * MB] * 5
+        guard = MemoryGuard(200 * MB, 4, minBatchSize=1)
+        res = list(guard.batches(iter([[1, 2, 3, 4, 5, 6, 7, 8]])))
+        self.assertEqual(res, [[1, 2, 3, 4], [5, 6], [7, 8]])
+        mock_gc.assert_called_once()
+
+    @patch('lib.memoryManager.gc.collect')
+    @patch('lib.memoryManager.currentRSS')
+    def test_check_collected(self, mock_rss, mock_gc):
+        mock_rss.side_effect = [300 * MB, 100 * MB]
+        guard = MemoryGuard(200 * MB, 4)
+        guard.check()
+        self.assertEqual(guard.batchSize, 4)
+
+    @patch('lib.memoryManager.gc.collect')
+    @patch('lib.memoryManager.currentRSS', return_value=300 * MB)
+    def test_check_min_batch_size(self, mock_rss, mock_gc):
+        guard = MemoryGuard(200 * MB, 16, minBatchSize=5)
+        for _ in range(4):
+            guard.check()
+        self.assertEqual(guard.batchSize, 5)
+
+    def test_reduce(self):
+        guard = MemoryGuard(200 * MB, 16, minBatchSize=5)
+        guard.reduce(None)
+        guard.reduce(32)
+        self.assertEqual(guard.batchSize, 16)
+        guard.reduce(8)
+        self.assertEqual(guard.batchSize, 8)
+        guard.reduce(2)
+        self.assertEqual(guard.batchSize, 5)
@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import asyncio
+
+from lib.pipelineManager import AsyncPipeline
+
+
+class MockSink():
+    """Records the actions taken from the pipeline queue and echoes a result
+    for each
+    """
+    def __init__(self):
+        self.controller = MagicMock(maxConcurrency=2)
+        self.sent = []
+
+    def sendChunk(self, chunk):
+        self.sent.append(chunk)
+        return chunk
+
+    async def writeAsync(self, queue, send):
+        while True:
+            batch = await queue.get()
+            if batch is None:
+                break
+            for item in await send(batch):
+                yield True, item
+
+
+def runPipeline(pipeline, batches):
+    async def collect():
+        return [result async for result in pipeline.run(batches)]
+
+    return asyncio.run(collect())
+
+
+@patch('lib.pipelineManager.AsyncElasticsearch', None)
+class TestPipelineManager(unittest.TestCase):
+    @patch.dict('os.environ', {'PIPELINE_QUEUE_SIZE': '5'})
+    def test_create_pipeline(self):
+        testPipeline = AsyncPipeline('client', MockSink())
+        self.assertEqual(testPipeline.queueSize, 5)
+
+    def test_run(self):
+        testSink = MockSink()
+        testPipeline = AsyncPipeline(MagicMock(), testSink)
+        results = runPipeline(testPipeline, iter([[1, 2], [3]]))
+        self.assertEqual(results, [(True, 1), (True, 2), (True, 3)])
+        self.assertEqual(testSink.sent, [[1, 2], [3]])
+
+    def test_run_batch_error(self):
+        def failingBatches():
+            yield [1]
+            raise ValueError('bad batch')
+
+        testPipeline = AsyncPipeline(MagicMock(), MockSink())
+        with self.assertRaises(ValueError):
+            runPipeline(testPipeline, failingBatches())
+
+    def test_run_async_client(self):
+        mockClient = MagicMock()
+        mockClient.transport.hosts = [{'host': 'test'}]
+        mockClient.transport.kwargs = {'timeout': 60}
+        mockAsync = MagicMock()
+        mockAsync.return_value.transport.close.side_effect = lambda: asyncio.sleep(0)
+
+        testSink = MockSink()
+
+        async def mockSendAsync(chunk, asyncClient):
+            return chunk
+
+        testSink.sendChunkAsync = mockSendAsync
+        testPipeline = AsyncPipeline(mockClient, testSink)
+        with patch('lib.pipelineManager.AsyncElasticsearch', mockAsync):
+            results = runPipeline(testPipeline, iter([[1]]))
+
+        self.assertEqual(results, [(True, 1)])
+        self.assertEqual(testSink.sent, [])
+        mockAsync.assert_called_once_with(hosts=[{'host': 'test'}], timeout=60)
+        mockAsync.return_value.transport.close.assert_called_once()
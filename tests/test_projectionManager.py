@@ -0,0 +1,198 @@
+import unittest
+from unittest.mock import MagicMock
+from itertools import count
+from types import SimpleNamespace
+import os
+
+os.environ['ES_INDEX'] = 'test'
+
+from sfrCore import Work, Instance, Item
+
+from lib.esManager import ESDoc
+from lib.projectionManager import projectWorks, WorkProjector
+from scripts.fixtures import buildWorks
+
+
+class GraphQuery():
+    """Answers the queries of a WorkProjector from a graph of in-memory
+    records, as the database would from the tables they were loaded from
+    """
+    def __init__(self, records, columns):
+        self.records = records
+        self.columns = columns
+        self.joins = []
+        self.parentIDs = []
+
+    def join(self, relationship):
+        self.joins.append(relationship)
+        return self
+
+    def filter(self, clause):
+        self.parentIDs = [param.value for param in clause.right.element.clauses]
+        return self
+
+    def order_by(self, *columns):
+        self.parentIDs = sorted(self.parentIDs)
+        return self
+
+    def __iter__(self):
+        parentModel = self.columns[0].class_
+        for parentID in self.parentIDs:
+            parent = self.records[parentModel][parentID]
+            if len(self.joins) < 1:
+                yield GraphQuery._values(parent, self.columns)
+                continue
+
+            for child in getattr(parent, self.joins[0].key):
+                if len(self.joins) > 1:
+                    yield (parentID, getattr(child, self.columns[1].key))\
+                        + GraphQuery._values(
+                            getattr(child, self.joins[1].key), self.columns[2:]
+                        )
+                else:
+                    yield (parentID,)\
+                        + GraphQuery._values(child, self.columns[1:])
+
+    @staticmethod
+    def _values(record, columns):
+        return tuple(getattr(record, column.key, None) for column in columns)
+
+
+def numberWorks(works, projector):
+    """Give every record in the works a unique ID, as rows in the database
+    would have, and index the records that the projector selects children of
+    by their model
+    """
+    ids = count(1)
+    numbered = {}
+    records = {
+        Work: {}, Instance: {}, Item: {}, projector.Agent: {},
+        projector.Identifier: {}, projector.Rights: {}
+    }
+
+    def number(record, model=None):
+        if id(record) not in numbered:
+            record.id = next(ids)
+            numbered[id(record)] = record
+            for value in vars(record).values():
+                if isinstance(value, list):
+                    for child in value:
+                        number(child)
+        if model is not None:
+            records[model][record.id] = record
+
+    for work in works:
+        number(work, Work)
+        for identifier in work.identifiers:
+            number(identifier, projector.Identifier)
+        for rel in work.agent_works:
+            number(rel.agent, projector.Agent)
+        for instance in work.instances:
+            number(instance, Instance)
+            for rights in instance.rights:
+                number(rights, projector.Rights)
+            for rel in instance.agent_instances:
+                number(rel.agent, projector.Agent)
+            for item in instance.items:
+                number(item, Item)
+                for identifier in item.identifiers:
+                    number(identifier, projector.Identifier)
+
+    return records
+
+
+class TestProjectionManager(unittest.TestCase):
+
+    def test_field_columns(self):
+        columns = WorkProjector._fieldColumns(
+            Work, ['title', 'title', 'langauge', 'uuid']
+        )
+        self.assertEqual(
+            [column.key for column in columns], ['id', 'title', 'uuid']
+        )
+
+    def test_project_no_works(self):
+        mockSession = MagicMock()
+        mockSession.query.return_value.filter.return_value.order_by.return_value = []
+        self.assertEqual(projectWorks(mockSession, [1, 2]), [])
+        mockSession.query.assert_called_once()
+
+    def test_project_matches_records(self):
+        works = buildWorks(10)
+        projector = WorkProjector(None)
+        records = numberWorks(works, projector)
+        projector.session = MagicMock()
+        projector.session.query.side_effect = lambda *columns: GraphQuery(
+            records, columns
+        )
+
+        projected = projector.project([work.id for work in reversed(works)])
+
+        self.assertEqual(len(projected), len(works))
+        for work, projectedWork in zip(works, projected):
+            esWork = ESDoc((work.id,), None, dbRec=work)
+            esWork.indexWork()
+            esProjected = ESDoc((work.id,), None, dbRec=projectedWork)
+            esProjected.indexWork()
+            self.assertEqual(
+                esProjected.work.to_dict(True), esWork.work.to_dict(True)
+            )
+
+    def test_attach(self):
+        mockSession = MagicMock()
+        mockQuery = mockSession.query.return_value.join.return_value.filter.return_value
+        mockQuery.order_by.return_value = [
+            (1, 10, 'Alt 1'), (1, 11, 'Alt 2'), (1, 11, 'Alt 2'),
+            (2, 10, 'Alt 1')
+        ]
+        parents = {1: SimpleNamespace(), 2: SimpleNamespace(), 3: SimpleNamespace()}
+        projector = WorkProjector(mockSession)
+        children = projector._attach(
+            parents, Work, Work.alt_titles, 'alt_titles', ['title']
+        )
+
+        self.assertEqual(
+            [alt.title for alt in parents[1].alt_titles], ['Alt 1', 'Alt 2']
+        )
+        self.assertIs(parents[2].alt_titles[0], parents[1].alt_titles[0])
+        self.assertEqual(parents[3].alt_titles, [])
+        self.assertEqual(set(children.keys()), {10, 11})
+        mockQuery.order_by.assert_called_once()
+
+    def test_attach_no_parents(self):
+        mockSession = MagicMock()
+        projector = WorkProjector(mockSession)
+        children = projector._attach({}, Work, Work.links, 'links', ['url'])
+        self.assertEqual(children, {})
+        mockSession.query.assert_not_called()
+
+    def test_attach_agents(self):
+        mockSession = MagicMock()
+        mockRows = mockSession.query.return_value.join.return_value.join.return_value
+        mockRows.filter.return_value.order_by.return_value = [
+            (1, 'author', 5, 'Agent'), (1, 'author', 5, 'Agent'),
+            (1, 'editor', 5, 'Agent'), (2, 'editor', 5, 'Agent')
+        ]
+        parents = {1: SimpleNamespace(), 2: SimpleNamespace()}
+        projector = WorkProjector(mockSession)
+        projector._attachAgents(
+            parents, Work, Work.agent_works, 'agent_works', projector.AgentWork
+        )
+
+        self.assertEqual(
+            [rel.role for rel in parents[1].agent_works], ['author', 'editor']
+        )
+        self.assertEqual(parents[2].agent_works[0].role, 'editor')
+        self.assertIs(
+            parents[1].agent_works[0].agent, parents[2].agent_works[0].agent
+        )
+        self.assertEqual(list(projector.agents.keys()), [5])
+
+    def test_attach_identifier_values(self):
+        mockSession = MagicMock()
+        mockSession.query.return_value.join.return_value.filter.return_value\
+            .order_by.return_value = [(1, 20, 'value1')]
+        projector = WorkProjector(mockSession)
+        projector.identifiers = {1: SimpleNamespace(id=1, type=None)}
+        projector._attachIdentifierValues()
+        self.assertEqual(projector.identifiers[1].generic[0].value, 'value1')
@@ -0,0 +1,94 @@
+import unittest
+from unittest.mock import MagicMock
+import os
+import tempfile
+
+from helpers.errorHelpers import ReconcileError
+from lib.reconcileManager import (
+    streamIndexIDs,
+    findFormerParents,
+    mergeIDs,
+    ReconcileCursor
+)
+
+
+def mockSearch(index, doc_type, body, _source):
+    """Serve sorted document IDs a page at a time using search_after"""
+    docIDs = ['a', 'b', 'c', 'd', 'e']
+    if 'search_after' in body:
+        docIDs = [d for d in docIDs if d > body['search_after'][0]]
+    return {'hits': {'hits': [
+        {'_id': docID, 'sort': [docID]} for docID in docIDs[:body['size']]
+    ]}}
+
+
+class TestReconcileManager(unittest.TestCase):
+    def test_stream_index_ids(self):
+        mockClient = MagicMock()
+        mockClient.search.side_effect = mockSearch
+        res = list(streamIndexIDs(mockClient, 'test', 'doc', pageSize=2))
+        self.assertEqual(res, ['a', 'b', 'c', 'd', 'e'])
+        self.assertEqual(mockClient.search.call_count, 3)
+        self.assertEqual(
+            mockClient.search.call_args[1]['body']['search_after'], ['d']
+        )
+
+    def test_stream_index_ids_after(self):
+        mockClient = MagicMock()
+        mockClient.search.side_effect = mockSearch
+        res = list(streamIndexIDs(mockClient, 'test', 'doc', after='c'))
+        self.assertEqual(res, ['d', 'e'])
+
+    def test_find_former_parents(self):
+        def innerHits(*instanceIDs):
+            return {'instances': {'hits': {'hits': [
+                {'_source': {'instance_id': i}} for i in instanceIDs
+            ]}}}
+
+        mockClient = MagicMock()
+        mockClient.search.return_value = {'hits': {'hits': [
+            {'_id': 'uuid1', 'sort': ['uuid1'], 'inner_hits': innerHits(1, 2)},
+            {'_id': 'uuid2', 'sort': ['uuid2'], 'inner_hits': innerHits(2, 3)}
+        ]}}
+        res = findFormerParents(
+            mockClient, 'test', 'doc', {1: 'uuid1', 2: 'uuid2', 3: 'uuid2'}
+        )
+        self.assertEqual(res, {'uuid1': [2]})
+        query = mockClient.search.call_args[1]['body']['query']['nested']
+        self.assertEqual(
+            query['query'], {'terms': {'instances.instance_id': [1, 2, 3]}}
+        )
+
+    def test_merge_ids(self):
+        res = list(mergeIDs(
+            iter(['a', 'b', 'd', 'f', 'g']), iter(['b', 'c', 'd', 'e', 'g', 'h'])
+        ))
+        self.assertEqual(res, [
+            ('missing', 'a'), ('match', 'b'), ('orphan', 'c'), ('match', 'd'),
+            ('orphan', 'e'), ('missing', 'f'), ('match', 'g'), ('orphan', 'h')
+        ])
+
+    def test_merge_ids_empty(self):
+        self.assertEqual(list(mergeIDs(iter([]), iter([]))), [])
+        self.assertEqual(
+            list(mergeIDs(iter(['a']), iter([]))), [('missing', 'a')]
+        )
+
+    def test_cursor(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            cursorPath = os.path.join(tmpDir, 'cursor.json')
+            cursor = ReconcileCursor(cursorPath)
+            self.assertIsNone(cursor.load())
+            cursor.save('uuid5')
+            self.assertEqual(ReconcileCursor(cursorPath).load(), 'uuid5')
+            cursor.clear()
+            self.assertFalse(os.path.exists(cursorPath))
+            cursor.clear()
+
+    def test_cursor_invalid(self):
+        with tempfile.TemporaryDirectory() as tmpDir:
+            cursorPath = os.path.join(tmpDir, 'cursor.json')
+            with open(cursorPath, 'w') as cursorFile:
+                cursorFile.write('{"bad"')
+            with self.assertRaises(ReconcileError):
+                ReconcileCursor(cursorPath).load()
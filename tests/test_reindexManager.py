@@ -0,0 +1,103 @@
+import unittest
+from unittest.mock import patch, MagicMock
+import os
+
+from elasticsearch.exceptions import NotFoundError
+
+os.environ['ES_INDEX'] = 'test'
+
+from lib.reindexManager import IndexRebuild
+
+
+class TestReindexManager(unittest.TestCase):
+    def setUp(self):
+        self.mockClient = MagicMock()
+        self.testRebuild = IndexRebuild(self.mockClient, 'test')
+        self.testRebuild.name = 'test_1'
+
+    def test_versioned_name(self):
+        testRebuild = IndexRebuild(self.mockClient, 'test')
+        self.assertRegex(testRebuild.name, r'^test_\d{14}$')
+
+    def test_resumed_name(self):
+        testRebuild = IndexRebuild(self.mockClient, 'test', 'test_2')
+        self.assertEqual(testRebuild.name, 'test_2')
+
+    @patch('lib.reindexManager.Work')
+    def test_create(self, mock_work):
+        mockIndex = mock_work._index.clone.return_value
+        self.testRebuild.create()
+        mock_work._index.clone.assert_called_once_with(name='test_1')
+        mockIndex.settings.assert_called_once_with(
+            refresh_interval='-1', number_of_replicas=0
+        )
+        mockIndex.create.assert_called_once_with(using=self.mockClient)
+
+    def test_live_settings(self):
+        self.mockClient.indices.get_settings.return_value = {
+            'test_0': {'settings': {'index': {
+                'refresh_interval': '30s', 'number_of_replicas': '2'
+            }}}
+        }
+        self.assertEqual(self.testRebuild.liveSettings(), {
+            'refresh_interval': '30s', 'number_of_replicas': '2'
+        })
+
+    def test_live_settings_missing(self):
+        self.mockClient.indices.get_settings.side_effect = NotFoundError
+        self.assertEqual(self.testRebuild.liveSettings(), {
+            'refresh_interval': None, 'number_of_replicas': None
+        })
+
+    def test_finish(self):
+        self.testRebuild.liveSettings = MagicMock(return_value={
+            'refresh_interval': None, 'number_of_replicas': '1'
+        })
+        self.testRebuild.swapAlias = MagicMock()
+        self.testRebuild.finish()
+        self.mockClient.indices.put_settings.assert_called_once_with(
+            index='test_1', body={'index': {
+                'refresh_interval': None, 'number_of_replicas': '1'
+            }}
+        )
+        self.mockClient.indices.forcemerge.assert_called_once_with(
+            index='test_1', max_num_segments=1, request_timeout=600
+        )
+        self.testRebuild.swapAlias.assert_called_once()
+
+    def test_swap_alias(self):
+        self.mockClient.indices.exists_alias.return_value = True
+        self.mockClient.indices.get_alias.return_value = {'test_0': {}}
+        self.testRebuild.swapAlias()
+        self.mockClient.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove': {'index': 'test_0', 'alias': 'test'}},
+                {'add': {'index': 'test_1', 'alias': 'test'}}
+            ]
+        })
+        self.mockClient.indices.delete.assert_not_called()
+
+    def test_swap_alias_replaces_index(self):
+        self.mockClient.indices.exists_alias.return_value = False
+        self.mockClient.indices.exists.return_value = True
+        self.testRebuild.swapAlias()
+        self.mockClient.indices.update_aliases.assert_called_once_with(body={
+            'actions': [
+                {'remove_index': {'index': 'test'}},
+                {'add': {'index': 'test_1', 'alias': 'test'}}
+            ]
+        })
+
+    def test_swap_alias_new(self):
+        self.mockClient.indices.exists_alias.return_value = False
+        self.mockClient.indices.exists.return_value = False
+        self.testRebuild.swapAlias()
+        self.mockClient.indices.update_aliases.assert_called_once_with(body={
+            'actions': [{'add': {'index': 'test_1', 'alias': 'test'}}]
+        })
+
+    def test_discard(self):
+        self.testRebuild.discard()
+        self.mockClient.indices.delete.assert_called_once_with(
+            index='test_1', ignore=[404]
+        )
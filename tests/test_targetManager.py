@@ -0,0 +1,60 @@
+import unittest
+from unittest.mock import patch
+
+from lib.targetManager import createIndexTargets, loadSerializer, IndexTarget
+from helpers.errorHelpers import ESError
+
+
+def upperTitle(source):
+    return dict(source, title=source['title'].upper())
+
+
+class TestTargetManager(unittest.TestCase):
+    def test_create_targets_default(self):
+        targets = createIndexTargets('test')
+        self.assertEqual([target.name for target in targets], ['test'])
+        self.assertFalse(targets[0].projected)
+
+    @patch.dict('os.environ', {'INDEX_TARGETS': (
+        '[{"index": "test_v2", "exclude": ["summary"],'
+        ' "serializer": "tests.test_targetManager.upperTitle"}]'
+    )})
+    def test_create_targets(self):
+        targets = createIndexTargets('test')
+        self.assertEqual(
+            [target.name for target in targets], ['test', 'test_v2']
+        )
+        self.assertEqual(targets[1].exclude, {'summary'})
+        self.assertEqual(targets[1].serializer, upperTitle)
+
+    @patch.dict('os.environ', {'INDEX_TARGETS': '[{"exclude": []}]'})
+    def test_create_targets_invalid(self):
+        with self.assertRaises(ESError):
+            createIndexTargets('test')
+
+    def test_load_serializer_missing(self):
+        with self.assertRaises(ESError):
+            loadSerializer('tests.test_targetManager.missing')
+
+    def test_action_unchanged(self):
+        testAction = {'_index': 'test', '_id': '1', '_source': {'title': 't'}}
+        self.assertIs(IndexTarget('test').action(testAction), testAction)
+
+    def test_action_renamed(self):
+        testSource = {'title': 't'}
+        testAction = {'_index': 'test', '_id': '1', '_source': testSource}
+        targetAction = IndexTarget('test_v2').action(testAction)
+        self.assertEqual(targetAction['_index'], 'test_v2')
+        self.assertIs(targetAction['_source'], testSource)
+        self.assertEqual(testAction['_index'], 'test')
+
+    def test_action_projected(self):
+        testAction = {'_index': 'test', '_id': '1', '_source': {
+            'title': 't', 'summary': 's', 'medium': 'm'
+        }}
+        target = IndexTarget(
+            'test_v2', include=['title', 'summary'], exclude=['summary'],
+            serializer=upperTitle
+        )
+        self.assertEqual(target.action(testAction)['_source'], {'title': 'T'})
+        self.assertEqual(testAction['_source']['title'], 't')
@@ -0,0 +1,79 @@
+import unittest
+from unittest.mock import patch, MagicMock
+
+from lib.workerManager import createTransformPool, TransformPool, runWorker
+from helpers.errorHelpers import TransformError
+
+
+def mockTransform(session, workIDs, cache):
+    return [workID[0] * 2 for workID in workIDs]
+
+
+def mockFailingTransform(session, workIDs, cache):
+    raise ValueError('bad work')
+
+
+@patch.dict('os.environ', {'DOC_CACHE_SIZE': '0'})
+@patch('lib.workerManager.SessionManager')
+class TestWorkerManager(unittest.TestCase):
+    def test_create_pool_default(self, mock_manager):
+        self.assertEqual(createTransformPool(mockTransform), None)
+
+    @patch.dict('os.environ', {'INDEX_WORKERS': '3'})
+    def test_create_pool(self, mock_manager):
+        testPool = createTransformPool(mockTransform)
+        self.assertEqual(testPool.workerCount, 3)
+        self.assertEqual(testPool.transform, mockTransform)
+
+    def test_pool_map(self, mock_manager):
+        testPool = TransformPool(2, mockTransform)
+        batches = [
+            [(1, 'date1'), (2, 'date2')], [(3, 'date3')], [(4, 'date4')]
+        ]
+        results = list(testPool.map(iter(batches)))
+        self.assertEqual(
+            sorted(results), [[2, 4], [6], [8]]
+        )
+
+    def test_pool_map_empty(self, mock_manager):
+        testPool = TransformPool(2, mockTransform)
+        self.assertEqual(list(testPool.map(iter([]))), [])
+
+    def test_pool_map_error(self, mock_manager):
+        testPool = TransformPool(2, mockFailingTransform)
+        with self.assertRaises(TransformError):
+            list(testPool.map(iter([[(1, 'date1')]])))
+
+    @patch('lib.workerManager.createMemoryGuard')
+    def test_pool_map_memory_guard(self, mock_guard, mock_manager):
+        mock_guard.return_value.batchSize = 5
+        memoryGuard = MagicMock()
+        testPool = TransformPool(2, mockTransform, memoryGuard)
+        results = list(testPool.map(iter([[(1, 'date1')], [(2, 'date2')]])))
+        self.assertEqual(sorted(results), [[2], [4]])
+        memoryGuard.reduce.assert_called_with(5)
+        self.assertEqual(memoryGuard.reduce.call_count, 2)
+
+    @patch('lib.workerManager.createMemoryGuard')
+    def test_worker_checks_memory(self, mock_guard, mock_manager):
+        mock_guard.return_value.batchSize = 5
+        mockConn = MagicMock()
+        mockConn.recv.side_effect = [[(1, 'date1')], None]
+        runWorker(mockConn, mockTransform)
+        mock_guard.return_value.check.assert_called_once()
+        self.assertEqual(
+            mockConn.send.call_args_list[0][0][0], ('result', ([2], 5))
+        )
+
+    @patch.dict('os.environ', {'DB_SNAPSHOT': 'snap-1'})
+    @patch('lib.workerManager.importSnapshot')
+    def test_worker_imports_snapshot(self, mock_import, mock_manager):
+        mockConn = MagicMock()
+        mockConn.recv.return_value = None
+        runWorker(mockConn, mockTransform)
+        mock_import.assert_called_once_with(
+            mock_manager.return_value.createSession.return_value, 'snap-1'
+        )
+        mockConn.send.assert_called_once_with(
+            ('stats', {'works': 0, 'seconds': 0})
+        )